@@ -0,0 +1,77 @@
+"""! A stand-in for the gimpfu module (benchmarks only).
+
+It provides the parts of gimpfu used by create_anaglyph_plugin.py: the pdb procedures to create and
+display the output image, register/main and the constants. Images and layers are
+layer_stack.ArrayImage/ArrayLayer objects (backed by numpy arrays), i.e., the plugin can be
+imported and run without gimp. The registered procedures are collected in procedures.
+"""
+import os
+import tempfile
+import numpy
+from layer_stack import ArrayLayer
+
+RGB, GRAY, INDEXED = 0, 1, 2
+RGB_IMAGE, RGBA_IMAGE, GRAY_IMAGE, GRAYA_IMAGE = 0, 1, 2, 3
+NORMAL_MODE = 0
+(PF_INT8, PF_INT16, PF_INT32, PF_INT, PF_FLOAT, PF_STRING, PF_VALUE, PF_COLOR, PF_IMAGE, PF_LAYER, PF_CHANNEL,
+ PF_DRAWABLE, PF_TOGGLE, PF_BOOL, PF_SLIDER, PF_SPINNER, PF_ADJUSTMENT, PF_FONT, PF_FILE, PF_BRUSH, PF_PATTERN,
+ PF_GRADIENT, PF_RADIO, PF_TEXT, PF_PALETTE, PF_FILENAME, PF_DIRNAME, PF_OPTION) = range(28)
+
+## the procedures registered with register (by name)
+procedures = {}
+
+class FakeImage:
+    """! A gimp image without layers (layers are added with add_layer). """
+    def __init__(self, width, height, image_type=RGB):
+        self.width = width
+        self.height = height
+        self.image_type = image_type
+        self.layers = []
+
+    def add_layer(self, layer, position=0):
+        """! Adds a layer (position 0 = top most layer). """
+        self.layers.insert(position, layer)
+
+class FakeDisplay:
+    """! A gimp display (does nothing). """
+    def __init__(self, image):
+        self.image = image
+
+class FakeGimp:
+    """! The gimp module (only gimp.directory is used by the plugin). """
+    def __init__(self):
+        self.directory = os.path.join(tempfile.gettempdir(), "fake_gimp")
+
+class FakePdb:
+    """! The procedural database (only the procedures used by the plugin). """
+    def __init__(self):
+        self.progress = 0.0
+
+    def gimp_image_new(self, width, height, image_type):
+        return FakeImage(width, height, image_type)
+
+    def gimp_layer_new(self, image, width, height, layer_type, name, opacity, mode):
+        channels = {RGB_IMAGE: 3, RGBA_IMAGE: 4, GRAY_IMAGE: 1, GRAYA_IMAGE: 2}[layer_type]
+        return ArrayLayer(name, numpy.zeros((height, width, channels), dtype=numpy.uint8))
+
+    def gimp_layer_add_alpha(self, layer):
+        if layer.data.shape[2] in (1, 3):
+            alpha = numpy.zeros((layer.height, layer.width, 1), dtype=numpy.uint8)
+            layer.data = numpy.concatenate((layer.data, alpha), axis=2)
+
+    def gimp_display_new(self, image):
+        return FakeDisplay(image)
+
+    def gimp_progress_update(self, progress):
+        self.progress = progress
+
+gimp = FakeGimp()
+pdb = FakePdb()
+
+def register(name, blurb, help, author, copyright, date, label, imagetypes, params, results, function):
+    """! Records a plugin procedure (see procedures). """
+    procedures[name] = function
+
+def main():
+    """! Does nothing (gimp would start the plugin here). """
+    pass
@@ -0,0 +1,231 @@
+#! /usr/bin/env python
+"""! Benchmarks of the stages of the anaglyph algorithm on synthetic layer stacks.
+
+Usage:
+    python benchmark/run_benchmarks.py [--full] [--save] [--baseline <file>] [--tolerance <t>] [--require-baseline]
+
+For each case of a matrix (canvas size, layer count, alpha coverage, constant depth or depth map;
+see synthetic.make_stack) the following stages are timed (best of --repeat runs) and their peak
+memory is measured (tracemalloc, python 3 only):
+ * layer2array: converting all layers to numpy arrays (float64)
+ * DepthAlgo: parsing the layer names and computing all disparities
+ * update: Anaglyph.update for all layers with a constant depth
+ * update_ext: Anaglyph.update_ext for all layers with a depth map
+ * get_result: Anaglyph.get_result
+ * plugin: the plugin procedure (create_anaglyph_plugin.run, with the stand-in gimpfu module)
+
+With --save the results are stored as baselines. Otherwise the results are compared with the
+stored baselines and the script fails (exit code 1) if a stage is slower or needs more memory than
+its baseline (plus the tolerance). The baselines depend on the machine: create them on the machine
+used for the comparison. Therefore no baselines are committed; without baselines the results are only
+printed. A CI job checking a change runs both on the same runner:
+    git checkout <base commit> && python benchmark/run_benchmarks.py --save
+    git checkout <change> && python benchmark/run_benchmarks.py --require-baseline
+With --require-baseline, missing baselines (no file or a case/stage without baseline) fail the run.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import numpy
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "plugin"))
+sys.path.insert(0, HERE)
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from gimpfu_numpy_converter import layer2array
+from anaglyph_algorithm import Anaglyph
+from depth_algorithm import DepthAlgo
+from synthetic import make_stack, CONSTANT_DEPTH, DEPTH_MAP
+
+## the default baseline file
+DEFAULT_BASELINE = os.path.join(HERE, "baselines.json")
+
+## the case matrix: canvas sizes (width, height), layer counts, coverages, kinds of depth
+QUICK_MATRIX = ([(256, 256), (1024, 768)], [4, 16], [0.25, 1.0], [CONSTANT_DEPTH, DEPTH_MAP])
+FULL_MATRIX = ([(256, 256), (1024, 768), (3000, 2000)], [4, 16, 64], [0.05, 0.25, 1.0], [CONSTANT_DEPTH, DEPTH_MAP])
+
+## parameters of the rendering
+MINDISP, MAXDISP, F1, F2 = 0.0, 2.0, 1.0, 0.8
+
+_clock = getattr(time, "perf_counter", time.time)
+
+def case_name(size, layers, coverage, depth):
+    """! @return the name of a case (key of the baselines) """
+    return "%dx%d_n%d_c%g_%s"%(size[0], size[1], layers, coverage, depth)
+
+def cases(matrix):
+    """! @return generator of (name, size, layers, coverage, depth) of all cases of a matrix """
+    sizes, counts, coverages, depths = matrix
+    for size in sizes:
+        for layers in counts:
+            for coverage in coverages:
+                for depth in depths:
+                    yield case_name(size, layers, coverage, depth), size, layers, coverage, depth
+
+class Stages:
+    """! The stages of one case. Each stage is a function without parameters; the input of a stage
+    (e.g. the converted layers) is prepared beforehand and not measured.
+    """
+    def __init__(self, image):
+        self.image = image
+        self.depthalgo = DepthAlgo(image, MINDISP, MAXDISP)
+        self.entries = self.depthalgo.layers()
+        self.data = [layer2array(entry.layer, dtype=numpy.float64) for entry in self.entries]
+        self.disparities = [self.depthalgo.disparity(entry) for entry in self.entries]
+        self.anaglyph = Anaglyph(F1, F2)
+        for entry, data, d in zip(self.entries, self.data, self.disparities):
+            (self.anaglyph.update_ext if entry.has_map() else self.anaglyph.update)(data, d)
+
+    def functions(self):
+        """! @return list of (stage name, function); stages without work (e.g. no depth maps) are omitted """
+        stages = [("layer2array", self.layer2array), ("DepthAlgo", self.depth_algo)]
+        if not all(entry.has_map() for entry in self.entries):
+            stages.append(("update", self.update))
+        if any(entry.has_map() for entry in self.entries):
+            stages.append(("update_ext", self.update_ext))
+        stages += [("get_result", self.get_result), ("plugin", self.plugin)]
+        return stages
+
+    def layer2array(self):
+        for layer in self.image.layers:
+            layer2array(layer, dtype=numpy.float64)
+
+    def depth_algo(self):
+        depthalgo = DepthAlgo(self.image, MINDISP, MAXDISP)
+        for entry in depthalgo.layers():
+            depthalgo.disparity(entry)
+        depthalgo.close()
+
+    def update(self):
+        anaglyph = Anaglyph(F1, F2)
+        for entry, data, d in zip(self.entries, self.data, self.disparities):
+            if not entry.has_map():
+                anaglyph.update(data, d)
+
+    def update_ext(self):
+        anaglyph = Anaglyph(F1, F2)
+        for entry, data, d in zip(self.entries, self.data, self.disparities):
+            if entry.has_map():
+                anaglyph.update_ext(data, d)
+
+    def get_result(self):
+        self.anaglyph.get_result(False)
+
+    def plugin(self):
+        # the plugin prints the layers: not part of the benchmark output
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            import create_anaglyph_plugin
+            create_anaglyph_plugin.run(self.image, None, MINDISP, MAXDISP, F1, F2, False, False)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+def measure(function, repeat):
+    """! Measures a stage.
+    @param function the stage
+    @param repeat the number of timed runs
+    @return dict with the best time (seconds) and the peak memory (bytes, None without tracemalloc)
+    """
+    best = None
+    for i in range(repeat):
+        gc.collect()
+        t = _clock()
+        function()
+        t = _clock()-t
+        best = t if best is None else min(best, t)
+    peak = None
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {"time": best, "peak": peak}
+
+def compare(results, baselines, tolerance, memory_tolerance, min_time=0.002, require_baseline=False):
+    """! Compares results with baselines.
+    @param results dict case -> stage -> measurement
+    @param baselines the stored results (same structure)
+    @param tolerance the allowed relative increase of the time
+    @param memory_tolerance the allowed relative increase of the peak memory
+    @param min_time time differences below this (seconds) are ignored (timer noise)
+    @param require_baseline if true a stage without baseline is reported as regression (else it is skipped)
+    @return list of messages describing the regressions
+    """
+    regressions = []
+    for case, stages in sorted(results.items()):
+        for stage, r in sorted(stages.items()):
+            b = baselines.get(case, {}).get(stage)
+            if b is None:
+                if require_baseline:
+                    regressions.append("%s %s: no baseline"%(case, stage))
+                continue
+            if r["time"] > b["time"]*(1+tolerance) and r["time"]-b["time"] > min_time:
+                regressions.append("%s %s: time %.4fs (baseline %.4fs)"%(case, stage, r["time"], b["time"]))
+            if r["peak"] is not None and b.get("peak") is not None and r["peak"] > b["peak"]*(1+memory_tolerance)+65536:
+                regressions.append("%s %s: peak memory %d bytes (baseline %d bytes)"%(case, stage, r["peak"], b["peak"]))
+    return regressions
+
+def main(argv=None):
+    """! Command line entry point. """
+    parser = argparse.ArgumentParser(description="Benchmarks of the anaglyph algorithm stages (synthetic layer stacks).")
+    parser.add_argument("--full", action="store_true", help="run the full matrix (default: quick matrix)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage (default: 3)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file (default: %s)"%(DEFAULT_BASELINE))
+    parser.add_argument("--save", action="store_true", help="store the results as baselines (merged into the baseline file)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative time increase (default: 0.25)")
+    parser.add_argument("--memory-tolerance", type=float, default=0.10, help="allowed relative peak memory increase (default: 0.10)")
+    parser.add_argument("--require-baseline", action="store_true",
+                        help="fail if the baselines are missing (for CI, see the module documentation)")
+    parser.add_argument("--case", default=None, help="only run the cases containing this string")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, size, layers, coverage, depth in cases(FULL_MATRIX if args.full else QUICK_MATRIX):
+        if args.case is not None and args.case not in name:
+            continue
+        stages = Stages(make_stack(size[0], size[1], layers, coverage, depth))
+        results[name] = {}
+        for stage, function in stages.functions():
+            r = measure(function, args.repeat)
+            results[name][stage] = r
+            print("%-32s %-12s %9.4fs %12s bytes"%(name, stage, r["time"], "-" if r["peak"] is None else r["peak"]))
+        del stages
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    if args.save:
+        for name, stages in results.items():
+            baselines.setdefault(name, {}).update(stages)
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        print("baselines stored in %s"%(args.baseline))
+        return 0
+    if not baselines:
+        print("no baselines found (%s), use --save to create them"%(args.baseline))
+        return 1 if args.require_baseline else 0
+    regressions = compare(results, baselines, args.tolerance, args.memory_tolerance,
+                          require_baseline=args.require_baseline)
+    for message in regressions:
+        print("REGRESSION "+message)
+    if regressions:
+        return 1
+    print("no regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
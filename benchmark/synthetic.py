@@ -0,0 +1,52 @@
+"""! Synthetic layer stacks for the benchmarks. """
+import numpy
+from layer_stack import ArrayLayer, ArrayImage
+
+## kinds of depth of the synthetic layers
+CONSTANT_DEPTH, DEPTH_MAP = "constant", "map"
+
+def make_layer(rng, name, width, height, coverage):
+    """! Creates a gray level layer with a random rectangle of visible pixels.
+    @param rng the random generator (numpy.random.RandomState)
+    @param name the layer name
+    @param width the layer width
+    @param height the layer height
+    @param coverage the fraction of visible pixels (alpha>0)
+    @return the ArrayLayer
+    """
+    data = numpy.zeros((height, width, 2), dtype=numpy.uint8)
+    data[:,:,0] = rng.randint(0, 256, (height, width))
+    h = max(1, int(round(height*coverage**0.5)))
+    w = max(1, min(width, int(round(width*height*coverage/float(h)))))
+    y = rng.randint(0, height-h+1)
+    x = rng.randint(0, width-w+1)
+    data[y:y+h,x:x+w,1] = rng.randint(1, 256, (h, w))
+    return ArrayLayer(name, data)
+
+def make_stack(width, height, layers, coverage, depth=CONSTANT_DEPTH, seed=0):
+    """! Creates a synthetic layer stack.
+    The stack consists of layers-1 partially visible layers over an opaque background.
+    With depth==DEPTH_MAP, the layers use a depth map ("reldepthmap=m"), defined by
+    a horizontal gradient layer ("depthmap m 0 to 1") on top of the stack.
+    @param width the image width
+    @param height the image height
+    @param layers the number of layers (without the depth map)
+    @param coverage the fraction of visible pixels of each layer (except the background)
+    @param depth CONSTANT_DEPTH or DEPTH_MAP
+    @param seed the seed of the random generator
+    @return the ArrayImage (top most layer first)
+    """
+    rng = numpy.random.RandomState(seed)
+    stack = []
+    if depth == DEPTH_MAP:
+        gradient = numpy.zeros((height, width, 2), dtype=numpy.uint8)
+        gradient[:,:,0] = numpy.linspace(0, 255, width)[numpy.newaxis,:]
+        gradient[:,:,1] = 255
+        stack.append(ArrayLayer("depthmap m 0 to 1", gradient))
+    for i in range(layers-1):
+        name = "reldepthmap=m %d"%(i) if depth == DEPTH_MAP else "layer %d"%(i)
+        stack.append(make_layer(rng, name, width, height, coverage))
+    background = make_layer(rng, "background", width, height, 1.0)
+    background.data[:,:,1] = 255
+    stack.append(background)
+    return ArrayImage(stack)
@@ -1,7 +1,7 @@
 ## 
 # \mainpage Introduction
 # The anaglyph Generator generates a stereoscopic anaglyph image from a given
-# layered gray level image. Every layer is assigned a specific depth.
+# layered gray level or color image. Every layer is assigned a specific depth.
 # This information is then utilized to generate the stereoscopic image.
 # * \ref page_usage
 # * \ref page_installation
@@ -38,9 +38,37 @@
 #  * "swap left/right":
 #    * normally "no"
 #    * "yes" swaps left and right image (you swap the left and right side of your glasses)
+#  * "reuse results of previous runs":
+#    * "yes" stores intermediate results in the gimp directory (folder "create_anaglyph_cache", at most 2GB).
+#    * Changing only the luminance correction or "swap left/right" reuses the complete result. The layers are combined
+#      in spans of at least 4 layers: editing a single layer shifts only the layers of its span (the first edit of a
+#      layer also combines the other spans once). The first run is slower than without the cache (about twice).
+#  * "record timings (report in the gimp directory)":
+#    * "yes" records the wall time, cpu time and peak memory of each stage and layer (see profiler.Profiler; the peak
+#      memory is only known for stages not running at the same time as stages of other threads).
+#    * A summary is printed; the records are stored as create_anaglyph_profile.json/.csv in the gimp directory.
+#  * "output":
+#    * "anaglyph" (default), "side by side", "over/under", "row interleaved" (even rows left, odd rows right),
+#      "left and right" (two images) or "all".
+#    * The left and right image are rendered once, all selected formats are created from them (see stereo_output).
+#    * The other formats are gray level images (RGB images for RGB input); the luminance correction only applies to the anaglyph.
+#  * "colors (RGB images)":
+#    * the anaglyph of RGB images: "optimized (Dubois)" (default, least squares red/cyan matrices by E. Dubois, less
+#      retinal rivalry), "color" (red of the left image, green/blue of the right image), "half color" (luminance of the
+#      left image, green/blue of the right image) or "gray" (luminance of both images). Ignored for gray level images.
+#  * "use the render service (if running)":
+#    * "yes" sends the layers to a running render service (see below) instead of rendering them in the plugin.
+#
+# ### Preview
+# The plugin "Filters/Goto 40/Create Anaglyph Preview" has the same parameters and renders a small preview
+# (max. width in pixels, parameter "max. preview width"). The layers are downscaled by powers of 2 (preview.LayerPyramid),
+# the disparities are scaled accordingly. Use it to find good disparity values before rendering the full image.
+# The downscaled layers are kept in the gimp directory (folder "create_anaglyph_preview", at most 256MB): repeated
+# previews of unchanged layers only read them.
 #
 # Image and layer properties:
-#  * Only gray level images with and alpha channel can be used.
+#  * Gray level and RGB images (with alpha channel) can be used; the cache ("reuse results of previous runs") only
+#    supports gray level images.
 #  * All layers must have the full image size.
 #  * All layers must have no layer mask (apply before use).
 #  * The order of layers is used as depth (most visible layer is nearest).
@@ -65,6 +93,44 @@
 #  * JPG compression seems to destroy the stereoscopic effect in some cases (artifacts or color corruption?).
 #  * On my screen, with my glasses, with my eyes it is helpful to darken the cyan image.
 #
+# ### Batch processing (without gimp)
+# The module batch_anaglyph.py renders layer stacks stored on disk without gimp, e.g.
+#   python batch_anaglyph.py -o out/ --maxdisp 2.0 page1.npz page2.tif page3/
+# A layer stack is a directory of PNG/.npy files, a multi-page TIFF file or a .npz file (see layer_stack.load_stack).
+# The layer naming rules are the same as in the plugin. Several stacks are rendered in parallel (one process per core).
+# Very large images should be stored as directory of .npy layers and rendered to .npy:
+# the layers are then memory mapped and only one band of rows is held in memory (option --band-height).
+# Other stereo formats are selected with --outputs, e.g. --outputs anaglyph,side_by_side,left,right
+# (one file per format, all rendered in one pass). With --color <matrices> (dubois, color, half_color or gray) the layers
+# are read in color and a color anaglyph is rendered (see color_anaglyph).
+#
+# ### Stereo animations (without gimp)
+# The module sequence_renderer.py renders a sequence of frames, e.g.
+#   python sequence_renderer.py -o frames/ --outputs anaglyph,side_by_side anim.json
+# The sequence file (JSON) lists the frames: a layer stack per frame and optionally layers moved by (dx, dy) pixels
+# ("offsets") or with another depth ("depths"), by layer name. Layers which did not change since the previous frames
+# are not shifted and combined again (their contributions are kept in memory, option --cache-size);
+# every frame is written as soon as it is rendered. Only gray level layer stacks are supported.
+#
+# ### Render service
+# The module render_service.py is a long running local service rendering layer stacks submitted over HTTP (localhost):
+#   python render_service.py --workers 2 --memory-budget 2048
+# It keeps the loaded layer stacks and (for jobs with "cache") the combined layers between jobs. The jobs are queued and
+# rendered by a pool of workers; a job starts when its estimated memory fits into the memory budget. The plugin (parameter
+# "use the render service") and batch_anaglyph.py (option --service http://127.0.0.1:8765) can submit their jobs to it;
+# render_client.py contains the client functions. The service writes a random token to ~/.create_anaglyph_service_token
+# (readable by the user only, option --token-file); the clients send it with every request.
+#
+# ### Benchmarks
+# The directory benchmark (not part of the plugin) measures the time and peak memory of the stages of the algorithm
+# (layer2array, DepthAlgo, Anaglyph.update/update_ext/get_result and the plugin procedure) on synthetic layer stacks
+# (benchmark/synthetic.py; canvas size, layer count, alpha coverage, constant depth or depth maps):
+#   python benchmark/run_benchmarks.py --save     (stores the baselines, benchmark/baselines.json)
+#   python benchmark/run_benchmarks.py            (fails if a stage is slower or needs more memory than its baseline)
+# The baselines depend on the machine and are not committed: a CI job stores them on the base commit (--save) and
+# compares the change on the same runner with --require-baseline (fails if baselines are missing).
+# The plugin procedure runs with a stand-in gimpfu module (benchmark/gimpfu.py). Use --full for the large matrix.
+#
 # \page page_installation Installation
 # You need numpy to execute the plugin (e.g., apt-get install numpy).
 # You need to put the plugin code in the gimp plugin search path (e.g. see "Edit/Preferences/Folders/Plug-Ins").
@@ -96,6 +162,8 @@
 #    * Module anaglyph_algorithm.py (component "anaglyph_algorithm", class anaglyph_algorithm.Anaglyph): the core algorithm
 #    * Module depth_algorithm.py (component "depth_algorithm", class depth_algorithm.DepthAlgo): functions to determine a layers depth
 #    * Module gimpfu_numpy_converter.py (component "gimpfu_numpy_converter"): functions to convert from/to gimpfu data structures to/from numpy arrays.
+#    * Module anaglyph_renderer.py (component "anaglyph_renderer"): the layer loop combining the components above (used by the plugin and the batch renderer).
+#    * Module layer_stack.py and batch_anaglyph.py: stand-ins for gimp images/layers backed by numpy arrays and the headless batch renderer.
 #   \startuml
 #    node "Create Anaglyph Plugin" {
 #    component [anaglyph_algorithm] #Cyan
@@ -157,5 +225,32 @@
 #   ###Concepts
 #    * Data is converted from the gimp format to numpy and back.
 #    * Algorithms process on numpy arrays.
+#    * The layer names are parsed once (depth_algorithm.DepthAlgo.plan): the renderer iterates the resulting table of layer
+#      kinds and disparities, the cost is linear in the number of layers.
+#    * Depth maps are loaded when first needed (depth_algorithm.DepthMapStore), stored as float32 (large maps in a memory
+#      mapped scratch file) and freed after the last layer using them.
+#    * The disparity only shifts pixels along the rows. Thus, the layers are processed in bands of rows
+#      (anaglyph_renderer.render_bands): the memory needed is proportional to the band height, not to the image size.
+#      The bands are independent and are combined concurrently by a thread pool (one thread per core in the plugin);
+#      at most one band per thread is in flight and finished bands are passed on as uint8.
+#      Within a band, the next layers are read and converted by a background thread while the current layer is combined
+#      (anaglyph_renderer._prefetch, a bounded queue limits the memory).
+#    * anaglyph_algorithm.CompactAnaglyph is a float32 variant of the algorithm with preallocated buffers (in place operations).
+#    * forward_warp.ForwardWarpAnaglyph is an alternative algorithm for comparison: the pixels are splatted to where they
+#      go to (instead of sampled from where they come from), occlusions are resolved with a depth buffer.
+#    * front_to_back.FrontToBackAnaglyph combines the layers top most layer first ("under" operator) and skips rows which are
+#      already fully covered; the renderer stops reading layers as soon as everything is covered.
+#    * color_anaglyph.ColorAnaglyph handles RGB layers: both views are stored in one buffer (6 channels), all channels of
+#      a layer are shifted and blended at once, and the anaglyph is a single 6x3 matrix product per pixel (e.g. the Dubois
+#      matrices, the luminance correction is part of the matrix).
+#    * The output formats (stereo_output.write_outputs) are written from the left and right image directly into
+#      preallocated uint8 buffers, band by band (anaglyph_renderer.render_outputs).
+#    * render_cache.render_cached stores the composites of spans of layers, of the spans below/above an edited span and
+#      the result (keyed by content hashes) to recompute only what changed. sequence_renderer.render_sequence uses it (in memory) to reuse
+#      the unchanged layers of the frames of an animation.
+#    * render_service.RenderService renders jobs in a long running process (worker threads, a FIFO queue and a memory
+#      budget based on render_service.estimate_memory); render_client submits jobs over HTTP (JSON, files on disk).
+#    * The renderer wraps its stages (read, convert, disparity, update, update_ext, get_result, write) in
+#      profiler.stage; the default profiler.NULL_PROFILER records nothing, profiler.Profiler records every stage.
 # 
 
@@ -1,4 +1,3 @@
-from gimpfu import *
 import numpy
 
 # interp2-like function from matlab
@@ -6,15 +5,14 @@ def interp2(X,Y,Z):
     """! interpolates Z at locations X,Y
     output of function is of shape(X)==shape(Y)
     """
-    from numpy import *
-    X1 = array(floor(X),dtype=int);
-    X2 = array(ceil(X),dtype=int);
-    Y1 = array(floor(Y),dtype=int);
-    Y2 = array(ceil(Y),dtype=int);
+    X1 = numpy.array(numpy.floor(X),dtype=int);
+    X2 = numpy.array(numpy.ceil(X),dtype=int);
+    Y1 = numpy.array(numpy.floor(Y),dtype=int);
+    Y2 = numpy.array(numpy.ceil(Y),dtype=int);
 
-    M1 = logical_or(logical_or(Y1<0,Y1>=Z.shape[0]),logical_or(Y2<0,Y2>=Z.shape[0]))
-    M2 = logical_or(logical_or(X1<0,X1>=Z.shape[1]),logical_or(X2<0,X2>=Z.shape[1]))
-    M = logical_not(logical_or(M1,M2));
+    M1 = numpy.logical_or(numpy.logical_or(Y1<0,Y1>=Z.shape[0]),numpy.logical_or(Y2<0,Y2>=Z.shape[0]))
+    M2 = numpy.logical_or(numpy.logical_or(X1<0,X1>=Z.shape[1]),numpy.logical_or(X2<0,X2>=Z.shape[1]))
+    M = numpy.logical_not(numpy.logical_or(M1,M2));
 
     X1[X1<0]=0;
     X1[X1>=Z.shape[1]]=Z.shape[1]-1;
@@ -31,8 +29,129 @@ def interp2(X,Y,Z):
     ERG  = ERG1+(ERG2-ERG1)*YR;
     return ERG,M;
 
+def overlap(w, d, cols=None):
+    """! Determines the columns of an image shifted by an integer disparity.
+    @param w the image width
+    @param d the disparity (shift to the right)
+    @param cols optional slice of the source columns to be considered (e.g. the bounding box of the layer)
+    @return a tuple (destination slice, source slice) of the overlapping columns, or None if nothing overlaps
+    """
+    lo = max(0,-d)
+    hi = min(w,w-d)
+    if cols is not None:
+        lo = max(lo,cols.start)
+        hi = min(hi,cols.stop)
+    if lo>=hi:
+        return None
+    return slice(lo+d,hi+d), slice(lo,hi)
+
+def alpha_bbox(alpha):
+    """! Determines the bounding box of the visible part of a layer.
+    @param alpha the alpha channel of the layer (height x width)
+    @return a tuple (row slice, column slice) of the bounding box of alpha>0, or None if the layer is fully transparent
+    """
+    rows = numpy.flatnonzero(alpha.any(axis=1))
+    if len(rows)==0:
+        return None
+    rows = slice(rows[0],rows[-1]+1)
+    cols = numpy.flatnonzero(alpha[rows].any(axis=0))
+    return rows, slice(cols[0],cols[-1]+1)
+
+def ext_window(w, d, cols):
+    """! Determines the columns of the output affected by a layer shifted with a depth map (both views).
+    @param w the image width
+    @param d the disparity map (of the rows to be considered)
+    @param cols the slice of the source columns to be considered (the bounding box of the layer)
+    @return a slice of the output columns, or None if no column is affected
+    """
+    dmin = int(numpy.floor(d.min()))
+    dmax = int(numpy.ceil(d.max()))
+    # left view: sampled at x+d, right view: sampled at x-d (interpolation: one more column)
+    lo = max(0, min(cols.start-1-dmax, cols.start-1+dmin))
+    hi = min(w, max(cols.stop-dmin, cols.stop+dmax))
+    if lo>=hi:
+        return None
+    return slice(lo,hi)
+
+def layer_channels(layer_data):
+    """! Splits layer data into its gray and alpha channel.
+    @param layer_data the layer (height x width x channels)
+    @return the gray and alpha channel (views); a single channel is the alpha channel of a white layer.
+    """
+    if layer_data.shape[2]==1:
+        a = layer_data[:,:,0]
+        return numpy.broadcast_to(numpy.array(255, dtype=a.dtype), a.shape), a
+    return layer_data[:,:,0], layer_data[:,:,1]
+
+class RowSampling:
+    """! The sampling positions of a horizontal-only resampling: row y of the
+    result is sampled at the positions x-d[y,x] of row y of the input (linear interpolation,
+    samples outside the image are 0). This is the same as interp2 with Y being the row grid,
+    but only the rows are accessed (a single gather per sample). The positions are computed once
+    and can be reused for all channels of a layer (see row_samplings).
+    """
+    def __init__(self, x1, frac, w=None):
+        """! Creates a sampling.
+        @param x1 the integer part of the sampling positions (height x width)
+        @param frac the fractional part of the sampling positions (height x width; None or all 0 = integer positions)
+        @param w the width of the input (default: width of x1)
+        """
+        h = x1.shape[0]
+        if w is None:
+            w = x1.shape[1]
+        if frac is not None and not frac.any():
+            frac = None
+        x2 = x1 if frac is None else x1+(frac>0)
+        self.valid = numpy.logical_and(x1>=0, x2<w)
+        offsets = (numpy.arange(h)*w)[:,None]
+        self.index1 = numpy.clip(x1,0,w-1)+offsets
+        self.index2 = None if frac is None else numpy.clip(x2,0,w-1)+offsets
+        self.frac = frac
+
+    def resample(self, img, out=None):
+        """! Resamples an image.
+        @param img the image (height x width or height x width x channels)
+        @param out optional output buffer of the type of img and the shape of the sampling (only for integer positions)
+        @return the resampled image
+        """
+        h, w = img.shape[0], img.shape[1]
+        flat = numpy.reshape(img, (h*w,)+img.shape[2:])
+        valid = self.valid if img.ndim==2 else self.valid[:,:,None]
+        res = numpy.take(flat, self.index1, axis=0, out=out)
+        if self.frac is not None:
+            frac = self.frac if img.ndim==2 else self.frac[:,:,None]
+            res = numpy.asarray(res, dtype=self.frac.dtype)
+            res = res+(numpy.take(flat, self.index2, axis=0)-res)*frac
+        res *= valid
+        return res
+
+def row_samplings(d, cols=None, w=None):
+    """! Computes the samplings of both views for a disparity map. The integer and
+    fractional part of the disparity is computed once for both views.
+    @param d the disparity map (height x width)
+    @param cols optional slice of the output columns d belongs to (default: all columns)
+    @param w the width of the input (default: width of d)
+    @return a tuple of RowSampling objects (left, right), i.e., the shift by -d and by +d (see Anaglyph.shiftx_ext)
+    """
+    fd = numpy.floor(d)
+    fr = d-fd
+    fd = numpy.array(fd, dtype=int)
+    x0 = 0 if cols is None else cols.start
+    x = numpy.arange(x0, x0+d.shape[1])
+    left = RowSampling(x+fd, fr, w)
+    nonzero = fr>0
+    right = RowSampling(x-fd-nonzero, numpy.where(nonzero, 1-fr, 0), w)
+    return left, right
+
 class Anaglyph:
     """! This class represents an algorithm to compute two stereo images from gimp layers and to combine them to an anaglyph. """
+    ## the type of the layer data expected by update/update_ext (see gimpfu_numpy_converter.layer2array)
+    layer_dtype = numpy.float64
+    ## the order in which the layers are added: False = bottom layer first (back to front)
+    front_to_back = False
+    ## the number of color channels of the left and right image (1 = gray level images)
+    channels = 1
+
     def __init__(self, f1=1.0, f2=1.0):
         """! Creates an anaglyph algorithm.
         @param f1 the darkening factor for the left image (1.0 = no modification)
@@ -56,14 +175,8 @@ class Anaglyph:
         return res
 
     def shiftx_ext(self,img,d):
-        """! Helper function to shift an image with a given disparity map. """
-        w = d.shape[1]
-        h = d.shape[0]
-        x,y = numpy.meshgrid(numpy.arange(w),numpy.arange(h))
-        x = x-d
-        res,m = interp2(x,y,img);
-        return res*m
-        
+        """! Helper function to shift an image with a given disparity map (see RowSampling). """
+        return row_samplings(d)[1].resample(numpy.asarray(img, dtype=numpy.float64))
 
     def update(self, layer_data, d):
         """! Update the image using a single depth value
@@ -76,23 +189,33 @@ class Anaglyph:
             tmp = numpy.ones((h,w,2))*255.0
             tmp[:,:,1]=numpy.reshape(layer_data,(h,w))
             layer_data=tmp
-        if self.left==None:
+        if self.left is None:
             self.left  = numpy.zeros((h,w))
             self.right = numpy.zeros((h,w))
             self.aleft  = numpy.zeros((h,w))
             self.aright = numpy.zeros((h,w))
         else:
-            assert(self.left.shape == (h,w), "shape must not change")
-            
-        imleft  = self.shiftx(layer_data[:,:,0],-d)
-        imright = self.shiftx(layer_data[:,:,0],+d)
-        alphaleft  = self.shiftx(layer_data[:,:,1],-d)
-        alpharight = self.shiftx(layer_data[:,:,1],+d)
-   
-        self.left  = (self.left *(255-alphaleft )+imleft *alphaleft )/255
-        self.right = (self.right*(255-alpharight)+imright*alpharight)/255
-        self.aleft  = numpy.maximum(alphaleft,  self.aleft)
-        self.aright = numpy.maximum(alpharight, self.aright)
+            assert self.left.shape == (h,w), "shape must not change"
+
+        # only the bounding box of the visible part of the layer is processed
+        box = alpha_bbox(layer_data[:,:,1])
+        if box is None:
+            return
+        rows, cols = box
+
+        # the shifted layer is blended through slice views: only the overlapping
+        # columns are touched (the shifted alpha is 0 elsewhere), gray and alpha
+        # are taken from the same view of the layer
+        for acc, aacc, s in ((self.left, self.aleft, -d), (self.right, self.aright, +d)):
+            c = overlap(w, int(s), cols)
+            if c is None:
+                continue
+            dst, src = c
+            px = layer_data[rows,src,:]
+            im = px[:,:,0]
+            alpha = px[:,:,1]
+            acc[rows,dst]  = (acc[rows,dst]*(255-alpha)+im*alpha)/255
+            aacc[rows,dst] = numpy.maximum(alpha, aacc[rows,dst])
 
     def update_ext(self, layer_data, d):
         """! Update the image using a depth map
@@ -101,23 +224,44 @@ class Anaglyph:
         """
         h = layer_data.shape[0]
         w = layer_data.shape[1]
-        if self.left==None:
+        if self.left is None:
             self.left  = numpy.zeros((h,w))
             self.right = numpy.zeros((h,w))
             self.aleft  = numpy.zeros((h,w))
             self.aright = numpy.zeros((h,w))
         else:
-            assert(self.left.shape == (h,w), "shape must not change")
-            
-        imleft  = self.shiftx_ext(layer_data[:,:,0],-d)
-        imright = self.shiftx_ext(layer_data[:,:,0],+d)
-        alphaleft  = self.shiftx_ext(layer_data[:,:,1],-d)
-        alpharight = self.shiftx_ext(layer_data[:,:,1],+d)
-   
-        self.left  = (self.left *(255-alphaleft )+imleft *alphaleft )/255
-        self.right = (self.right*(255-alpharight)+imright*alpharight)/255
-        self.aleft  = numpy.maximum(alphaleft,  self.aleft)
-        self.aright = numpy.maximum(alpharight, self.aright)
+            assert self.left.shape == (h,w), "shape must not change"
+
+        # only the bounding box of the visible part of the layer is processed,
+        # widened by the disparity range
+        box = alpha_bbox(layer_data[:,:,1])
+        if box is None:
+            return
+        rows, cols = box
+        win = ext_window(w, d[rows], cols)
+        if win is None:
+            return
+
+        # the sampling positions are computed once for both views, gray and alpha are resampled together
+        left, right = row_samplings(d[rows,win], win, w)
+        src = layer_data[rows]
+        pxleft  = left.resample(src)
+        pxright = right.resample(src)
+        imleft,  alphaleft  = pxleft[:,:,0],  pxleft[:,:,1]
+        imright, alpharight = pxright[:,:,0], pxright[:,:,1]
+
+        self.left[rows,win]  = (self.left[rows,win] *(255-alphaleft )+imleft *alphaleft )/255
+        self.right[rows,win] = (self.right[rows,win]*(255-alpharight)+imright*alpharight)/255
+        self.aleft[rows,win]  = numpy.maximum(alphaleft,  self.aleft[rows,win])
+        self.aright[rows,win] = numpy.maximum(alpharight, self.aright[rows,win])
+
+    def covered(self):
+        """! @return true if the layers not yet added cannot change the result anymore (only for front to back variants) """
+        return False
+
+    def finish(self):
+        """! Called by the renderer after the last layer was added, before the result is read (nothing to do for Anaglyph). """
+        pass
 
     def get_result(self,swap_lr):
         """! Combines the result collected so far (left and right image) as anaglyph. 
@@ -136,3 +280,169 @@ class Anaglyph:
         a[:,:,2] = r*self.f2 + (1-self.f2)/2
         a[:,:,3] = numpy.maximum(self.aleft,self.aright)
         return a
+
+    def write_result(self, out, swap_lr):
+        """! Writes the anaglyph into an uint8 RGBA window, same values as get_result but without its float RGBA temporary.
+        @param out the output (height x width x 4, uint8), e.g. rows of a larger image (see stereo_output.write_outputs)
+        @param swap_lr if true the left and right image are swapped.
+        """
+        l, r = (self.right, self.left) if swap_lr else (self.left, self.right)
+        out[:,:,0] = l*self.f1 + (1-self.f1)/2
+        cyan = r*self.f2 + (1-self.f2)/2
+        out[:,:,1] = cyan
+        out[:,:,2] = cyan
+        out[:,:,3] = numpy.maximum(self.aleft, self.aright)
+
+def _window(buf, shape):
+    """! @return a contiguous window of the given shape at the start of a preallocated buffer (a view) """
+    return numpy.reshape(buf.reshape(-1)[:shape[0]*shape[1]], shape)
+
+class CompactAnaglyph(Anaglyph):
+    """! A memory saving variant of the Anaglyph algorithm.
+    The left/right images and alpha channels are stored as float32 and all buffers are
+    allocated once: a layer with a single depth value is blended in place (numpy out= operations)
+    through slice views of the overlapping columns, i.e., it costs no new full size arrays.
+    A layer with a depth map is resampled in place as well: the sampling positions, weights and
+    gathered values are computed into buffers allocated once per canvas (see _sample).
+    As in Anaglyph, only the bounding box of the visible part of a layer is processed.
+    The layer data can be passed as uint8 (no conversion copy needed).
+    The result differs from Anaglyph only by float32 rounding errors.
+    """
+    ## the type of the layer data expected by update/update_ext (None = as stored in the layer, uint8)
+    layer_dtype = None
+
+    def _init_buffers(self, h, w):
+        """! Allocates the buffers (on first use). """
+        if self.left is None:
+            self.left  = numpy.zeros((h,w), dtype=numpy.float32)
+            self.right = numpy.zeros((h,w), dtype=numpy.float32)
+            self.aleft  = numpy.zeros((h,w), dtype=numpy.float32)
+            self.aright = numpy.zeros((h,w), dtype=numpy.float32)
+            self._tmp = numpy.empty((h,w), dtype=numpy.float32)
+            # the buffers of update_ext (see _sample); _raw holds the gathered layer values (type of the layer data)
+            self._floor = numpy.empty((h,w), dtype=numpy.float32)
+            self._frac  = numpy.empty((h,w), dtype=numpy.float32)
+            self._pos1  = numpy.empty((h,w), dtype=numpy.intp)
+            self._pos2  = numpy.empty((h,w), dtype=numpy.intp)
+            self._step  = numpy.empty((h,w), dtype=bool)
+            self._valid = numpy.empty((h,w), dtype=bool)
+            self._mask  = numpy.empty((h,w), dtype=bool)
+            self._gray  = numpy.empty((h,w), dtype=numpy.float32)
+            self._alpha = numpy.empty((h,w), dtype=numpy.float32)
+            self._raw   = None
+        else:
+            assert self.left.shape == (h,w), "shape must not change"
+
+    def _blend(self, acc, aacc, im, a):
+        """! In place: acc = (acc*(255-a)+im*a)/255 and aacc = max(aacc,a) (acc, aacc may be views). """
+        tmp = self._tmp[:acc.shape[0],:acc.shape[1]]
+        numpy.subtract(im, acc, out=tmp)
+        tmp *= a
+        tmp /= 255
+        acc += tmp
+        numpy.maximum(aacc, a, out=aacc)
+
+    def update(self, layer_data, d):
+        """! Update the image using a single depth value
+        @param layer_data the layer to be added (as numpy array)
+        @param d the disparity of the layer
+        """
+        d = int(d)
+        self._init_buffers(layer_data.shape[0], layer_data.shape[1])
+        gray, alpha = layer_channels(layer_data)
+        box = alpha_bbox(alpha)
+        if box is None:
+            return
+        rows, cols = box
+        for acc, aacc, s in ((self.left, self.aleft, -d), (self.right, self.aright, +d)):
+            c = overlap(gray.shape[1], s, cols)
+            if c is None:
+                continue
+            dst, src = c
+            self._blend(acc[rows,dst], aacc[rows,dst], gray[rows,src], alpha[rows,src])
+
+    def update_ext(self, layer_data, d):
+        """! Update the image using a depth map
+        @param layer_data the layer to be added (as numpy array)
+        @param d the disparity map of the layer
+        """
+        h, w = layer_data.shape[0], layer_data.shape[1]
+        self._init_buffers(h, w)
+        box = alpha_bbox(layer_channels(layer_data)[1])
+        if box is None:
+            return
+        rows, cols = box
+        win = ext_window(w, d[rows], cols)
+        if win is None:
+            return
+        shape = (rows.stop-rows.start, win.stop-win.start)
+        dw = d[rows,win]
+        floor = _window(self._floor, shape)
+        frac = _window(self._frac, shape)
+        step = _window(self._step, shape)
+        numpy.floor(dw, out=floor)
+        numpy.subtract(dw, floor, out=frac)
+        numpy.greater(frac, 0, out=step)
+        fractional = step.any()
+        flat = numpy.ascontiguousarray(layer_data[rows]).reshape(-1)
+        if self._raw is None or self._raw.dtype != flat.dtype:
+            self._raw = numpy.empty((2, h*w), dtype=flat.dtype)
+        x = numpy.arange(win.start, win.stop)
+        # the same sampling as row_samplings: the left view is sampled at x+floor(d) (weight frac of the next
+        # column), the right view at x-floor(d)-step (weight 1-frac of the next column if frac>0)
+        for acc, aacc, view in ((self.left, self.aleft, 0), (self.right, self.aright, 1)):
+            pos = _window(self._pos1, shape)
+            numpy.copyto(pos, floor, casting="unsafe")
+            if view == 0:
+                pos += x
+            else:
+                numpy.subtract(x, pos, out=pos)
+                pos -= step
+                numpy.subtract(1, frac, out=frac)
+                frac *= step
+            gray, alpha = self._sample(flat, layer_data.shape[2], w, shape, frac if fractional else None)
+            self._blend(acc[rows,win], aacc[rows,win], gray, alpha)
+
+    def _sample(self, flat, channels, w, shape, frac):
+        """! Resamples the rows of a layer at the positions in _pos1 (window of the buffers of the given shape), in place.
+        Samples outside of the layer are transparent, as in RowSampling.resample.
+        @param flat the rows of the layer (flattened, rows x w x channels)
+        @param channels the number of channels of the layer (1 = alpha only)
+        @param w the width of the layer
+        @param shape the shape of the window (rows, columns)
+        @param frac the weights of the next column (window of _frac) or None for integer positions
+        @return the gray and alpha channel (windows of _gray and _alpha, float32)
+        """
+        n = shape[0]*shape[1]
+        pos1 = _window(self._pos1, shape)
+        pos2 = pos1
+        if frac is not None:
+            pos2 = _window(self._pos2, shape)
+            numpy.add(pos1, _window(self._step, shape), out=pos2)
+        valid = _window(self._valid, shape)
+        mask = _window(self._mask, shape)
+        numpy.greater_equal(pos1, 0, out=valid)
+        numpy.less(pos2, w, out=mask)
+        valid &= mask
+        offsets = (numpy.arange(shape[0])*w)[:,None]
+        for pos in ((pos1,) if frac is None else (pos1, pos2)):
+            numpy.clip(pos, 0, w-1, out=pos)
+            pos += offsets
+            pos *= channels
+        gray = _window(self._gray, shape)
+        alpha = _window(self._alpha, shape)
+        raw = numpy.reshape(self._raw[0,:n], shape)
+        sources = ((alpha, flat),) if channels == 1 else ((gray, flat), (alpha, flat[1:]))
+        if channels == 1:
+            gray.fill(255)
+        for buf, src in sources:
+            numpy.take(src, pos1, out=raw, mode="clip")
+            buf[...] = raw
+            if frac is not None:
+                tmp = _window(self._tmp, shape)
+                numpy.take(src, pos2, out=raw, mode="clip")
+                numpy.subtract(raw, buf, out=tmp)
+                tmp *= frac
+                buf += tmp
+            buf *= valid
+        return gray, alpha
@@ -0,0 +1,323 @@
+import threading
+import itertools
+import collections
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from multiprocessing.pool import ThreadPool
+import numpy
+from gimpfu_numpy_converter import layer2array, layer_rows2array, convert_array
+from anaglyph_algorithm import Anaglyph
+from depth_algorithm import DepthAlgo
+from profiler import NULL_PROFILER
+from stereo_output import ANAGLYPH, allocate_outputs, write_outputs
+
+## default height of the bands processed by render_bands (rows)
+DEFAULT_BAND_HEIGHT = 256
+
+## default number of layers loaded ahead of the compositing by a background thread (see _prefetch)
+DEFAULT_PREFETCH = 2
+
+def _bounded_imap(pool, func, items, size):
+    """! Like pool.imap, but at most size items are submitted to the pool and not yet consumed: the next item is
+    submitted when a result is taken, so the results cannot pile up if the consumer is slower than the pool.
+    @param pool the pool (multiprocessing.pool.ThreadPool)
+    @param func the function called with each item
+    @param items the items
+    @param size the max. number of items in flight
+    @return generator of the results of func, in the order of the items
+    """
+    items = iter(items)
+    pending = collections.deque(pool.apply_async(func, (item,)) for item in itertools.islice(items, size))
+    while pending:
+        result = pending.popleft().get()
+        for item in itertools.islice(items, 1):
+            pending.append(pool.apply_async(func, (item,)))
+        yield result
+
+## serializes the pixel transfer (gimp must not be called from several threads at once)
+_transfer_lock = threading.Lock()
+
+class _BufferRing:
+    """! Buffers for the converted layer data (see gimpfu_numpy_converter.convert_array), reused round robin
+    (one ring per shape). A buffer is overwritten after size further layers of the same shape were converted.
+    """
+    def __init__(self, dtype, size=1):
+        """! Creates the (empty) rings.
+        @param dtype the type expected by the algorithm (None = no conversion)
+        @param size the number of buffers per shape (the number of converted layers in use at the same time)
+        """
+        self.dtype = dtype
+        self.size = size
+        self.rings = {}
+
+    def convert(self, raw):
+        """! @return the layer data raw (as read, uint8) converted to dtype """
+        if self.dtype is None:
+            return raw
+        ring = self.rings.setdefault(raw.shape, [])
+        if len(ring) < self.size:
+            buf = numpy.empty(raw.shape, dtype=self.dtype)
+        else:
+            buf = ring.pop(0)
+        ring.append(buf)
+        return convert_array(raw, self.dtype, buf)
+
+def _prefetch(items, load, depth=DEFAULT_PREFETCH):
+    """! Loads items ahead of their use on a background thread (producer/consumer pipeline).
+    At most depth loaded items wait in a bounded queue. If the consumer stops early (closes the
+    generator), the background thread is stopped. Exceptions of load are raised in the consumer.
+    @param items the items to be loaded
+    @param load function loading an item
+    @param depth the size of the queue (0 = no background thread, items are loaded when needed)
+    @return generator of (item, load(item)) in the order of items
+    """
+    if depth <= 0:
+        for item in items:
+            yield item, load(item)
+        return
+    loaded = queue.Queue(depth)
+    stop = threading.Event()
+    def put(x):
+        while not stop.is_set():
+            try:
+                loaded.put(x, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def produce():
+        try:
+            for item in items:
+                if not put((item, load(item), None)):
+                    return
+        except Exception as e:
+            put((None, None, e))
+            return
+        put(None)
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            x = loaded.get()
+            if x is None:
+                break
+            item, data, error = x
+            if error is not None:
+                raise error
+            yield item, data
+    finally:
+        stop.set()
+        thread.join()
+
+def render(image, mindisp, maxdisp, f1=1.0, f2=1.0, progress=None, verbose=False, algorithm=Anaglyph, prefetch=DEFAULT_PREFETCH, profiler=NULL_PROFILER):
+    """! Combines the layers of an image to a stereo image pair (the core loop of the plugin).
+    This function does not depend on gimp: image may be a gimp image or a
+    layer_stack.ArrayImage.
+    @param image the image to be processed (layers, top most layer first)
+    @param mindisp the minimum disparity (percent of the image width, near)
+    @param maxdisp the maximum disparity (percent of the image width, far)
+    @param f1 the darkening factor for the left image (1.0 = no modification)
+    @param f2 the darkening factor for the right image (1.0 = no modification)
+    @param progress optional function called with the progress (0..1) after each layer
+    @param verbose if true the layer names and depths are printed
+    @param algorithm the algorithm class (Anaglyph or a variant like CompactAnaglyph)
+    @param prefetch the number of layers read and converted ahead by a background thread (0 = no background thread)
+    @param profiler records the stages (see profiler.Profiler; default: nothing is recorded)
+    @return the Anaglyph object holding the left and right image (see Anaglyph.get_result)
+    """
+    anaglyph = algorithm(f1,f2)
+    with profiler.stage("parse"):
+        depthalgo = DepthAlgo(image, mindisp, maxdisp, _transfer_lock)
+
+    buffers = _BufferRing(algorithm.layer_dtype, prefetch+2)
+    def load(entry):
+        # convert layer data to numpy array and determine depth
+        name = entry.layer.name
+        with _transfer_lock:
+            with profiler.stage("read", name):
+                raw = layer2array(entry.layer)
+        with profiler.stage("convert", name):
+            mf = buffers.convert(raw)
+        with profiler.stage("disparity", name):
+            d = depthalgo.disparity(entry)
+        return mf, d
+
+    n=1
+    nmax=len(depthalgo.plan)
+    layers = _prefetch(depthalgo.layers(algorithm.front_to_back), load, prefetch)
+    for entry, (mf, d) in layers:
+        if anaglyph.covered():
+            layers.close()
+            break
+        layer = entry.layer
+        if verbose:
+            print(layer.name)
+
+        # update algo and progress bar
+        if entry.has_map():
+            if verbose:
+                print("%s --> special"%(layer.name))
+            with profiler.stage("update_ext", layer.name):
+                anaglyph.update_ext(mf,d)
+        else:
+            if verbose:
+                print("%s --> %f"%(layer.name,d))
+            with profiler.stage("update", layer.name):
+                anaglyph.update(mf,d)
+        depthalgo.release(entry)
+
+        if progress is not None:
+            progress(float(n)/float(nmax))
+        n=n+1
+    depthalgo.close()
+    anaglyph.finish()
+    return anaglyph
+
+def render_bands(image, mindisp, maxdisp, f1, f2, swap_lr, write_band, band_height=DEFAULT_BAND_HEIGHT, progress=None, verbose=False, threads=1, algorithm=Anaglyph, prefetch=DEFAULT_PREFETCH, profiler=NULL_PROFILER, finish_band=None):
+    """! Combines the layers of an image to an anaglyph, band by band (streaming mode).
+    All operations of the algorithm are horizontal (the disparity only shifts along the rows).
+    Thus, the image can be processed in bands of rows: each band is read from every layer,
+    combined and written to the output before the next band is processed. The peak memory is
+    proportional to the band height instead of the image size. The result is identical to render.
+
+    Since the bands are independent, they can be combined concurrently by a pool of threads
+    (numpy releases the GIL for large operations). At most threads bands are combined or finished and
+    waiting to be written at a time (see _bounded_imap), i.e., a slow write_band does not let them pile up. Reading the layers (and the depth maps), write_band and
+    progress are never called concurrently (the conversion of the layer data is done outside of this lock),
+    and the bands are written in order. Within a band, the next layers are read on a background thread
+    while the current layer is combined (see _prefetch).
+    @param image the image to be processed (layers, top most layer first)
+    @param mindisp the minimum disparity (percent of the image width, near)
+    @param maxdisp the maximum disparity (percent of the image width, far)
+    @param f1 the darkening factor for the left image (1.0 = no modification)
+    @param f2 the darkening factor for the right image (1.0 = no modification)
+    @param swap_lr if true the left and right image are swapped.
+    @param write_band function called with (y, band) for each band; band is the RGBA result (uint8, see Anaglyph.write_result) of the rows y..y+band.shape[0]-1
+    @param band_height the number of rows per band
+    @param progress optional function called with the progress (0..1) after each band
+    @param verbose if true the layer names and depths are printed
+    @param threads the number of threads combining bands concurrently
+    @param algorithm the algorithm class (Anaglyph or a variant like CompactAnaglyph)
+    @param prefetch the number of layers of a band read and converted ahead by a background thread (0 = no background thread)
+    @param profiler records the stages (see profiler.Profiler; default: nothing is recorded)
+    @param finish_band optional function called with (y, anaglyph) for each band (in the thread combining the band); its
+           return value is passed to write_band instead of the RGBA result (e.g. to write other formats, see render_outputs)
+    """
+    if finish_band is None:
+        def finish_band(y, anaglyph):
+            band = numpy.empty((anaglyph.left.shape[0], anaglyph.left.shape[1], 4), dtype=numpy.uint8)
+            anaglyph.write_result(band, swap_lr)
+            return band
+    with profiler.stage("parse"):
+        depthalgo = DepthAlgo(image, mindisp, maxdisp, _transfer_lock)
+    layers = depthalgo.layers(algorithm.front_to_back)
+    if verbose:
+        for entry in layers:
+            if entry.has_map():
+                print("%s --> special"%(entry.layer.name))
+            else:
+                print("%s --> %f"%(entry.layer.name,entry.disparity))
+
+    def composite_band(y):
+        h = min(band_height, image.height-y)
+        anaglyph = algorithm(f1,f2)
+        buffers = _BufferRing(algorithm.layer_dtype, prefetch+2)
+        rows = slice(y,y+h)
+        def load(entry):
+            name = entry.layer.name
+            with _transfer_lock:
+                with profiler.stage("read", name):
+                    raw = layer_rows2array(entry.layer, y, h)
+            with profiler.stage("convert", name):
+                mf = buffers.convert(raw)
+            with profiler.stage("disparity", name):
+                d = depthalgo.disparity(entry, rows)
+            return mf, d
+        band_layers = _prefetch(layers, load, prefetch)
+        for entry, (mf, d) in band_layers:
+            if anaglyph.covered():
+                band_layers.close()
+                break
+            if entry.has_map():
+                with profiler.stage("update_ext", entry.layer.name):
+                    anaglyph.update_ext(mf, d)
+            else:
+                with profiler.stage("update", entry.layer.name):
+                    anaglyph.update(mf, d)
+        with profiler.stage("get_result"):
+            anaglyph.finish()
+            return y, h, finish_band(y, anaglyph)
+
+    bands = range(0, image.height, band_height)
+    pool = None
+    if threads > 1:
+        pool = ThreadPool(threads)
+        results = _bounded_imap(pool, composite_band, bands, threads)
+    else:
+        results = (composite_band(y) for y in bands)
+    try:
+        for y, h, band in results:
+            with _transfer_lock:
+                with profiler.stage("write"):
+                    write_band(y, band)
+                if progress is not None:
+                    progress(float(y+h)/float(image.height))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        depthalgo.close()
+
+def render_outputs(image, mindisp, maxdisp, f1=1.0, f2=1.0, swap_lr=False, formats=(ANAGLYPH,), outputs=None, band_height=DEFAULT_BAND_HEIGHT, progress=None, threads=1, algorithm=Anaglyph, prefetch=DEFAULT_PREFETCH, profiler=NULL_PROFILER):
+    """! Renders the left and right image once, band by band (see render_bands), and writes any number of output
+    formats (anaglyph, side by side, over/under, interleaved, left, right; see stereo_output) into uint8 buffers.
+    @param image the image to be processed (layers, top most layer first)
+    @param mindisp the minimum disparity (percent of the image width, near)
+    @param maxdisp the maximum disparity (percent of the image width, far)
+    @param f1 the darkening factor for the left image of the anaglyph (1.0 = no modification)
+    @param f2 the darkening factor for the right image of the anaglyph (1.0 = no modification)
+    @param swap_lr if true the left and right image are swapped.
+    @param formats the requested output formats (see stereo_output.FORMATS), used if outputs is None
+    @param outputs optional dict format -> output buffer (uint8, see stereo_output.output_shape with the channels of the algorithm), e.g. numpy.memmap objects
+    @param band_height the number of rows per band
+    @param progress optional function called with the progress (0..1) after each band
+    @param threads the number of threads combining bands concurrently
+    @param algorithm the algorithm class (Anaglyph or a variant like CompactAnaglyph)
+    @param prefetch the number of layers read ahead by a background thread (see render_bands)
+    @param profiler records the stages (see profiler.Profiler; default: nothing is recorded)
+    @return dict format -> output (uint8)
+    """
+    if outputs is None:
+        outputs = allocate_outputs(formats, image.height, image.width, algorithm.channels)
+    def finish_band(y, anaglyph):
+        # the bands are disjoint: written directly by the threads combining them
+        write_outputs(anaglyph, outputs, y, swap_lr)
+    def write_band(y, band):
+        pass
+    render_bands(image, mindisp, maxdisp, f1, f2, swap_lr, write_band, band_height, progress, threads=threads, algorithm=algorithm,
+                 prefetch=prefetch, profiler=profiler, finish_band=finish_band)
+    return outputs
+
+def render_to_array(image, mindisp, maxdisp, f1=1.0, f2=1.0, swap_lr=False, out=None, band_height=DEFAULT_BAND_HEIGHT, progress=None, threads=1, algorithm=Anaglyph, prefetch=DEFAULT_PREFETCH, profiler=NULL_PROFILER):
+    """! Renders an anaglyph band by band (see render_outputs) into an uint8 array.
+    @param image the image to be processed (layers, top most layer first)
+    @param mindisp the minimum disparity (percent of the image width, near)
+    @param maxdisp the maximum disparity (percent of the image width, far)
+    @param f1 the darkening factor for the left image (1.0 = no modification)
+    @param f2 the darkening factor for the right image (1.0 = no modification)
+    @param swap_lr if true the left and right image are swapped.
+    @param out optional output array (height x width x 4, uint8), e.g. a numpy.memmap
+    @param band_height the number of rows per band
+    @param progress optional function called with the progress (0..1) after each band
+    @param threads the number of threads combining bands concurrently
+    @param algorithm the algorithm class (Anaglyph or a variant like CompactAnaglyph)
+    @param prefetch the number of layers read ahead by a background thread (see render_bands)
+    @param profiler records the stages (see profiler.Profiler; default: nothing is recorded)
+    @return the RGBA result (uint8)
+    """
+    outputs = None if out is None else {ANAGLYPH: out}
+    return render_outputs(image, mindisp, maxdisp, f1, f2, swap_lr, (ANAGLYPH,), outputs, band_height, progress,
+                          threads=threads, algorithm=algorithm, prefetch=prefetch, profiler=profiler)[ANAGLYPH]
@@ -0,0 +1,198 @@
+#! /usr/bin/env python
+"""! Headless batch renderer: creates anaglyphs from layer stacks stored on disk, without gimp.
+
+Usage:
+    python batch_anaglyph.py [options] <stack> [<stack> ...]
+
+A stack is a directory of PNG/.npy files, a multi-page TIFF file or a .npz file
+(see layer_stack.load_stack). The layer naming rules are the same as in the gimp plugin.
+The stacks are rendered in parallel by a pool of worker processes. Each stack is
+rendered in bands of rows (see anaglyph_renderer.render_bands); with .npy layers and
+.npy output the memory needed does not depend on the image height.
+"""
+import os
+import sys
+import argparse
+import multiprocessing
+import numpy
+from layer_stack import load_stack, save_array
+from anaglyph_algorithm import Anaglyph, CompactAnaglyph
+from forward_warp import ForwardWarpAnaglyph
+from front_to_back import FrontToBackAnaglyph
+from color_anaglyph import MATRICES, color_algorithm
+from anaglyph_renderer import render_outputs, DEFAULT_BAND_HEIGHT, DEFAULT_PREFETCH
+from stereo_output import ANAGLYPH, FORMATS, output_shape, write_outputs
+from render_cache import render_cached
+from profiler import Profiler, NULL_PROFILER
+from render_client import submit, wait
+
+## the algorithms selectable with --algorithm
+ALGORITHMS = {
+    "anaglyph": Anaglyph,
+    "compact": CompactAnaglyph,
+    "forward": ForwardWarpAnaglyph,
+    "front_to_back": FrontToBackAnaglyph,
+}
+
+## the default parameters of a job (see render_file)
+DEFAULT_PARAMS = dict(mindisp=0.0, maxdisp=2.0, f1=1.0, f2=0.8, swap_lr=False, band_height=DEFAULT_BAND_HEIGHT, threads=1,
+                      algorithm="anaglyph", prefetch=DEFAULT_PREFETCH, profile=False, color=None)
+
+def output_path(stack, outdir, ext=".png", fmt=ANAGLYPH):
+    """! Determines the output file name for a stack.
+    @param stack the path of the layer stack
+    @param outdir the output directory (None = next to the stack)
+    @param ext the output file extension
+    @param fmt the output format (see stereo_output.FORMATS)
+    @return the output file name
+    """
+    base = os.path.normpath(stack)
+    if not os.path.isdir(base):
+        base = os.path.splitext(base)[0]
+    name = os.path.basename(base)+"_"+fmt+ext
+    if outdir is None:
+        return os.path.join(os.path.dirname(base), name)
+    return os.path.join(outdir, name)
+
+def job_algorithm(params):
+    """! @return the algorithm class of the job parameters (algorithm, color; see render_file) """
+    # color layers are rendered with the anaglyph matrices named by color (see color_anaglyph.MATRICES)
+    color = params["color"]
+    if color is None:
+        return ALGORITHMS[params["algorithm"]]
+    return color_algorithm(MATRICES[color])
+
+def render_stack(image, paths, params, profiler=NULL_PROFILER, cache=None):
+    """! Renders a loaded layer stack into one or several output files.
+    @param image the layer stack (layer_stack.ArrayImage)
+    @param paths list of (output format, output path); .npy outputs are written through a memory map
+    @param params the parameter dict (see render_file)
+    @param profiler records the stages (see profiler.Profiler; default: nothing is recorded)
+    @param cache optional render_cache.RenderCache: gray level stacks rendered with the algorithm "anaglyph" reuse its results
+    @return the output paths
+    """
+    algorithm = job_algorithm(params)
+    outputs = {}
+    for fmt, output in paths:
+        shape = output_shape(fmt, image.height, image.width, algorithm.channels)
+        if output.lower().endswith(".npy"):
+            outputs[fmt] = numpy.lib.format.open_memmap(output, mode="w+", dtype=numpy.uint8, shape=shape)
+        else:
+            outputs[fmt] = numpy.zeros(shape, dtype=numpy.uint8)
+    if cache is not None and algorithm is Anaglyph:
+        with profiler.stage("render_cached"):
+            anaglyph = render_cached(image, params["mindisp"], params["maxdisp"], params["f1"], params["f2"], cache)
+        with profiler.stage("get_result"):
+            write_outputs(anaglyph, outputs, 0, params["swap_lr"])
+    else:
+        render_outputs(image, params["mindisp"], params["maxdisp"], params["f1"], params["f2"], params["swap_lr"],
+                       outputs=outputs, band_height=params["band_height"], threads=params["threads"],
+                       algorithm=algorithm, prefetch=params["prefetch"], profiler=profiler)
+    with profiler.stage("save"):
+        for fmt, output in paths:
+            out = outputs[fmt]
+            if isinstance(out, numpy.memmap):
+                out.flush()
+            else:
+                save_array(out, output)
+    return [output for fmt, output in paths]
+
+def render_file(job):
+    """! Renders a single layer stack into one or several output formats (executed in a worker process).
+    @param job tuple (stack path, list of (output format, output path), parameter dict with mindisp, maxdisp, f1, f2, swap_lr, band_height, threads, algorithm, prefetch, profile, color)
+    @return the output paths
+    """
+    stack, paths, params = job
+    profiler = Profiler() if params["profile"] else NULL_PROFILER
+    with profiler.stage("load_stack"):
+        image = load_stack(stack, params["color"] is not None)
+    render_stack(image, paths, params, profiler)
+    if params["profile"]:
+        # report next to the (first) output (see profiler.Profiler)
+        profiler.close()
+        report = os.path.splitext(paths[0][1])[0]+"_profile"
+        profiler.to_json(report+".json")
+        profiler.to_csv(report+".csv")
+        print("%s:\n%s"%(stack, profiler.summary()))
+    return [output for fmt, output in paths]
+
+def render_files(stacks, outdir=None, processes=None, ext=".png", formats=(ANAGLYPH,), service=None, **params):
+    """! Renders several layer stacks in parallel (locally or by a render service).
+    @param stacks the paths of the layer stacks
+    @param outdir the output directory (None = next to the stacks)
+    @param processes the number of worker processes (None = number of cores)
+    @param ext the output file extension
+    @param formats the output formats (see stereo_output.FORMATS), all rendered in one pass
+    @param service optional address of a render service (see render_service.py): the stacks are submitted to it
+    @param params the algorithm parameters (mindisp, maxdisp, f1, f2, swap_lr, band_height, threads, algorithm, prefetch, profile, color)
+    @return generator of the output paths (in order of completion)
+    """
+    p = dict(DEFAULT_PARAMS)
+    p.update(params)
+    jobs = [(stack, [(fmt, output_path(stack, outdir, ext, fmt)) for fmt in formats], p) for stack in stacks]
+    if service is not None:
+        ids = [submit(stack, paths, job_params, service) for stack, paths, job_params in jobs]
+        for job_id in ids:
+            for output in wait(job_id, service)["outputs"]:
+                yield output
+        return
+    if processes == 1 or len(jobs) <= 1:
+        for job in jobs:
+            for output in render_file(job):
+                yield output
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for outputs in pool.imap_unordered(render_file, jobs):
+            for output in outputs:
+                yield output
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main(argv=None):
+    """! Command line entry point. """
+    parser = argparse.ArgumentParser(description="Create anaglyphs from layer stacks (without gimp).")
+    parser.add_argument("stacks", nargs="+", help="layer stacks (PNG directory, multi-page TIFF or .npz)")
+    parser.add_argument("-o", "--outdir", default=None, help="output directory (default: next to the input)")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="number of worker processes (default: number of cores)")
+    parser.add_argument("--format", default="png", help="output file format, e.g. png, tif or npy (default: png)")
+    parser.add_argument("--mindisp", type=float, default=0.0, help="min disparity, percent width (near)")
+    parser.add_argument("--maxdisp", type=float, default=2.0, help="max disparity, percent width (far)")
+    parser.add_argument("--left-factor", dest="f1", type=float, default=1.0, help="luminance correction left (0.0..1.0)")
+    parser.add_argument("--right-factor", dest="f2", type=float, default=0.8, help="luminance correction right (0.0..1.0)")
+    parser.add_argument("--swap-lr", action="store_true", help="swap left/right")
+    parser.add_argument("--outputs", default=ANAGLYPH,
+                        help="comma separated output formats, rendered in one pass: %s (default: %s)"%(", ".join(FORMATS), ANAGLYPH))
+    parser.add_argument("--band-height", type=int, default=DEFAULT_BAND_HEIGHT, help="rows processed at once (default: %d)"%(DEFAULT_BAND_HEIGHT))
+    parser.add_argument("-t", "--threads", type=int, default=1, help="threads per stack combining bands concurrently (default: 1)")
+    parser.add_argument("--prefetch", type=int, default=DEFAULT_PREFETCH,
+                        help="layers read ahead by a background thread while a layer is combined (0 = off, default: %d)"%(DEFAULT_PREFETCH))
+    parser.add_argument("--profile", action="store_true",
+                        help="record the time and memory of the stages (report <output>_profile.json/.csv, summary printed)")
+    parser.add_argument("--service", default=None, metavar="URL",
+                        help="submit the stacks to a render service (see render_service.py), e.g. http://127.0.0.1:8765")
+    parser.add_argument("--algorithm", choices=sorted(ALGORITHMS), default="anaglyph",
+                        help="anaglyph (default), compact (float32, less memory), forward (forward splatting, see forward_warp) "
+                             "or front_to_back (skips covered regions, see front_to_back)")
+    parser.add_argument("--color", choices=sorted(MATRICES), default=None,
+                        help="read the layers in color and render a color anaglyph with these matrices "
+                             "(dubois, color, half_color or gray; see color_anaglyph; --algorithm is ignored)")
+    args = parser.parse_args(argv)
+    formats = [fmt.strip() for fmt in args.outputs.split(",") if fmt.strip()]
+    for fmt in formats:
+        if fmt not in FORMATS:
+            parser.error("unknown output format: %s"%(fmt))
+    if args.outdir is not None and not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    for output in render_files(args.stacks, args.outdir, args.processes, "."+args.format, formats, args.service,
+                               mindisp=args.mindisp, maxdisp=args.maxdisp,
+                               f1=args.f1, f2=args.f2, swap_lr=args.swap_lr,
+                               band_height=args.band_height, threads=args.threads,
+                               algorithm=args.algorithm, prefetch=args.prefetch, profile=args.profile, color=args.color):
+        print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
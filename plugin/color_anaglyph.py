@@ -0,0 +1,177 @@
+import numpy
+from anaglyph_algorithm import Anaglyph, overlap, alpha_bbox, ext_window, row_samplings
+
+## red/cyan matrices (left, right) of the least squares method by E. Dubois (rows: output R,G,B; columns: input R,G,B)
+DUBOIS_RED_CYAN = (((0.456, 0.500, 0.176), (-0.040, -0.038, -0.016), (-0.015, -0.021, -0.005)),
+                   ((-0.043, -0.088, -0.002), (0.378, 0.734, -0.018), (-0.072, -0.113, 1.226)))
+## red/cyan matrices of a color anaglyph (red channel of the left view, green and blue channel of the right view)
+COLOR_RED_CYAN = (((1, 0, 0), (0, 0, 0), (0, 0, 0)),
+                  ((0, 0, 0), (0, 1, 0), (0, 0, 1)))
+## red/cyan matrices of a half color anaglyph (luminance of the left view, green and blue channel of the right view)
+HALF_COLOR_RED_CYAN = (((0.299, 0.587, 0.114), (0, 0, 0), (0, 0, 0)),
+                       ((0, 0, 0), (0, 1, 0), (0, 0, 1)))
+## red/cyan matrices of a gray anaglyph (luminance of both views, as Anaglyph.get_result for gray layers)
+GRAY_RED_CYAN = (((0.299, 0.587, 0.114), (0, 0, 0), (0, 0, 0)),
+                 ((0, 0, 0), (0.299, 0.587, 0.114), (0.299, 0.587, 0.114)))
+
+## the anaglyph matrices by name (see ColorAnaglyph.matrices)
+MATRICES = {
+    "dubois": DUBOIS_RED_CYAN,
+    "color": COLOR_RED_CYAN,
+    "half_color": HALF_COLOR_RED_CYAN,
+    "gray": GRAY_RED_CYAN,
+}
+
+def color_channels(layer_data):
+    """! Splits layer data into its color and alpha channels.
+    @param layer_data the layer (height x width x channels): gray+alpha, RGB or RGB+alpha; a single channel is the alpha channel of a white layer
+    @return the color channels (height x width x 3) and the alpha channel (height x width), as views
+    """
+    h, w, channels = layer_data.shape
+    if channels == 1:
+        a = layer_data[:,:,0]
+        return numpy.broadcast_to(numpy.array(255, dtype=a.dtype), (h,w,3)), a
+    if channels == 2:
+        return numpy.broadcast_to(layer_data[:,:,:1], (h,w,3)), layer_data[:,:,1]
+    if channels == 3:
+        return layer_data, numpy.broadcast_to(numpy.array(255, dtype=layer_data.dtype), (h,w))
+    return layer_data[:,:,:3], layer_data[:,:,3]
+
+def is_color_image(image):
+    """! @return true if an image (gimp image or layer_stack.ArrayImage) has color (RGB) layers """
+    return any(layer.bpp >= 3 for layer in image.layers)
+
+class ColorAnaglyph(Anaglyph):
+    """! A variant of the Anaglyph algorithm for color (RGB) layers.
+
+    The left and right image are stored in a single buffer (height x width x 6: left R,G,B, right R,G,B);
+    left and right are views of it. A layer is shifted and blended with all its color channels at once
+    (numpy broadcasting over the last axis), i.e., there is one pass per view and layer instead of one per
+    channel. Gray level layers are treated as colors with R=G=B.
+
+    The anaglyph is computed by a single matrix product per pixel: the 6 channels of both views are
+    multiplied with a 6x3 matrix built from the left and right matrix of matrices (the luminance correction
+    f1, f2 is part of the matrix). The default are the red/cyan matrices by Dubois (see MATRICES).
+    The alpha channels are the same as for Anaglyph.
+    """
+    ## the number of color channels of the left and right image
+    channels = 3
+    ## the (left, right) anaglyph matrices (see MATRICES)
+    matrices = DUBOIS_RED_CYAN
+
+    def __init__(self, f1=1.0, f2=1.0, matrices=None):
+        """! Creates the algorithm (see Anaglyph.__init__).
+        @param matrices the (left, right) anaglyph matrices (3x3 each, default: the matrices of the class)
+        """
+        Anaglyph.__init__(self, f1, f2)
+        if matrices is not None:
+            self.matrices = matrices
+        self.views = None
+
+    def _init_buffers(self, h, w):
+        """! Allocates the buffers (on first use). """
+        if self.views is None:
+            self.views = numpy.zeros((h,w,6))
+            self.left  = self.views[:,:,:3]
+            self.right = self.views[:,:,3:]
+            self.aleft  = numpy.zeros((h,w))
+            self.aright = numpy.zeros((h,w))
+        else:
+            assert self.views.shape[:2] == (h,w), "shape must not change"
+
+    def _blend(self, acc, aacc, color, alpha):
+        """! In place: acc = acc+(color-acc)*alpha/255 (all channels) and aacc = max(aacc,alpha). """
+        tmp = numpy.subtract(color, acc)
+        tmp *= alpha[:,:,None]/255.0
+        acc += tmp
+        numpy.maximum(aacc, alpha, out=aacc)
+
+    def update(self, layer_data, d):
+        """! Update the image using a single depth value
+        @param layer_data the layer to be added (as numpy array, see color_channels)
+        @param d the disparity of the layer
+        """
+        h, w = layer_data.shape[0], layer_data.shape[1]
+        self._init_buffers(h, w)
+        color, alpha = color_channels(layer_data)
+        box = alpha_bbox(alpha)
+        if box is None:
+            return
+        rows, cols = box
+        for acc, aacc, s in ((self.left, self.aleft, -d), (self.right, self.aright, +d)):
+            c = overlap(w, int(s), cols)
+            if c is None:
+                continue
+            dst, src = c
+            self._blend(acc[rows,dst], aacc[rows,dst], color[rows,src], alpha[rows,src])
+
+    def update_ext(self, layer_data, d):
+        """! Update the image using a depth map
+        @param layer_data the layer to be added (as numpy array, see color_channels)
+        @param d the disparity map of the layer
+        """
+        h, w = layer_data.shape[0], layer_data.shape[1]
+        self._init_buffers(h, w)
+        box = alpha_bbox(color_channels(layer_data)[1])
+        if box is None:
+            return
+        rows, cols = box
+        win = ext_window(w, d[rows], cols)
+        if win is None:
+            return
+
+        # all channels are resampled together; samples outside the layer must be transparent,
+        # i.e., an alpha channel is needed
+        src = layer_data[rows]
+        if src.shape[2] == 3:
+            src = numpy.concatenate((src, numpy.full(src.shape[:2]+(1,), 255, dtype=src.dtype)), axis=2)
+        left, right = row_samplings(d[rows,win], win, w)
+        for acc, aacc, sampling in ((self.left, self.aleft, left), (self.right, self.aright, right)):
+            color, alpha = color_channels(sampling.resample(src))
+            self._blend(acc[rows,win], aacc[rows,win], color, alpha)
+
+    def matrix(self, swap_lr):
+        """! @return the 6x3 matrix projecting the left and right colors of a pixel to the anaglyph colors (see views)
+        @param swap_lr if true the left and right image are swapped.
+        """
+        ml = numpy.transpose(numpy.asarray(self.matrices[0], dtype=numpy.float64))*self.f1
+        mr = numpy.transpose(numpy.asarray(self.matrices[1], dtype=numpy.float64))*self.f2
+        if swap_lr:
+            return numpy.concatenate((mr, ml))
+        return numpy.concatenate((ml, mr))
+
+    def project(self, swap_lr):
+        """! Computes the anaglyph colors (a single matrix product for all pixels, clipped to 0..255).
+        @param swap_lr if true the left and right image are swapped.
+        @return the colors (height x width x 3)
+        """
+        h, w = self.views.shape[0], self.views.shape[1]
+        rgb = numpy.dot(numpy.reshape(self.views, (h*w,6)), self.matrix(swap_lr))
+        rgb[:,0] += (1-self.f1)/2
+        rgb[:,1:] += (1-self.f2)/2
+        numpy.clip(rgb, 0, 255, out=rgb)
+        return numpy.reshape(rgb, (h,w,3))
+
+    def write_result(self, out, swap_lr):
+        """! Writes the anaglyph into an uint8 RGBA window (see Anaglyph.write_result). """
+        out[:,:,:3] = self.project(swap_lr)
+        numpy.maximum(self.aleft, self.aright, out=out[:,:,3], casting="unsafe")
+
+    def get_result(self, swap_lr):
+        """! Combines the result collected so far (left and right image) as anaglyph.
+        @param swap_lr if true the left and right image are swapped.
+        @return a numpy array representing the result image with 4 (RGBA) channels.
+        """
+        a = numpy.empty((self.views.shape[0],self.views.shape[1],4))
+        a[:,:,:3] = self.project(swap_lr)
+        a[:,:,3] = numpy.maximum(self.aleft,self.aright)
+        return a
+
+def color_algorithm(matrices):
+    """! @return a ColorAnaglyph class using the given (left, right) matrices (e.g. MATRICES["gray"]), for the
+    renderer functions (see anaglyph_renderer.render, parameter algorithm)
+    """
+    class _ColorAnaglyph(ColorAnaglyph):
+        pass
+    _ColorAnaglyph.matrices = matrices
+    return _ColorAnaglyph
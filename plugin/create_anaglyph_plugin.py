@@ -1,46 +1,118 @@
 #! /usr/bin/env python
 from gimpfu import *
 import os
+import multiprocessing
 from gimpfu_numpy_converter import *
 from anaglyph_algorithm import Anaglyph
-from depth_algorithm import DepthAlgo
+from anaglyph_renderer import render_bands, render_outputs
+from color_anaglyph import MATRICES, color_algorithm, is_color_image
+from stereo_output import *
+from render_cache import RenderCache, render_cached
+from preview import LayerPyramid
+from profiler import Profiler, NULL_PROFILER
+from render_client import render_remote, service_available, DEFAULT_URL
 
-def run(timg, tdrawable, mindisp, maxdisp,f1,f2,swap_lr):
-    """! Plugin main function. Combines layers to form an anaglyph."""
-    # init algo        
-    anaglyph = Anaglyph(f1,f2)
-    depthalgo = DepthAlgo(timg, mindisp, maxdisp)
+## the choices of the plugin parameter "output" (lists of stereo_output formats)
+OUTPUT_CHOICES = [[ANAGLYPH], [SIDE_BY_SIDE], [OVER_UNDER], [INTERLEAVED], [LEFT, RIGHT], list(FORMATS)]
+## the choices of the plugin parameter "colors" (anaglyph matrices for RGB images, see color_anaglyph.MATRICES)
+COLOR_CHOICES = ["dubois", "color", "half_color", "gray"]
 
-    n=1
-    nmax=len(timg.layers)
-    for layer in reversed(timg.layers):
-        print layer.name
-        if not depthalgo.is_depth_map(layer):
-            # convert layer data to numpy array
-            mf = layer2array(layer, dtype=numpy.float)
+def select_algorithm(timg, colors):
+    """! @return the algorithm class for an image: Anaglyph for gray level images, a ColorAnaglyph (matrices COLOR_CHOICES[colors]) for RGB images """
+    if is_color_image(timg):
+        return color_algorithm(MATRICES[COLOR_CHOICES[colors]])
+    return Anaglyph
 
-            # determine depth
-            d = depthalgo.get_disparity(layer)
+def new_output_image(fmt, width, height, channels=1):
+    """! Creates a new image with a single layer for an output format (see stereo_output.output_shape).
+    @return the image and the layer
+    """
+    h, w, channels = output_shape(fmt, height, width, channels)
+    image_type, layer_type = (RGB, RGB_IMAGE) if channels == 4 else (GRAY, GRAY_IMAGE)
+    new_image = pdb.gimp_image_new(w, h, image_type); 
+    new_layer = pdb.gimp_layer_new(new_image, w, h, layer_type, fmt, 100.0, NORMAL_MODE)
+    pdb.gimp_layer_add_alpha(new_layer)
+    new_image.add_layer(new_layer)
+    return new_image, new_layer
+
+def run(timg, tdrawable, mindisp, maxdisp,f1,f2,swap_lr,use_cache,profile=False,output=0,colors=0,use_service=False):
+    """! Plugin main function. Combines layers to form an anaglyph (or other stereo formats, see OUTPUT_CHOICES)."""
+    profiler = Profiler() if profile else NULL_PROFILER
+    formats = OUTPUT_CHOICES[output]
+    algorithm = select_algorithm(timg, colors)
+    if use_cache and algorithm.channels != 1:
+        print("reusing results of previous runs is only supported for gray level images")
+        use_cache = False
+
+    if use_service and not service_available():
+        print("no render service running at %s, rendering locally"%(DEFAULT_URL))
+        use_service = False
+
+    # create new output images
+    images = [new_output_image(fmt, timg.width, timg.height, algorithm.channels) for fmt in formats]
+
+    if use_service:
+        # the render service renders the layers (stored in a temporary file, see render_client.render_remote)
+        params = {"mindisp": mindisp, "maxdisp": maxdisp, "f1": f1, "f2": f2, "swap_lr": bool(swap_lr),
+                  "threads": multiprocessing.cpu_count(), "cache": bool(use_cache),
+                  "color": COLOR_CHOICES[colors] if algorithm.channels != 1 else None}
+        with profiler.stage("render_remote"):
+            outputs = render_remote(timg, formats, params)
+    elif use_cache:
+        # combine all layers reusing the results of previous runs (see render_cache.render_cached)
+        cache = RenderCache(os.path.join(gimp.directory, "create_anaglyph_cache"))
+        with profiler.stage("render_cached"):
+            anaglyph = render_cached(timg, mindisp, maxdisp, f1, f2, cache, progress=pdb.gimp_progress_update, verbose=True)
+        with profiler.stage("get_result"):
+            outputs = allocate_outputs(formats, timg.height, timg.width)
+            write_outputs(anaglyph, outputs, 0, swap_lr)
+    elif formats == [ANAGLYPH]:
+        # combine all layers band by band and convert each output band (numpy) to gimp data
+        # (see anaglyph_renderer.render_bands)
+        new_layer = images[0][1]
+        def write_band(y, band):
+            copy_array_into_layer_rows(band, new_layer, y)
+        render_bands(timg, mindisp, maxdisp, f1, f2, swap_lr, write_band, progress=pdb.gimp_progress_update, verbose=True,
+                     threads=multiprocessing.cpu_count(), algorithm=algorithm, profiler=profiler)
+        outputs = {}
+    else:
+        # render the left and right image once, all formats are written from it (see anaglyph_renderer.render_outputs)
+        outputs = render_outputs(timg, mindisp, maxdisp, f1, f2, swap_lr, formats, progress=pdb.gimp_progress_update,
+                                 threads=multiprocessing.cpu_count(), algorithm=algorithm, profiler=profiler)
+    with profiler.stage("write"):
+        for fmt, (new_image, new_layer) in zip(formats, images):
+            if fmt in outputs:
+                copy_array_into_layer(outputs[fmt], new_layer)
 
-            # update algo and progress bar        
-            if (depthalgo.has_map(layer)):
-                print("%s --> special"%(layer.name))
-                anaglyph.update_ext(mf,d)
-            else:
-                print("%s --> %f"%(layer.name,d))
-                anaglyph.update(mf,d)
+    if profile:
+        # report in the gimp directory (see profiler.Profiler)
+        profiler.close()
+        report = os.path.join(gimp.directory, "create_anaglyph_profile")
+        profiler.to_json(report+".json")
+        profiler.to_csv(report+".csv")
+        print(profiler.summary())
+        print("profile stored in %s.json/.csv"%(report))
+
+    # display new images
+    for new_image, new_layer in images:
+        display = pdb.gimp_display_new(new_image)
+
+def run_preview(timg, tdrawable, mindisp, maxdisp,f1,f2,swap_lr,preview_width,colors=0):
+    """! Plugin function rendering a low resolution preview (see preview.LayerPyramid).
+    The downscaled layers are stored in the gimp directory: the next preview of the same layers
+    (e.g. with other parameters) only reads them.
+    """
+    pyramid = LayerPyramid(timg, os.path.join(gimp.directory, "create_anaglyph_preview"))
+    max_pixels = preview_width*preview_width*timg.height//timg.width
+    result = pyramid.render(mindisp, maxdisp, f1, f2, swap_lr, max_pixels=max(max_pixels,1), algorithm=select_algorithm(timg, colors))
 
-            pdb.gimp_progress_update(float(n)/float(nmax))
-            n=n+1
-    
     # create new output image
-    new_image = pdb.gimp_image_new(timg.width, timg.height, RGB); 
-    new_layer = pdb.gimp_layer_new(new_image, timg.width, timg.height, RGB, "main", 100.0, NORMAL_MODE)
+    h, w = result.shape[0], result.shape[1]
+    new_image = pdb.gimp_image_new(w, h, RGB); 
+    new_layer = pdb.gimp_layer_new(new_image, w, h, RGB, "preview", 100.0, NORMAL_MODE)
     pdb.gimp_layer_add_alpha(new_layer)
     new_image.add_layer(new_layer)
-
-    # convert algorithm output array (numpy) to gimp data
-    copy_array_into_layer(anaglyph.get_result(swap_lr), new_layer)
+    copy_array_into_layer(result, new_layer)
 
     # display new image
     display = pdb.gimp_display_new(new_image)
@@ -51,7 +123,7 @@ register(
     """Create an anaglyph from layers (generates a new image)
 Layers named depth=<float> specify a fixed depth from 0 (near) to 1(far). Values outside 0..1 are also possible.""", "", "", "", "",
     "<Toolbox>/Xtns/Goto40/Create Anaglyph From Layers", 
-    "GRAY*",
+    "RGB*, GRAY*",
     [
     (PF_IMAGE,      "image",    "Input image",      None),
     (PF_DRAWABLE,   "drawable", "Input drawable",   None),
@@ -60,11 +132,35 @@ Layers named depth=<float> specify a fixed depth from 0 (near) to 1(far). Values
     (PF_FLOAT,      "left_factor",   "luminance correction left (0.0..1.0)",        1.0),
     (PF_FLOAT,      "right_factor",   "luminance correction right (0.0..1.0)",        0.8),
     (PF_BOOL,      "swap_lr",   "swap left/right",        False),
-#optional:    (PF_OPTION,     "mode",     "conversion mode",  0, ["layers","encoded"]),
+    (PF_BOOL,      "use_cache",   "reuse results of previous runs",        False),
+    (PF_BOOL,      "profile",   "record timings (report in the gimp directory)",        False),
+    (PF_OPTION,     "output",     "output",  0, ["anaglyph","side by side","over/under","row interleaved","left and right","all"]),
+    (PF_OPTION,     "colors",     "colors (RGB images)",  0, ["optimized (Dubois)","color","half color","gray"]),
+    (PF_BOOL,      "use_service",   "use the render service (if running)",        False),
     ],
     [],
     run
     )
+register(
+    "create_anaglyph_preview", 
+    """Create a low resolution preview of an anaglyph from layers (generates a new image)
+The parameters are the same as for "Create Anaglyph From Layers".""", "", "", "", "",
+    "<Toolbox>/Xtns/Goto40/Create Anaglyph Preview", 
+    "RGB*, GRAY*",
+    [
+    (PF_IMAGE,      "image",    "Input image",      None),
+    (PF_DRAWABLE,   "drawable", "Input drawable",   None),
+    (PF_FLOAT,        "mindisp",   "min disparity, percent width (near)",        0.0),
+    (PF_FLOAT,        "maxdisp",   "max disparity, percent width (far)",        2.0),
+    (PF_FLOAT,      "left_factor",   "luminance correction left (0.0..1.0)",        1.0),
+    (PF_FLOAT,      "right_factor",   "luminance correction right (0.0..1.0)",        0.8),
+    (PF_BOOL,      "swap_lr",   "swap left/right",        False),
+    (PF_INT,      "preview_width",   "max. preview width (pixels)",        800),
+    (PF_OPTION,     "colors",     "colors (RGB images)",  0, ["optimized (Dubois)","color","half color","gray"]),
+    ],
+    [],
+    run_preview
+    )
 
 main()
 
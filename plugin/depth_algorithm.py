@@ -1,41 +1,222 @@
 import re
+import tempfile
+import threading
 from gimpfu_numpy_converter import *
 
+## the layer name patterns (see DepthAlgo)
+_depthmap_pattern = re.compile(r'depthmap\s+(\w+)\s+(-?[\d\.]+)\s+to\s+(-?[\d\.]+)')
+_reldepthmap_pattern = re.compile(r'reldepthmap\s*=\s*(\w+)')
+_fixdepthmap_pattern = re.compile(r'fixdepthmap\s*=\s*(\w+)')
+_depth_pattern = re.compile(r'depth=(-?[\d\.]+)')
+
+## depth maps larger than this are stored in a memory mapped scratch file (bytes, see DepthMapStore)
+DEFAULT_SPILL_BYTES = 64*1024**2
+
+## kinds of layers (see PlannedLayer.kind)
+NORMAL_LAYER, FIXED_DEPTH, RELATIVE_MAP, FIXED_MAP, DEPTH_MAP = range(5)
+
+class PlannedLayer:
+    """!
+    An entry of the layer plan of a DepthAlgo: the parsed name of a layer and its disparity.
+    """
+    def __init__(self, layer, index, kind, map_name=None):
+        """!
+        Creates an entry.
+        @param layer the gimp layer
+        @param index the index of the layer in the image (top most layer first)
+        @param kind the kind of the layer (NORMAL_LAYER, FIXED_DEPTH, RELATIVE_MAP, FIXED_MAP or DEPTH_MAP)
+        @param map_name the name of the depth map used (RELATIVE_MAP, FIXED_MAP) or defined (DEPTH_MAP)
+        """
+        self.layer = layer
+        self.index = index
+        self.kind = kind
+        self.map_name = map_name
+        ## the relative depth (0..1) of the layer (for RELATIVE_MAP: the depth of its position between the neighboring layers)
+        self.depth = None
+        ## the disparity in pixels, None if the layer uses a depth map (see DepthAlgo.disparity)
+        self.disparity = None
+
+    def has_map(self):
+        """! @return if this layer uses a depth map """
+        return self.kind == RELATIVE_MAP or self.kind == FIXED_MAP
+
+class DepthMapStore:
+    """!
+    Holds the depth maps of an image (the layers "depthmap <name> a to b").
+
+    A map is loaded from its layer and normalized (to a..b) when it is first needed, and stored as
+    float32. Maps larger than spill_bytes are stored in a memory mapped scratch file (deleted
+    automatically). Each map counts its users (the layers referencing it); a map is released after its
+    last user (see release). The store may be used from several threads; the map layers are read
+    while holding transfer_lock (gimp pixel access is not thread safe).
+    """
+    def __init__(self, scratch_dir=None, spill_bytes=DEFAULT_SPILL_BYTES, transfer_lock=None):
+        """!
+        Creates an empty store.
+        @param scratch_dir the directory for the scratch files (None = system default)
+        @param spill_bytes maps larger than this (bytes) are memory mapped
+        @param transfer_lock optional lock held while a band of a map layer is read (e.g. the lock of the renderer
+               serializing all pixel transfers, see anaglyph_renderer); default: a lock of its own
+        """
+        self.scratch_dir = scratch_dir
+        self.spill_bytes = spill_bytes
+        self.transfer_lock = transfer_lock or threading.Lock()
+        self.sources = {}
+        self.users = {}
+        self.maps = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.sources
+
+    def add(self, name, layer, mi, ma):
+        """! Registers a depth map (the map is not loaded yet).
+        @param name the name of the map
+        @param layer the depth map layer
+        @param mi the depth of the darkest pixels
+        @param ma the depth of the brightest pixels
+        """
+        assert(ma>mi)
+        self.sources[name] = (layer, mi, ma)
+        self.users.setdefault(name, 0)
+
+    def add_user(self, name):
+        """! Registers a user of a map (see release). """
+        self.users[name] += 1
+
+    def get(self, name):
+        """! @return the depth map (float32 array, height x width; loaded on first use) """
+        with self.lock:
+            m = self.maps.get(name)
+            if m is None:
+                m = self._load(name)
+                self.maps[name] = m
+            return m
+
+    def release(self, name):
+        """! Called by a user when the map is no longer needed; the map is freed after the last user. """
+        with self.lock:
+            self.users[name] -= 1
+            if self.users[name] <= 0:
+                self.maps.pop(name, None)
+
+    def close(self):
+        """! Frees all maps. """
+        with self.lock:
+            self.maps.clear()
+
+    def _allocate(self, h, w):
+        if h*w*4 > self.spill_bytes:
+            return numpy.memmap(tempfile.TemporaryFile(dir=self.scratch_dir), dtype=numpy.float32, mode="w+", shape=(h,w))
+        return numpy.empty((h,w), dtype=numpy.float32)
+
+    def _load(self, name):
+        """! Reads the map layer band by band (each band under transfer_lock) into a float32 array and normalizes it. """
+        layer, mi, ma = self.sources[name]
+        h, w = layer.height, layer.width
+        m = self._allocate(h, w)
+        band = 256
+        for y in range(0, h, band):
+            with self.transfer_lock:
+                rows = layer_rows2array(layer, y, min(band, h-y))
+            m[y:y+rows.shape[0]] = rows[:,:,0]
+        lo = float(m.min())
+        hi = float(m.max())
+        assert(hi>lo)
+        for y in range(0, h, band):
+            rows = m[y:y+band]
+            rows -= lo
+            rows *= (ma-mi)/(hi-lo)
+            rows += mi
+        return m
+
 class DepthAlgo:
     """!
     This class is responsible to compute the depth of a layer. This can be a single depth value or a depth map.
+
+    The layer names are parsed once, when the DepthAlgo is created: the result is the layer plan
+    (DepthAlgo.plan, one PlannedLayer per layer, top most layer first) holding the kind of each
+    layer and its disparity. The renderer iterates the plan (see DepthAlgo.layers).
     """
-    def __init__(self, gimp_image, mindisp, maxdisp):
+    def __init__(self, gimp_image, mindisp, maxdisp, transfer_lock=None):
         """!
         Creates a DepthAlgo.
         @param gimp_image the gimp image to be processed        
         @param min_disp the minimum disparity to be processed (relative to image width)        
         @param max_disp the maximum disparity to be processed (relative to image width)        
+        @param transfer_lock optional lock held while the depth maps are read (see DepthMapStore)
         """
         self.gimp_image = gimp_image
         self.mindisp = mindisp
         self.maxdisp = maxdisp
-        self.n=0
-        self.depthmaps={}
-        self.normallayers=[]
-        for layer in reversed(gimp_image.layers):
-            m = self.is_depth_map(layer) 
-            isnormal = not( m or self.has_fixdepthmap(layer) or self.has_depth(layer))
-            if isnormal:
-                #print("normal layer: %s --> %d"%(layer.name,self.n))
-                self.n+=1
-                self.normallayers.insert(0,layer)
-            elif m:
-                data = layer2array(layer, dtype=numpy.float)
-                data = data[:,:,0]
-                assert(data.max()>data.min())
-                data = (data-data.min())/(data.max()-data.min())*1.0
-                mi = float(m.group(2))
-                ma = float(m.group(3))
-                assert(ma>mi)
-                self.depthmaps[m.group(1)] = mi+data*(ma-mi)
+        self.width = gimp_image.width
+        self.depthmaps=DepthMapStore(transfer_lock=transfer_lock)
+        self.plan = [self._classify(layer, index) for index, layer in enumerate(gimp_image.layers)]
+        self._entries = dict((_layer_key(entry.layer), entry) for entry in self.plan)
+        normal = [entry for entry in self.plan if entry.kind == NORMAL_LAYER or entry.kind == RELATIVE_MAP]
+        self.n = len(normal)
         #print("layer count n==%d"%(self.n))
 
+        for entry in reversed(self.plan):
+            if entry.kind == DEPTH_MAP:
+                m = _depthmap_pattern.match(entry.layer.name)
+                self.depthmaps.add(m.group(1), entry.layer, float(m.group(2)), float(m.group(3)))
+
+        for idx, entry in enumerate(normal):
+            if entry.kind == NORMAL_LAYER:
+                entry.depth = self._relative_depth(idx)
+                entry.disparity = int(0.5+self._scale(entry.depth)*self.width/100.0)
+        for entry in self.plan:
+            if entry.kind == RELATIVE_MAP:
+                entry.depth = self._relative_depth(entry.index)
+            elif entry.kind == FIXED_DEPTH:
+                entry.disparity = int(0.5+self._scale(entry.depth)*self.width/100.0)
+            if entry.has_map():
+                assert(entry.map_name in self.depthmaps)
+                self.depthmaps.add_user(entry.map_name)
+
+    def _classify(self, layer, index):
+        """! Parses the name of a layer (see is_depth_map, has_reldepthmap, has_fixdepthmap and has_depth).
+        @return the PlannedLayer
+        """
+        name = layer.name
+        m = _depthmap_pattern.match(name)
+        if m:
+            return PlannedLayer(layer, index, DEPTH_MAP, m.group(1))
+        m = _fixdepthmap_pattern.match(name)
+        if m:
+            return PlannedLayer(layer, index, FIXED_MAP, m.group(1))
+        m = _reldepthmap_pattern.match(name)
+        if m:
+            return PlannedLayer(layer, index, RELATIVE_MAP, m.group(1))
+        m = _depth_pattern.match("depth=0" if name.startswith("background") else name)
+        if m:
+            entry = PlannedLayer(layer, index, FIXED_DEPTH)
+            entry.depth = float(m.group(1))
+            return entry
+        return PlannedLayer(layer, index, NORMAL_LAYER)
+
+    def _relative_depth(self, idx):
+        if self.n>1:
+            return float(idx)/float(self.n-1)
+        return 0
+
+    def _scale(self, d):
+        return self.mindisp+float(self.maxdisp-self.mindisp)*d
+
+    def layers(self, front_to_back=False):
+        """!
+        @param front_to_back if true the layers are returned top most layer first, else bottom layer first
+        @return the plan entries (PlannedLayer) of the layers to be rendered (all layers except the depth maps)
+        """
+        entries = [entry for entry in self.plan if entry.kind != DEPTH_MAP]
+        if not front_to_back:
+            entries.reverse()
+        return entries
+
+    def entry(self, gimp_layer):
+        """! @return the plan entry (PlannedLayer) of a layer of the image (raises KeyError on error) """
+        return self._entries[_layer_key(gimp_layer)]
 
     def is_depth_map(self, gimp_layer):
         """!
@@ -43,9 +224,7 @@ class DepthAlgo:
         @param gimp_layer the layer to be investigated.
         @return the matcher containing (name, mindepth, maxdepth) or None (logically maps to a boolean)
         """
-        pat = re.compile(r'depthmap\s+(\w+)\s+(-?[\d\.]+)\s+to\s+(-?[\d\.]+)')
-        m=pat.match(gimp_layer.name)
-        return m
+        return _depthmap_pattern.match(gimp_layer.name)
 
     def has_map(self, gimp_layer):
         """! 
@@ -59,18 +238,14 @@ class DepthAlgo:
         @param gimp_layer the layer to be investigated.
         @return the matcher containing the map name or None (logically maps to a boolean)
         """
-        pat = re.compile(r'reldepthmap\s*=\s*(\w+)')
-        m=pat.match(gimp_layer.name)
-        return m
+        return _reldepthmap_pattern.match(gimp_layer.name)
 
     def has_fixdepthmap(self, gimp_layer):
         """! Determines if a layer has (uses) a depth map as fixed map fixed depth values)
         @param gimp_layer the layer to be investigated.
         @return the matcher containing the map name or None (logically maps to a boolean)
         """
-        pat = re.compile(r'fixdepthmap\s*=\s*(\w+)')
-        m=pat.match(gimp_layer.name)
-        return m
+        return _fixdepthmap_pattern.match(gimp_layer.name)
 
     def has_depth(self, gimp_layer):
         """! Determines if a used depth is specified for the layer
@@ -80,50 +255,56 @@ class DepthAlgo:
         n=gimp_layer.name
         if (n.startswith("background")):
             n="depth=0" 
-        pat = re.compile(r'depth=(-?[\d\.]+)')
-        m=pat.match(n)
-        return m
+        return _depth_pattern.match(n)
 
-    def get_disparity(self, gimp_layer):
+    def get_disparity(self, gimp_layer, rows=None):
         """! Determines the depth value or the map of depth values of a layer
         @param gimp_layer the layer to be investigated.
+        @param rows optional slice selecting the rows of a depth map to be computed (default: all rows)
         @retrun the depth value (as absolute disparity in pixels) either as single value or as array of values.
         """
-        idx = self.gimp_image.layers.index(gimp_layer) # raises exception on error
-        mrel=self.has_reldepthmap(gimp_layer)
-        mfix=self.has_fixdepthmap(gimp_layer)
-        if self.n>1:
-            d = float(idx)/float(self.n-1)
-        else:
-            d = 0
-        if self.has_map(gimp_layer):
-            if mrel:
-                print("relative map detected: "+gimp_layer.name)
-                d0 = d-float(1.0/(self.n-1))
-                d1 = d+float(1.0/(self.n-1))
-                assert(mrel.group(1) in self.depthmaps.keys())
-                d = self.depthmaps[mrel.group(1)]
-                d =  d0+d*(d1-d0)
-            else:
-                print("fixed map detected: "+gimp_layer.name)
-                assert(mfix.group(1) in self.depthmaps.keys())
-                d = self.depthmaps[mfix.group(1)]
-            d = self.mindisp+float(self.maxdisp-self.mindisp)*d
-            return numpy.floor(0.5+d*self.gimp_image.width/100.0)
-        else:
-            m=self.has_depth(gimp_layer)
-            if (m):
-                d = float(m.group(1))
-                #print("detected fixed depth: %s=rel. %f"%(gimp_layer.name,d))
-            else:
-                idx = self.normallayers.index(gimp_layer) # raises exception on error
-                if self.n>1:
-                    d = float(idx)/float(self.n-1)
-                else:
-                    d = 0
-
-            d = self.mindisp+float(self.maxdisp-self.mindisp)*d
-            #print("***** depth, idx=%d, d=%f"%(idx,d))
-            return int(0.5+d*self.gimp_image.width/100.0)
-            
+        return self.disparity(self.entry(gimp_layer), rows)
+
+    def set_depth(self, entry, depth):
+        """! Overrides the depth of a plan entry (like a layer named "depth=<float>", e.g. per frame of an animation).
+        @param entry the PlannedLayer (a layer without depth map)
+        @param depth the depth (0.0=nearest layer, 1.0=farthest layer)
+        """
+        if entry.has_map() or entry.kind == DEPTH_MAP:
+            raise ValueError("the depth of a layer with depth map cannot be set: %s"%(entry.layer.name))
+        entry.depth = float(depth)
+        entry.disparity = int(0.5+self._scale(entry.depth)*self.width/100.0)
+
+    def disparity(self, entry, rows=None):
+        """! Determines the depth value or the map of depth values of a plan entry (see get_disparity)
+        @param entry the PlannedLayer
+        @param rows optional slice selecting the rows of a depth map to be computed (default: all rows)
+        @return the depth value (as absolute disparity in pixels) either as single value or as array of values.
+        """
+        if not entry.has_map():
+            return entry.disparity
+        d = self.depthmaps.get(entry.map_name)
+        if rows is not None:
+            d = d[rows]
+        if entry.kind == RELATIVE_MAP:
+            d0 = entry.depth-float(1.0/(self.n-1))
+            d1 = entry.depth+float(1.0/(self.n-1))
+            d = d0+d*(d1-d0)
+        d = self._scale(d)
+        return numpy.floor(0.5+d*self.width/100.0)
+
+    def release(self, entry):
+        """! Called after the last call of disparity for a plan entry: frees its depth map after the last user. """
+        if entry.has_map():
+            self.depthmaps.release(entry.map_name)
+
+    def close(self):
+        """! Frees all depth maps. """
+        self.depthmaps.close()
 
+def _layer_key(gimp_layer):
+    """! @return a key identifying a layer (gimp layers are identified by their ID, other layers by the object) """
+    key = getattr(gimp_layer, "ID", None)
+    if key is None:
+        return id(gimp_layer)
+    return key
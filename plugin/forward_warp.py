@@ -0,0 +1,100 @@
+import numpy
+from anaglyph_algorithm import Anaglyph, layer_channels
+
+## number of depth buffer keys reserved per layer (disparities must be within +-DISPARITY_RANGE/2)
+DISPARITY_RANGE = 1<<32
+
+class ForwardWarpAnaglyph(Anaglyph):
+    """! An alternative algorithm: every visible layer pixel is forward splatted into the left and right image.
+
+    The Anaglyph algorithm combines the layers back to front and a depth map determines where a
+    pixel comes from (see \\ref page_usage). Here, the disparity of a pixel determines where the pixel
+    goes to (x-d in the left image, x+d in the right image). The occlusion is resolved with a depth buffer
+    per view holding the layer order and the disparity: as in Anaglyph, an upper layer occludes the
+    layers below; pixels of the same layer (depth maps) occlude each other by their disparity (the
+    smallest disparity is nearest). Only pixels with alpha>0 are processed, i.e., the cost is
+    proportional to the number of visible layer pixels instead of layers x image size.
+
+    Restrictions (compared to Anaglyph): the disparities are rounded to integers and transparency is not
+    blended: each output pixel shows the nearest pixel (gray*alpha) with its alpha value.
+    The interface is the same as for Anaglyph: update/update_ext are called back to front.
+    """
+    ## the type of the layer data expected by update/update_ext (None = as stored in the layer, uint8)
+    layer_dtype = None
+
+    def __init__(self, f1=1.0, f2=1.0):
+        """! Creates the algorithm (see Anaglyph.__init__). """
+        Anaglyph.__init__(self, f1, f2)
+        self.zleft = None
+        self.zright = None
+        self.n = 0
+
+    def _init_buffers(self, h, w):
+        """! Allocates the images and depth buffers (on first use). """
+        if self.left is None:
+            self.left  = numpy.zeros((h,w))
+            self.right = numpy.zeros((h,w))
+            self.aleft  = numpy.zeros((h,w))
+            self.aright = numpy.zeros((h,w))
+            self.zleft  = numpy.full((h,w), numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+            self.zright = numpy.full((h,w), numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+        else:
+            assert self.left.shape == (h,w), "shape must not change"
+
+    def _splat(self, acc, aacc, zbuf, x, y, d, gray, alpha, unique):
+        """! Splats pixels into one view.
+        @param acc the image of the view
+        @param aacc the alpha channel of the view
+        @param zbuf the depth buffer of the view
+        @param x the destination columns of the pixels
+        @param y the rows of the pixels
+        @param d the (integer) disparities of the pixels
+        @param gray the gray values of the pixels
+        @param alpha the alpha values of the pixels
+        @param unique true if the destinations are unique (constant disparity)
+        """
+        w = acc.shape[1]
+        inside = numpy.logical_and(x>=0, x<w)
+        dst = y[inside]*w+x[inside]
+        key = d[inside]-self.n*DISPARITY_RANGE if numpy.ndim(d) else numpy.full(dst.shape, d-self.n*DISPARITY_RANGE, dtype=numpy.int64)
+        z = zbuf.reshape(-1)
+        if unique:
+            z[dst] = numpy.minimum(z[dst], key)
+        else:
+            numpy.minimum.at(z, dst, key)
+        # the keys are unique per destination: exactly one pixel wins
+        win = z[dst]==key
+        dst = dst[win]
+        a = alpha[inside][win]
+        acc.reshape(-1)[dst] = gray[inside][win]*a/255.0
+        aacc.reshape(-1)[dst] = a
+
+    def _update(self, layer_data, d):
+        """! Splats the visible pixels of a layer into both views. """
+        self._init_buffers(layer_data.shape[0], layer_data.shape[1])
+        self.n += 1
+        gray, alpha = layer_channels(layer_data)
+        y, x = numpy.nonzero(alpha)
+        gray = numpy.asarray(gray[y,x], dtype=numpy.float64)
+        alpha = numpy.asarray(alpha[y,x], dtype=numpy.float64)
+        if numpy.ndim(d):
+            d = numpy.array(numpy.rint(d[y,x]), dtype=numpy.int64)
+        else:
+            d = int(round(d))
+        unique = not numpy.ndim(d)
+        self._splat(self.left,  self.aleft,  self.zleft,  x-d, y, d, gray, alpha, unique)
+        self._splat(self.right, self.aright, self.zright, x+d, y, d, gray, alpha, unique)
+
+    def update(self, layer_data, d):
+        """! Update the image using a single depth value
+        @param layer_data the layer to be added (as numpy array)
+        @param d the disparity of the layer
+        """
+        self._update(layer_data, d)
+
+    def update_ext(self, layer_data, d):
+        """! Update the image using a depth map
+        @param layer_data the layer to be added (as numpy array)
+        @param d the disparity map of the layer (the disparity of each layer pixel)
+        """
+        self._update(layer_data, d)
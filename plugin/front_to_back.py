@@ -0,0 +1,131 @@
+import numpy
+from anaglyph_algorithm import Anaglyph, overlap, alpha_bbox, ext_window, row_samplings
+
+class FrontToBackAnaglyph(Anaglyph):
+    """! A variant of the Anaglyph algorithm combining the layers front to back.
+
+    The layers are added from the top most layer to the bottom layer with the "under" operator:
+    each view accumulates the color weighted with its transmittance t (initially 1):
+    image += t*gray*alpha/255, t *= 1-alpha/255. This yields the same images as combining the layers back
+    to front up to floating point rounding (about 1e-13). Since a value like 127-1e-14 would be truncated to 126
+    in an uint8 output, values closer than SNAP to an integer are rounded to it (see finish), i.e., the uint8
+    outputs match the back to front ones. The coverage is tracked per row: rows which are fully
+    covered (t==0, e.g. below an opaque layer) are skipped for all deeper layers, and as soon as all rows
+    of both views are covered, the remaining layers need not be processed at all (see covered).
+    """
+    ## the layers are added top most layer first (see Anaglyph.front_to_back)
+    front_to_back = True
+    ## values of the left and right image closer than this to an integer are rounded to it (see finish)
+    SNAP = 1e-9
+
+    def __init__(self, f1=1.0, f2=1.0):
+        """! Creates the algorithm (see Anaglyph.__init__). """
+        Anaglyph.__init__(self, f1, f2)
+        self.tleft = None
+        self.tright = None
+        self.openleft = None
+        self.openright = None
+
+    def _init_buffers(self, h, w):
+        """! Allocates the images, transmittances and row coverage flags (on first use). """
+        if self.left is None:
+            self.left  = numpy.zeros((h,w))
+            self.right = numpy.zeros((h,w))
+            self.aleft  = numpy.zeros((h,w))
+            self.aright = numpy.zeros((h,w))
+            self.tleft  = numpy.ones((h,w))
+            self.tright = numpy.ones((h,w))
+            self.openleft  = numpy.ones(h, dtype=bool)
+            self.openright = numpy.ones(h, dtype=bool)
+        else:
+            assert self.left.shape == (h,w), "shape must not change"
+
+    def covered(self):
+        """! @return true if all pixels of both views are fully covered (deeper layers cannot change the result) """
+        return self.left is not None and not self.openleft.any() and not self.openright.any()
+
+    def finish(self):
+        """! Rounds the values of the left and right image closer than SNAP to an integer (in place, see Anaglyph.finish). """
+        if self.left is None:
+            return
+        for im in (self.left, self.right):
+            r = numpy.rint(im)
+            numpy.copyto(im, r, where=numpy.abs(im-r)<self.SNAP)
+
+    def get_result(self, swap_lr):
+        """! Combines the result collected so far as anaglyph (see Anaglyph.get_result; the values are snapped, see finish). """
+        self.finish()
+        return Anaglyph.get_result(self, swap_lr)
+
+    def write_result(self, out, swap_lr):
+        """! Writes the anaglyph into an uint8 RGBA window (see Anaglyph.write_result; the values are snapped, see finish). """
+        self.finish()
+        Anaglyph.write_result(self, out, swap_lr)
+
+    def _open_rows(self, isopen, rows):
+        """! Restricts a range of rows to the rows which are not yet fully covered.
+        @return the slice from the first to the last open row of rows, or None
+        """
+        idx = numpy.flatnonzero(isopen[rows])
+        if len(idx)==0:
+            return None
+        return slice(rows.start+idx[0], rows.start+idx[-1]+1)
+
+    def _under(self, acc, aacc, t, isopen, rows, cols, im, alpha):
+        """! Adds a layer (already shifted, restricted to rows x cols) under the current result. """
+        a = alpha/255.0
+        tv = t[rows,cols]
+        acc[rows,cols] += tv*im*a
+        tv *= 1-a
+        aacc[rows,cols] = numpy.maximum(alpha, aacc[rows,cols])
+        isopen[rows] = (t[rows]>0).any(axis=1)
+
+    def update(self, layer_data, d):
+        """! Update the image using a single depth value (layers are added front to back)
+        @param layer_data the layer to be added (as numpy array)
+        @param d the disparity of the layer
+        """
+        h = layer_data.shape[0]
+        w = layer_data.shape[1]
+        if layer_data.shape[2]==1:
+            tmp = numpy.ones((h,w,2))*255.0
+            tmp[:,:,1]=numpy.reshape(layer_data,(h,w))
+            layer_data=tmp
+        self._init_buffers(h, w)
+        box = alpha_bbox(layer_data[:,:,1])
+        if box is None:
+            return
+        boxrows, cols = box
+        for acc, aacc, t, isopen, s in ((self.left, self.aleft, self.tleft, self.openleft, -d),
+                                        (self.right, self.aright, self.tright, self.openright, +d)):
+            rows = self._open_rows(isopen, boxrows)
+            c = overlap(w, int(s), cols)
+            if rows is None or c is None:
+                continue
+            dst, src = c
+            px = layer_data[rows,src,:]
+            self._under(acc, aacc, t, isopen, rows, dst, px[:,:,0], px[:,:,1])
+
+    def update_ext(self, layer_data, d):
+        """! Update the image using a depth map (layers are added front to back)
+        @param layer_data the layer to be added (as numpy array)
+        @param d the disparity map of the layer
+        """
+        h = layer_data.shape[0]
+        w = layer_data.shape[1]
+        self._init_buffers(h, w)
+        box = alpha_bbox(layer_data[:,:,1])
+        if box is None:
+            return
+        boxrows, cols = box
+        for acc, aacc, t, isopen, view in ((self.left, self.aleft, self.tleft, self.openleft, 0),
+                                           (self.right, self.aright, self.tright, self.openright, 1)):
+            rows = self._open_rows(isopen, boxrows)
+            if rows is None:
+                continue
+            win = ext_window(w, d[rows], cols)
+            if win is None:
+                continue
+            sampling = row_samplings(d[rows,win], win, w)[view]
+            px = sampling.resample(layer_data[rows])
+            self._under(acc, aacc, t, isopen, rows, win, px[:,:,0], px[:,:,1])
@@ -1,19 +1,74 @@
-from gimpfu import *
 import numpy
 
-def layer2array(layer,dtype=None):
+def convert_array(m, dtype=None, out=None):
     """!
-    converts a layer to an array.
+    converts pixel data to the requested type.
+    @param m the pixel data (e.g. from layer_tile2array)
+    @param dtype the requested output type (optional)
+    @param out optional buffer to convert into (same shape as m, e.g. reused for all layers)
+    @return out, m itself if no conversion is needed, or a converted copy of m
+    """
+    if out is not None:
+        out[...] = m
+        return out
+    if dtype is None or m.dtype == dtype:
+        return m
+    return numpy.array(m, dtype=dtype)
+
+def layer_tile2array(layer, x, y, w, h, dtype=None, out=None):
+    """!
+    converts a tile (rectangle) of a layer to an array.
+    Without dtype and out, the array wraps the bytes read from the pixel region (no copy, read only).
     @param layer a gimp layer
+    @param x the first column of the tile
+    @param y the first row of the tile
+    @param w the width of the tile
+    @param h the height of the tile
     @param dtype the requested output type (optional)
+    @param out optional buffer (h x w x channels) to convert into
+    @return a numpy array representing the tile (h x w x channels)
+    """
+    r = layer.get_pixel_rgn(x, y, w, h, False, False)
+    m = numpy.reshape(numpy.frombuffer(r[x:x+w,y:y+h],dtype=numpy.uint8),(h,w,r.bpp))
+    return convert_array(m, dtype, out)
+
+def layer_rows2array(layer, y, h, dtype=None, out=None):
+    """!
+    converts a band of rows of a layer to an array (see layer_tile2array).
+    @param layer a gimp layer
+    @param y the first row of the band
+    @param h the number of rows of the band
+    @param dtype the requested output type (optional)
+    @param out optional buffer (h x width x channels) to convert into
+    @return a numpy array representing the rows y..y+h-1 of the layer (h x width x channels)
+    """
+    return layer_tile2array(layer, 0, y, layer.width, h, dtype, out)
+
+def layer2array(layer,dtype=None,out=None):
+    """!
+    converts a layer to an array (see layer_tile2array).
+    @param layer a gimp layer
+    @param dtype the requested output type (optional)
+    @param out optional buffer (height x width x channels) to convert into
     @return a numpy array representing the layer (height x width x channels)
     """
-    r = layer.get_pixel_rgn(0, 0, layer.width, layer.height, False, False)
-    m = numpy.reshape(numpy.fromstring(r[:,:],dtype=numpy.uint8),(r.h,r.w,r.bpp))
-    if dtype!=None:
-        return numpy.array(m, dtype=dtype)
-    else:
-        return m
+    return layer_tile2array(layer, 0, 0, layer.width, layer.height, dtype, out)
+
+def _uint8_bytes(data):
+    """! @return the bytes of data converted to uint8 (no conversion copy if data is a contiguous uint8 array) """
+    return numpy.ascontiguousarray(data, dtype=numpy.uint8).tobytes()
+
+def copy_array_into_layer_tile(data, layer, x, y):
+    """!
+    copies an array into a tile (rectangle) of a layer.
+    @param data a numpy array representing the tile (h x w x channels). The data is converted into uint8.
+    @param layer a gimp layer
+    @param x the first column of the tile
+    @param y the first row of the tile
+   """
+    h, w = data.shape[0], data.shape[1]
+    r = layer.get_pixel_rgn(x, y, w, h, False, False)
+    r[x:x+w,y:y+h] = _uint8_bytes(data)
 
 def copy_array_into_layer(data, layer):
     """!
@@ -21,8 +76,13 @@ def copy_array_into_layer(data, layer):
     @param layer a gimp layer
     @param data a numpy array representing the layer (height x width x channels; must match the layers' size/channels). The data is converted into uint8.
    """
-    r = layer.get_pixel_rgn(0, 0, layer.width, layer.height, False, False)
-    data8 = numpy.array(data[:],dtype=numpy.uint8);
-    r[:,:] = data8.tostring()
-
+    copy_array_into_layer_tile(data, layer, 0, 0)
 
+def copy_array_into_layer_rows(data, layer, y):
+    """!
+    copies an array into a band of rows of a layer. (width must match)
+    @param data a numpy array representing the rows (h x width x channels). The data is converted into uint8.
+    @param layer a gimp layer
+    @param y the first row of the band
+   """
+    copy_array_into_layer_tile(data, layer, 0, y)
@@ -0,0 +1,291 @@
+import io
+import os
+import re
+import zipfile
+import numpy
+from gimpfu_numpy_converter import layer2array
+
+class ArrayPixelRegion:
+    """! A stand-in for a gimp pixel region, backed by a numpy array.
+    Only the parts used by gimpfu_numpy_converter are provided: the
+    attributes w, h and bpp and the access to the pixel bytes by slicing
+    (e.g. r[:,:]). Slice coordinates are absolute layer coordinates (x,y),
+    as in gimp.
+    """
+    def __init__(self, data, x, y, w, h):
+        self.data = data
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.bpp = data.shape[2]
+
+    def _bounds(self, key):
+        sx, sy = key
+        x1 = self.x if sx.start is None else sx.start
+        x2 = self.x+self.w if sx.stop is None else sx.stop
+        y1 = self.y if sy.start is None else sy.start
+        y2 = self.y+self.h if sy.stop is None else sy.stop
+        return x1, x2, y1, y2
+
+    def __getitem__(self, key):
+        x1, x2, y1, y2 = self._bounds(key)
+        return numpy.ascontiguousarray(self.data[y1:y2, x1:x2, :]).tobytes()
+
+    def __setitem__(self, key, value):
+        x1, x2, y1, y2 = self._bounds(key)
+        m = numpy.frombuffer(value, dtype=numpy.uint8)
+        self.data[y1:y2, x1:x2, :] = numpy.reshape(m, (y2-y1, x2-x1, self.bpp))
+
+class ArrayLayer:
+    """! A stand-in for a gimp layer, backed by a numpy array (height x width x channels, uint8).
+    It can be used everywhere a gimp layer is read by the algorithms (name, size and pixel regions).
+    """
+    def __init__(self, name, data):
+        """! Creates a layer.
+        @param name the name of the layer (the layer naming rules of DepthAlgo apply)
+        @param data the pixel data (height x width x channels); gray level layers have 2 channels (gray, alpha), color layers 4 (RGB, alpha)
+        """
+        ## true if the pixel data is memory mapped (see load_dir)
+        self.mapped = isinstance(data, numpy.memmap)
+        data = numpy.asarray(data, dtype=numpy.uint8)
+        if data.ndim == 2:
+            data = numpy.reshape(data, (data.shape[0], data.shape[1], 1))
+        self.name = name
+        self.data = data
+        self.height = data.shape[0]
+        self.width = data.shape[1]
+
+    @property
+    def bpp(self):
+        """! the number of channels (bytes per pixel, as gimp.Layer.bpp) """
+        return self.data.shape[2]
+
+    @property
+    def nbytes(self):
+        """! the memory held by the pixel data (bytes, 0 for a memory mapped layer) """
+        return 0 if self.mapped else self.data.nbytes
+
+    def get_pixel_rgn(self, x, y, w, h, dirty=False, shadow=False):
+        """! Returns a pixel region of the layer (see gimp.Layer.get_pixel_rgn). """
+        return ArrayPixelRegion(self.data, x, y, w, h)
+
+class LayerInfo:
+    """! The name and size of a layer of a stack on disk, without its pixels (see stack_info). """
+    def __init__(self, name, width, height, bpp, mapped=False):
+        """! Creates the description of a layer.
+        @param name the name of the layer
+        @param width the width of the layer
+        @param height the height of the layer
+        @param bpp the number of channels of the loaded layer
+        @param mapped if true the layer is memory mapped when loaded (see load_dir)
+        """
+        self.name = name
+        self.width = width
+        self.height = height
+        self.bpp = bpp
+        ## the memory needed by the loaded layer (bytes, see ArrayLayer.nbytes)
+        self.nbytes = 0 if mapped else width*height*bpp
+
+class ArrayImage:
+    """! A stand-in for a gimp image: a stack of ArrayLayer objects.
+    As in gimp, the first layer of the list is the top most layer.
+    """
+    def __init__(self, layers):
+        """! Creates an image.
+        @param layers the list of layers (top most layer first); all layers must have the same size.
+        """
+        self.layers = list(layers)
+        assert len(self.layers)>0, "an image needs at least one layer"
+        self.width = self.layers[0].width
+        self.height = self.layers[0].height
+        for layer in self.layers:
+            assert (layer.width, layer.height) == (self.width, self.height), "all layers must have the full image size"
+
+def _require_pil():
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError("reading/writing image files requires PIL (pillow); use .npz stacks without it")
+    return Image
+
+def _gray_alpha(im):
+    return numpy.asarray(im.convert("LA"), dtype=numpy.uint8)
+
+def _pixels(im, color):
+    """! @return the pixels of a PIL image as gray+alpha or (color) RGB+alpha array """
+    if color:
+        return numpy.asarray(im.convert("RGBA"), dtype=numpy.uint8)
+    return _gray_alpha(im)
+
+def load_dir(path, color=False):
+    """! Loads a layer stack from a directory of image files (one file per layer).
+    If the directory contains a file "layers.txt", it lists the layers, top most layer first,
+    one per line as "<file name>" or "<file name><TAB><layer name>".
+    Otherwise all *.png and *.npy files are used in the order of their file names (first file = top most layer)
+    and the layer name is the file name without extension and without an optional
+    leading ordering number (e.g. "03_depth=0.5.png" is the layer "depth=0.5").
+    .npy files (height x width x channels, uint8) are memory mapped, i.e., only the rows
+    accessed by the algorithm are read (see anaglyph_renderer.render_bands).
+    @param path the directory
+    @param color if true the image files are read as RGB+alpha (see color_anaglyph), else as gray+alpha
+    @return an ArrayImage
+    """
+    layers = []
+    for filename, name in _dir_entries(path):
+        if filename.lower().endswith(".npy"):
+            data = numpy.load(filename, mmap_mode="r")
+        else:
+            data = _pixels(_require_pil().open(filename), color)
+        layers.append(ArrayLayer(name, data))
+    return ArrayImage(layers)
+
+def _dir_entries(path):
+    """! @return the (file path, layer name) of the layers of a directory, top most layer first (see load_dir) """
+    index = os.path.join(path, "layers.txt")
+    entries = []
+    if os.path.exists(index):
+        for line in open(index):
+            line = line.rstrip("\r\n")
+            if not line.strip():
+                continue
+            if "\t" in line:
+                filename, name = line.split("\t", 1)
+            else:
+                filename = line
+                name = os.path.splitext(filename)[0]
+            entries.append((filename, name))
+    else:
+        for filename in sorted(os.listdir(path)):
+            if os.path.splitext(filename)[1].lower() in (".png", ".npy"):
+                name = os.path.splitext(filename)[0]
+                name = re.sub(r'^\d+_', '', name)
+                entries.append((filename, name))
+    return [(os.path.join(path, filename), name) for filename, name in entries]
+
+def _tiff_pages(im):
+    """! @return generator of (n, page name) of the pages of a PIL image (im is moved to the page) """
+    n = 0
+    while True:
+        try:
+            im.seek(n)
+        except EOFError:
+            break
+        yield n, im.tag_v2.get(285, "layer%d"%(n)) if hasattr(im, "tag_v2") else "layer%d"%(n)
+        n += 1
+
+def load_tiff(path, color=False):
+    """! Loads a layer stack from a multi-page TIFF file (first page = top most layer).
+    The layer names are taken from the page names (TIFF tag PageName); pages without a
+    name are called "layer<n>".
+    @param path the TIFF file
+    @param color if true the pages are read as RGB+alpha (see color_anaglyph), else as gray+alpha
+    @return an ArrayImage
+    """
+    im = _require_pil().open(path)
+    return ArrayImage([ArrayLayer(name, _pixels(im, color)) for n, name in _tiff_pages(im)])
+
+def load_npz(path):
+    """! Loads a layer stack from a numpy .npz file.
+    Each array is a layer (height x width x channels, uint8) named by its key;
+    the order in the archive is the layer order (first = top most layer).
+    @param path the .npz file
+    @return an ArrayImage
+    """
+    f = numpy.load(path)
+    try:
+        return ArrayImage([ArrayLayer(name, f[name]) for name in f.files])
+    finally:
+        f.close()
+
+def save_npz(image, path, compress=False):
+    """! Stores a layer stack as numpy .npz file (see load_npz).
+    The members are written one by one to keep the layer order.
+    @param image an ArrayImage (or gimp image)
+    @param path the .npz file
+    @param compress if true the layers are compressed (deflate), else stored uncompressed (fast, e.g. for
+           a temporary file passed to the render service)
+    """
+    z = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+    try:
+        for layer in image.layers:
+            buf = io.BytesIO()
+            numpy.save(buf, layer2array(layer))
+            z.writestr(layer.name+".npy", buf.getvalue())
+    finally:
+        z.close()
+
+def load_stack(path, color=False):
+    """! Loads a layer stack from disk, the format is deduced from the path.
+    @param path a directory of PNG/.npy files, a multi-page TIFF file or a .npz file
+    @param color if true image files are read as RGB+alpha, else as gray+alpha (numpy arrays are loaded as stored)
+    @return an ArrayImage
+    """
+    if os.path.isdir(path):
+        return load_dir(path, color)
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".tif", ".tiff"):
+        return load_tiff(path, color)
+    elif ext == ".npz":
+        return load_npz(path)
+    else:
+        raise ValueError("unsupported layer stack format: %s"%(path))
+
+def stack_info(path, color=False):
+    """! Reads the layer names and sizes of a layer stack from disk without loading the pixels
+    (only the file headers are read), e.g. to estimate the memory of load_stack.
+    @param path the layer stack (see load_stack)
+    @param color see load_stack
+    @return an ArrayImage of LayerInfo objects
+    """
+    bpp = 4 if color else 2
+    if os.path.isdir(path):
+        layers = []
+        for filename, name in _dir_entries(path):
+            if filename.lower().endswith(".npy"):
+                shape = numpy.load(filename, mmap_mode="r").shape
+                layers.append(LayerInfo(name, shape[1], shape[0], shape[2] if len(shape) > 2 else 1, mapped=True))
+            else:
+                w, h = _require_pil().open(filename).size
+                layers.append(LayerInfo(name, w, h, bpp))
+        return ArrayImage(layers)
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".tif", ".tiff"):
+        im = _require_pil().open(path)
+        return ArrayImage([LayerInfo(name, im.size[0], im.size[1], bpp) for n, name in _tiff_pages(im)])
+    elif ext == ".npz":
+        layers = []
+        z = zipfile.ZipFile(path)
+        try:
+            for member in z.namelist():
+                f = z.open(member)
+                try:
+                    version = numpy.lib.format.read_magic(f)
+                    if version == (1, 0):
+                        shape = numpy.lib.format.read_array_header_1_0(f)[0]
+                    else:
+                        shape = numpy.lib.format.read_array_header_2_0(f)[0]
+                finally:
+                    f.close()
+                name = member[:-4] if member.endswith(".npy") else member
+                layers.append(LayerInfo(name, shape[1], shape[0], shape[2] if len(shape) > 2 else 1))
+        finally:
+            z.close()
+        return ArrayImage(layers)
+    else:
+        raise ValueError("unsupported layer stack format: %s"%(path))
+
+def save_array(data, path):
+    """! Stores an image array (height x width x channels, uint8) to disk.
+    The format is deduced from the file extension: .npy is written with numpy, all other
+    formats (e.g. .png, .tif) with PIL.
+    @param data the image data
+    @param path the output file
+    """
+    if path.lower().endswith(".npy"):
+        numpy.save(path, data)
+    else:
+        Image = _require_pil()
+        if data.shape[2] == 1:
+            data = data[:,:,0]
+        Image.fromarray(numpy.ascontiguousarray(data)).save(path)
@@ -0,0 +1,106 @@
+import os
+import numpy
+from gimpfu_numpy_converter import layer2array
+from anaglyph_algorithm import Anaglyph
+from anaglyph_renderer import render_to_array
+from layer_stack import ArrayLayer, ArrayImage
+from render_cache import content_hash, prune_directory
+
+## default size of a preview (max. number of pixels)
+DEFAULT_PREVIEW_PIXELS = 640*480
+
+## default size limit of the stored pyramid levels (bytes, see LayerPyramid)
+DEFAULT_PYRAMID_CACHE_SIZE = 256*1024**2
+
+def downscale(data):
+    """! Halves the size of a layer (2x2 box filter, alpha weighted).
+    The gray level (or color) is averaged weighted with the alpha channel (a fully transparent pixel does not
+    contribute), integer arithmetic is used; layers without alpha channel (alpha only or RGB) are averaged.
+    An odd last row/column is dropped.
+    @param data the layer (height x width x channels, uint8)
+    @return the downscaled layer (uint8)
+    """
+    h = data.shape[0]//2*2
+    w = data.shape[1]//2*2
+    q = [numpy.asarray(data[y:h:2,x:w:2], dtype=numpy.uint32) for y in (0,1) for x in (0,1)]
+    if data.shape[2] in (1,3):
+        return numpy.array((q[0]+q[1]+q[2]+q[3]+2)//4, dtype=numpy.uint8)
+    a = [p[:,:,-1:] for p in q]
+    asum = a[0]+a[1]+a[2]+a[3]
+    gsum = q[0][:,:,:-1]*a[0]+q[1][:,:,:-1]*a[1]+q[2][:,:,:-1]*a[2]+q[3][:,:,:-1]*a[3]
+    gmean = (q[0][:,:,:-1]+q[1][:,:,:-1]+q[2][:,:,:-1]+q[3][:,:,:-1]+2)//4
+    g = numpy.where(asum>0, (gsum+asum//2)//numpy.maximum(asum,1), gmean)
+    return numpy.array(numpy.concatenate((g, (asum+2)//4), axis=2), dtype=numpy.uint8)
+
+class LayerPyramid:
+    """! A pyramid of downscaled copies of all layers of an image, to render previews.
+    Level 0 is the image itself, level k is downscaled by 2^k. The levels are built once (on first use);
+    the layer names are kept. Since the disparities are given relative to the image width, a preview
+    rendered from a level has the disparities scaled accordingly.
+
+    With a directory, the downscaled layers are stored there (one .npy file per layer and level, keyed by
+    the content of the layer, see render_cache.content_hash), e.g. to reuse them in the next preview of the
+    same image: a layer is then read once to compute its key, but not downscaled again. Layers changed in
+    the meantime get new keys. The least recently used files are removed above max_bytes.
+    """
+    def __init__(self, image, directory=None, max_bytes=DEFAULT_PYRAMID_CACHE_SIZE):
+        """! Creates the pyramid.
+        @param image the image (gimp image or layer_stack.ArrayImage, top most layer first)
+        @param directory optional directory storing the levels between runs (None = levels kept in memory only)
+        @param max_bytes the size limit of the directory (bytes)
+        """
+        self.levels = {0: image}
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def level(self, k):
+        """! @return the image (ArrayImage) of level k (builds the missing levels or loads them from the directory) """
+        if k not in self.levels:
+            if self.directory is None:
+                src = self.level(k-1)
+                self.levels[k] = ArrayImage([ArrayLayer(layer.name, downscale(layer2array(layer))) for layer in src.layers])
+            else:
+                self.levels[k] = ArrayImage([ArrayLayer(layer.name, self._stored_level(layer, k)) for layer in self.levels[0].layers])
+                prune_directory(self.directory, self.max_bytes, ".npy")
+        return self.levels[k]
+
+    def _stored_level(self, layer, k):
+        """! @return level k of a layer of the image (uint8), loaded from the directory or downscaled and stored """
+        data = layer2array(layer)
+        path = os.path.join(self.directory, content_hash("pyramid", data, k)+".npy")
+        if os.path.exists(path):
+            os.utime(path, None)
+            return numpy.load(path)
+        for i in range(k):
+            data = downscale(data)
+        tmp = path+".tmp.npy"
+        numpy.save(tmp, data)
+        os.rename(tmp, path)
+        return data
+
+    def level_for(self, max_pixels=DEFAULT_PREVIEW_PIXELS):
+        """! @return the first level with at most max_pixels pixels """
+        image = self.levels[0]
+        k = 0
+        w, h = image.width, image.height
+        while w*h > max_pixels and w>1 and h>1:
+            k += 1
+            w, h = w//2, h//2
+        return k
+
+    def render(self, mindisp, maxdisp, f1=1.0, f2=1.0, swap_lr=False, max_pixels=DEFAULT_PREVIEW_PIXELS, algorithm=Anaglyph):
+        """! Renders a preview (see anaglyph_renderer.render_to_array). Repeated calls (e.g. with
+        other parameters) reuse the pyramid.
+        @param mindisp the minimum disparity (percent of the image width, near)
+        @param maxdisp the maximum disparity (percent of the image width, far)
+        @param f1 the darkening factor for the left image (1.0 = no modification)
+        @param f2 the darkening factor for the right image (1.0 = no modification)
+        @param swap_lr if true the left and right image are swapped.
+        @param max_pixels the max. size of the preview (number of pixels)
+        @param algorithm the algorithm class (Anaglyph or a variant)
+        @return the RGBA preview (uint8)
+        """
+        image = self.level(self.level_for(max_pixels))
+        return render_to_array(image, mindisp, maxdisp, f1, f2, swap_lr, algorithm=algorithm)
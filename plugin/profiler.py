@@ -0,0 +1,194 @@
+import csv
+import json
+import time
+import threading
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+_wall_clock = getattr(time, "perf_counter", time.time)
+# cpu time of the calling thread (python >= 3.7), else of the process
+_cpu_clock = getattr(time, "thread_time", None) or getattr(time, "process_time", None) or time.clock
+
+## the fields of a record (see Profiler.records)
+FIELDS = ("stage", "layer", "wall", "cpu", "peak")
+
+class _NullStage:
+    """! The (shared) context manager of a NullProfiler stage: does nothing. """
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_null_stage = _NullStage()
+
+class NullProfiler:
+    """! A profiler recording nothing (the default, see Profiler).
+    Its stage returns a shared context manager without any work, i.e., instrumented code costs one
+    method call per stage.
+    """
+    ## false: nothing is recorded
+    enabled = False
+
+    def stage(self, name, layer=None):
+        """! @return a context manager doing nothing """
+        return _null_stage
+
+## the default profiler of the renderer (records nothing)
+NULL_PROFILER = NullProfiler()
+
+class _Stage:
+    """! The context manager of a Profiler stage: measures the time and memory of the with block. """
+    def __init__(self, profiler, name, layer):
+        self.profiler = profiler
+        self.name = name
+        self.layer = layer
+
+    def __enter__(self):
+        if self.profiler.memory:
+            self.profiler._enter_memory(self)
+        self.cpu = _cpu_clock()
+        self.wall = _wall_clock()
+        return self
+
+    def __exit__(self, *exc):
+        wall = _wall_clock()-self.wall
+        cpu = _cpu_clock()-self.cpu
+        peak = None
+        if self.profiler.memory:
+            peak = self.profiler._exit_memory(self)
+        self.profiler._record(self.name, self.layer, wall, cpu, peak)
+        return False
+
+class Profiler:
+    """! Records the wall time, the cpu time and the peak allocated memory of the stages of a run.
+
+    The renderer (see anaglyph_renderer.render) wraps its stages, e.g.
+        with profiler.stage("update", layer.name):
+            anaglyph.update(mf, d)
+    Each stage creates a record (stage, layer, wall time (s), cpu time (s), peak bytes). The records can be
+    exported (to_json, to_csv) and summarized per stage (summary). The cpu time is measured per thread
+    (python >= 3.7). The peak memory is measured with tracemalloc (python 3, only if memory is true):
+    the maximum of the memory allocated by the process while the stage ran, minus the memory allocated
+    when it started; nested stages are taken into account. Stages may run in several threads, but tracemalloc
+    measures (and resets) the peak of the whole process: the peak is only recorded for stages which did not
+    overlap with a stage of another thread (e.g. all stages of a renderer with threads=1 and prefetch=0), the
+    peak of the other stages is None. Memory allocated by other threads outside of any stage is counted as well.
+    """
+    ## true: stages are recorded
+    enabled = True
+
+    def __init__(self, memory=True):
+        """! Creates a profiler.
+        @param memory if true the peak memory of the stages is measured (tracemalloc is started)
+        """
+        self.memory = memory and tracemalloc is not None
+        self.records = []
+        self._lock = threading.Lock()
+        # the stages running in each thread (thread id -> stack of stages, see _enter_memory)
+        self._stacks = {}
+        self._started_tracing = False
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stage(self, name, layer=None):
+        """! @return a context manager recording a stage
+        @param name the name of the stage (e.g. "read", "update")
+        @param layer the name of the layer processed in the stage (optional)
+        """
+        return _Stage(self, name, layer)
+
+    def close(self):
+        """! Stops the memory tracing (if started by this profiler). """
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def _enter_memory(self, stage):
+        thread = threading.current_thread().ident
+        with self._lock:
+            stack = self._stacks.setdefault(thread, [])
+            others = [s for t, st in self._stacks.items() if t != thread for s in st]
+            stage.concurrent = bool(others)
+            if others:
+                # the process wide peak mixes the allocations of all these stages
+                for s in others+stack:
+                    s.concurrent = True
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # the peak is reset below: keep the peak reached so far for the enclosing stage
+                stack[-1].max_traced = max(stack[-1].max_traced, peak)
+            stage.start_traced = current
+            stage.max_traced = current
+            stack.append(stage)
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+
+    def _exit_memory(self, stage):
+        """! @return the peak memory of the stage (bytes), None if it overlapped with a stage of another thread """
+        thread = threading.current_thread().ident
+        with self._lock:
+            peak = max(tracemalloc.get_traced_memory()[1], stage.max_traced)
+            stack = self._stacks[thread]
+            stack.pop()
+            if stack:
+                stack[-1].max_traced = max(stack[-1].max_traced, peak)
+            else:
+                del self._stacks[thread]
+        if stage.concurrent:
+            return None
+        return peak-stage.start_traced
+
+    def _record(self, name, layer, wall, cpu, peak):
+        with self._lock:
+            self.records.append({"stage": name, "layer": layer, "wall": wall, "cpu": cpu, "peak": peak})
+
+    def totals(self):
+        """! @return list of dicts (stage, count, wall, cpu, peak) per stage (in order of the first record); times are summed, peak is the maximum """
+        totals = []
+        by_stage = {}
+        for r in self.records:
+            t = by_stage.get(r["stage"])
+            if t is None:
+                t = {"stage": r["stage"], "count": 0, "wall": 0.0, "cpu": 0.0, "peak": None}
+                by_stage[r["stage"]] = t
+                totals.append(t)
+            t["count"] += 1
+            t["wall"] += r["wall"]
+            t["cpu"] += r["cpu"]
+            if r["peak"] is not None:
+                t["peak"] = r["peak"] if t["peak"] is None else max(t["peak"], r["peak"])
+        return totals
+
+    def summary(self, layers=5):
+        """! @return a human readable summary: the totals per stage and the slowest layers
+        @param layers the number of slowest layers listed
+        """
+        lines = ["%-14s %6s %10s %10s %12s"%("stage", "count", "wall [s]", "cpu [s]", "peak [MB]")]
+        for t in self.totals():
+            peak = "-" if t["peak"] is None else "%.1f"%(t["peak"]/1024.0**2)
+            lines.append("%-14s %6d %10.3f %10.3f %12s"%(t["stage"], t["count"], t["wall"], t["cpu"], peak))
+        per_layer = {}
+        for r in self.records:
+            if r["layer"] is not None:
+                per_layer[r["layer"]] = per_layer.get(r["layer"], 0.0)+r["wall"]
+        if per_layer:
+            lines.append("slowest layers (wall time of all stages):")
+            for name, wall in sorted(per_layer.items(), key=lambda x: -x[1])[:layers]:
+                lines.append("  %10.3f s  %s"%(wall, name))
+        return "\n".join(lines)
+
+    def to_json(self, path):
+        """! Stores the records and the totals per stage as JSON file. """
+        with open(path, "w") as f:
+            json.dump({"records": self.records, "totals": self.totals()}, f, indent=1)
+
+    def to_csv(self, path):
+        """! Stores the records as CSV file (one line per record, columns FIELDS). """
+        with open(path, "w") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(FIELDS)
+            for r in self.records:
+                writer.writerow(["" if r[k] is None else r[k] for k in FIELDS])
@@ -0,0 +1,395 @@
+import os
+import hashlib
+import collections
+import threading
+import numpy
+from gimpfu_numpy_converter import layer2array
+from anaglyph_algorithm import Anaglyph, alpha_bbox, ext_window, layer_channels
+from depth_algorithm import DepthAlgo
+
+## default size limit of a RenderCache (bytes)
+DEFAULT_CACHE_SIZE = 2*1024**3
+## the minimum number of layers combined into one cached composite (see checkpoint_span)
+MIN_SPAN = 4
+
+class Composite:
+    """! The contribution of one layer or of several consecutive layers to the left and right image.
+
+    For each view the contribution consists of the image c (premultiplied with alpha), the transmittance t
+    and the alpha channel a. Combining the layers back to front (see Anaglyph.update) is the "over" operator:
+    front over back = (c_f+t_f*c_b, t_f*t_b, max(a_f,a_b)). Outside of the visible part (a==0) a
+    contribution is c=0, t=1, a=0; only the bounding box of the visible part is stored.
+    """
+    ## values of the left and right image closer than this to an integer are rounded to it (see to_anaglyph)
+    SNAP = 1e-9
+    def __init__(self, shape, rows=None, cols=None, data=None):
+        """! Creates a composite.
+        @param shape the image size (height, width)
+        @param rows the row slice of the stored window (None = nothing visible)
+        @param cols the column slice of the stored window
+        @param data the stored window: array (2 views x 3 (c,t,a) x rows x cols)
+        """
+        self.shape = tuple(shape)
+        self.rows = rows
+        self.cols = cols
+        self.data = data
+
+    @staticmethod
+    def from_layer(layer_data, d):
+        """! Computes the contribution of a single layer.
+        Only the window of the layer which can become visible is shifted: the rows of the bounding box of its
+        visible part and its columns extended by the disparity (and by one transparent column on each side,
+        the neighbors of the interpolated samples). The result is the same as shifting the whole layer.
+        @param layer_data the layer (as numpy array, e.g. uint8, see Anaglyph.update)
+        @param d the disparity (single value or map) of the layer
+        @return the Composite of the layer
+        """
+        shape = layer_data.shape[:2]
+        w = shape[1]
+        box = alpha_bbox(layer_channels(layer_data)[1])
+        if box is None:
+            return Composite(shape)
+        rows, cols = box
+        if numpy.ndim(d):
+            win = ext_window(w, d[rows], cols)
+            if win is None:
+                return Composite(shape)
+        else:
+            win = slice(cols.start-abs(int(d)), cols.stop+abs(int(d)))
+        win = slice(max(0, min(win.start, cols.start-1)), min(w, max(win.stop, cols.stop+1)))
+        anaglyph = Anaglyph()
+        window = numpy.asarray(layer_data[rows,win], dtype=numpy.float64)
+        if numpy.ndim(d):
+            anaglyph.update_ext(window, d[rows,win])
+        else:
+            anaglyph.update(window, d)
+        box = alpha_bbox(numpy.maximum(anaglyph.aleft, anaglyph.aright))
+        if box is None:
+            return Composite(shape)
+        r, c = box
+        data = numpy.empty((2,3,r.stop-r.start,c.stop-c.start))
+        for view, (im, alpha) in enumerate(((anaglyph.left, anaglyph.aleft), (anaglyph.right, anaglyph.aright))):
+            data[view,0] = im[r,c]
+            data[view,1] = 1-alpha[r,c]/255.0
+            data[view,2] = alpha[r,c]
+        return Composite(shape, slice(rows.start+r.start, rows.start+r.stop), slice(win.start+c.start, win.start+c.stop), data)
+
+    def over(self, below):
+        """! Combines this composite (front) with a composite below (back).
+        @param below the composite behind this one
+        @return the combined Composite
+        """
+        if self.data is None:
+            return below
+        if below.data is None:
+            return self
+        rows = slice(min(self.rows.start, below.rows.start), max(self.rows.stop, below.rows.stop))
+        cols = slice(min(self.cols.start, below.cols.start), max(self.cols.stop, below.cols.stop))
+        data = numpy.zeros((2,3,rows.stop-rows.start,cols.stop-cols.start))
+        data[:,1] = 1
+        for part in (below, self):
+            r = slice(part.rows.start-rows.start, part.rows.stop-rows.start)
+            c = slice(part.cols.start-cols.start, part.cols.stop-cols.start)
+            window = data[:,:,r,c]
+            if part is below:
+                window[...] = part.data
+            else:
+                window[:,0] = part.data[:,0]+part.data[:,1]*window[:,0]
+                window[:,1] *= part.data[:,1]
+                window[:,2] = numpy.maximum(part.data[:,2], window[:,2])
+        return Composite(self.shape, rows, cols, data)
+
+    @staticmethod
+    def combine(parts, shape):
+        """! Combines composites back to front, like over but in place: the parts are added to a single buffer
+        of the image size (one part at a time, e.g. a generator computing the contributions of layers).
+        @param parts iterable of Composite objects, bottom first
+        @param shape the image size (height, width)
+        @return the combined Composite
+        """
+        data = None
+        rows = cols = None
+        for part in parts:
+            if part.data is None:
+                continue
+            if data is None:
+                data = numpy.zeros((2,3)+tuple(shape))
+                data[:,1] = 1
+                rows, cols = part.rows, part.cols
+            else:
+                rows = slice(min(rows.start, part.rows.start), max(rows.stop, part.rows.stop))
+                cols = slice(min(cols.start, part.cols.start), max(cols.stop, part.cols.stop))
+            window = data[:,:,part.rows,part.cols]
+            window[:,0] *= part.data[:,1]
+            window[:,0] += part.data[:,0]
+            window[:,1] *= part.data[:,1]
+            numpy.maximum(window[:,2], part.data[:,2], out=window[:,2])
+        if data is None:
+            return Composite(shape)
+        data = data[:,:,rows,cols]
+        if data.shape[2:] != tuple(shape):
+            data = data.copy()
+        return Composite(shape, rows, cols, data)
+
+    def to_anaglyph(self, f1=1.0, f2=1.0):
+        """! Creates an Anaglyph holding the left and right image of this composite (see Anaglyph.get_result).
+        The values differ from the ones blended layer by layer by rounding errors only: as in FrontToBackAnaglyph.finish,
+        values closer than SNAP to an integer are rounded to it, i.e., the uint8 outputs match the ones of anaglyph_renderer.render.
+        @param f1 the darkening factor for the left image (1.0 = no modification)
+        @param f2 the darkening factor for the right image (1.0 = no modification)
+        @return the Anaglyph
+        """
+        anaglyph = Anaglyph(f1, f2)
+        anaglyph.left  = numpy.zeros(self.shape)
+        anaglyph.right = numpy.zeros(self.shape)
+        anaglyph.aleft  = numpy.zeros(self.shape)
+        anaglyph.aright = numpy.zeros(self.shape)
+        if self.data is not None:
+            anaglyph.left[self.rows,self.cols]   = self.data[0,0]
+            anaglyph.aleft[self.rows,self.cols]  = self.data[0,2]
+            anaglyph.right[self.rows,self.cols]  = self.data[1,0]
+            anaglyph.aright[self.rows,self.cols] = self.data[1,2]
+            for im in (anaglyph.left, anaglyph.right):
+                r = numpy.rint(im)
+                numpy.copyto(im, r, where=numpy.abs(im-r)<self.SNAP)
+        return anaglyph
+
+    def nbytes(self):
+        """! @return the memory needed by the composite (bytes) """
+        return 0 if self.data is None else self.data.nbytes
+
+class RenderCache:
+    """! A cache of Composite objects (see render_cached), kept in memory or stored in a directory.
+    The least recently used entries are removed when the size limit is exceeded.
+    An in-memory cache can be shared by several threads (e.g. the jobs of render_service.RenderService).
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_CACHE_SIZE):
+        """! Creates a cache.
+        @param directory the directory to store the entries (None = keep the entries in memory)
+        @param max_bytes the size limit of the cache (bytes)
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key+".npz")
+
+    def __contains__(self, key):
+        if self.directory is None:
+            with self.lock:
+                return key in self.entries
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """! @return the Composite stored for the key or None """
+        if self.directory is None:
+            with self.lock:
+                c = self.entries.pop(key, None)
+                if c is not None:
+                    self.entries[key] = c
+            return c
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        f = numpy.load(path)
+        try:
+            window = f["window"]
+            if len(window) == 2:
+                c = Composite(window)
+            else:
+                c = Composite(window[:2], slice(window[2],window[3]), slice(window[4],window[5]),
+                              f["data"])
+        finally:
+            f.close()
+        os.utime(path, None)
+        return c
+
+    def composite_bytes(self, shape):
+        """! @return the size of a Composite covering the whole image in the cache (bytes) """
+        return 2*3*shape[0]*shape[1]*8
+
+    def put(self, key, composite, keep=()):
+        """! Stores a Composite (on disk as float64: float32 rounding errors would change the uint8 outputs, see Composite.to_anaglyph).
+        @param key the key of the composite
+        @param composite the Composite
+        @param keep the keys of entries which must not be removed to make room for it (see prune)
+        """
+        if self.directory is None:
+            with self.lock:
+                self.entries.pop(key, None)
+                self.entries[key] = composite
+        else:
+            window = list(composite.shape)
+            data = numpy.zeros(0)
+            if composite.data is not None:
+                window += [composite.rows.start, composite.rows.stop, composite.cols.start, composite.cols.stop]
+                data = numpy.asarray(composite.data, dtype=numpy.float64)
+            tmp = self._path(key)+".tmp.npz"
+            numpy.savez(tmp, window=numpy.array(window), data=data)
+            os.rename(tmp, self._path(key))
+        self.prune(keep)
+
+    def prune(self, keep=()):
+        """! Removes the least recently used entries until the cache fits into max_bytes.
+        @param keep the keys of entries which are not removed (e.g. the composites of the current render)
+        """
+        if self.directory is None:
+            with self.lock:
+                size = sum(c.nbytes() for c in self.entries.values())
+                for key in list(self.entries):
+                    if size <= self.max_bytes:
+                        break
+                    if key not in keep:
+                        size -= self.entries.pop(key).nbytes()
+        else:
+            prune_directory(self.directory, self.max_bytes, ".npz", [self._path(key) for key in keep])
+
+def prune_directory(directory, max_bytes, ext, keep=()):
+    """! Removes the least recently used files (oldest modification time) of a cache directory until it fits into max_bytes.
+    @param directory the directory
+    @param max_bytes the size limit (bytes)
+    @param ext the extension of the cache files (other files are ignored)
+    @param keep the paths of files which are not removed
+    """
+    files = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(ext)]
+    files = sorted((os.path.getmtime(f), os.path.getsize(f), f) for f in files)
+    size = sum(s for _, s, _ in files)
+    keep = set(os.path.abspath(f) for f in keep)
+    for _, s, f in files:
+        if size <= max_bytes:
+            break
+        if os.path.abspath(f) in keep:
+            continue
+        os.remove(f)
+        size -= s
+
+def content_hash(*parts):
+    """! @return a key (hex string) identifying the parts (numpy arrays by shape and content, other values by str) """
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, numpy.ndarray):
+            h.update(str(part.shape).encode("ascii"))
+            h.update(numpy.ascontiguousarray(part))
+        else:
+            h.update(str(part).encode("utf-8"))
+    return h.hexdigest()
+
+def layer_key(layer_data, d):
+    """! Computes the cache key of a layer contribution.
+    @param layer_data the layer (as numpy array)
+    @param d the disparity (single value or map) of the layer
+    @return the key (content hash of the layer and the disparity)
+    """
+    return content_hash("layer", layer_data, d if numpy.ndim(d) else float(d))
+
+def checkpoint_span(n, shape, cache):
+    """! Determines the number of layers per cached composite (see combine_cached).
+    @param n the number of layers
+    @param shape the image size (height, width)
+    @param cache the RenderCache
+    @return the span: at least MIN_SPAN layers, and the composites of a render (the spans, the result and the
+            spans below and above the changed spans) fit into the cache
+    """
+    count = max(1, cache.max_bytes//cache.composite_bytes(shape)-3)
+    return max(MIN_SPAN, -(-n//count))
+
+def combine_cached(layers, shape, cache, progress=None, verbose=False):
+    """! Combines layer contributions back to front, reusing the composites stored in a cache.
+
+    The layers are split into spans of consecutive layers (bottom layer first, see checkpoint_span). The cache
+    holds the composite of each span (keyed by the keys of its layers) and the composite of all layers. If the
+    same layers are combined again, only the final composite is loaded. Otherwise the spans from the first to
+    the last span which is not cached are combined: their layers are loaded and shifted, one at a time (cached
+    spans in between are loaded). The spans below and above are combined once and stored as a whole, i.e., if
+    the same layer is edited again, the result is the composite above over the span of the layer over the
+    composite below. Storing the composites of a render never removes the other composites of the same render.
+    @param layers list of (key, load) per layer, bottom layer first: the key of the layer contribution (see layer_key)
+           and a function returning the layer data (e.g. uint8, see Composite.from_layer) and the disparity (single value or map)
+    @param shape the image size (height, width)
+    @param cache the RenderCache
+    @param progress optional function called with the progress (0..1)
+    @param verbose if true the cache usage is printed
+    @return the Composite of all layers
+    """
+    n = len(layers)
+    if n == 0:
+        return Composite(shape)
+    span = checkpoint_span(n, shape, cache)
+    spans = [layers[i:i+span] for i in range(0, n, span)]
+    keys = [content_hash("span", *[key for key, load in s]) for s in spans]
+    def group_key(first, last):
+        # the key of the composite of the spans first..last-1
+        return keys[first] if last-first == 1 else content_hash("spans", *keys[first:last])
+    m = len(spans)
+    key = group_key(0, m)
+    result = cache.get(key)
+    if result is not None:
+        if verbose:
+            print("cache: complete result found")
+        return result
+
+    # the changed spans first..last-1 (all spans if only the result is missing)
+    changed = [i for i, k in enumerate(keys) if k not in cache]
+    first, last = (changed[0], changed[-1]+1) if changed else (0, m)
+    keep = set(keys+[key, group_key(0, first) if first>0 else key, group_key(last, m) if last<m else key])
+    def span_composite(i):
+        c = cache.get(keys[i])
+        if c is None:
+            if verbose:
+                print("cache: layers %d..%d of %d to be combined"%(i*span, i*span+len(spans[i])-1, n))
+            c = Composite.combine((Composite.from_layer(*load()) for _, load in spans[i]), shape)
+            cache.put(keys[i], c, keep)
+        return c
+    def group(first, last):
+        # the composite of the spans first..last-1 (stored as a whole)
+        k = group_key(first, last)
+        c = cache.get(k)
+        if c is None:
+            c = Composite.combine((span_composite(i) for i in range(first, last)), shape)
+            cache.put(k, c, keep)
+        return c
+    def parts():
+        # bottom first, one at a time
+        if first>0:
+            yield group(0, first)
+        for i in range(first, last):
+            yield span_composite(i)
+            if progress is not None:
+                progress(float(i+1-first)/float(last-first))
+        if last<m:
+            yield group(last, m)
+    result = Composite.combine(parts(), shape)
+    if m>1:
+        cache.put(key, result, keep)
+    return result
+
+def render_cached(image, mindisp, maxdisp, f1, f2, cache, progress=None, verbose=False):
+    """! Combines the layers of an image like anaglyph_renderer.render, reusing cached results (see combine_cached).
+    The parameters f1, f2 and swap_lr only affect Anaglyph.get_result: changing them reuses the complete result.
+    Each layer is read (uint8) to compute its key, the data is not kept: the layers of the spans which are not
+    available in the cache are read again when they are shifted, one at a time.
+    @param image the image to be processed (layers, top most layer first)
+    @param mindisp the minimum disparity (percent of the image width, near)
+    @param maxdisp the maximum disparity (percent of the image width, far)
+    @param f1 the darkening factor for the left image (1.0 = no modification)
+    @param f2 the darkening factor for the right image (1.0 = no modification)
+    @param cache the RenderCache
+    @param progress optional function called with the progress (0..1)
+    @param verbose if true the cache usage is printed
+    @return the Anaglyph object holding the left and right image (see Anaglyph.get_result)
+    """
+    depthalgo = DepthAlgo(image, mindisp, maxdisp)
+    def loader(entry):
+        def load():
+            return layer2array(entry.layer), depthalgo.disparity(entry)
+        return load
+    layers = [(layer_key(layer2array(entry.layer), depthalgo.disparity(entry)), loader(entry)) for entry in depthalgo.layers()]
+    try:
+        result = combine_cached(layers, (image.height, image.width), cache, progress, verbose)
+    finally:
+        depthalgo.close()
+    return result.to_anaglyph(f1, f2)
@@ -0,0 +1,125 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy
+try:
+    from urllib.request import urlopen, Request
+    from urllib.error import URLError, HTTPError
+except ImportError:
+    from urllib2 import urlopen, Request, URLError, HTTPError
+from layer_stack import save_npz
+
+## the default address of the render service (see render_service.py)
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+## the longest time a single status request waits for a job (seconds, see wait)
+POLL_SECONDS = 30
+
+## the file holding the token of the running render service (written by render_service.serve, readable by the user only)
+DEFAULT_TOKEN_FILE = os.path.join(os.path.expanduser("~"), ".create_anaglyph_service_token")
+## the HTTP header carrying the token
+TOKEN_HEADER = "X-Render-Token"
+
+class ServiceError(Exception):
+    """! A job failed or the render service could not handle a request. """
+    pass
+
+def read_token(path=None):
+    """! @return the token of the render service (see render_service.write_token), raises ServiceError if there is none
+    @param path the token file (None = DEFAULT_TOKEN_FILE)
+    """
+    path = path or DEFAULT_TOKEN_FILE
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        raise ServiceError("no render service token (%s), is the service running?"%(path))
+
+def _request(url, path, data=None, timeout=None, token=None):
+    """! Sends a request to the render service.
+    @param url the address of the service
+    @param path the path of the request (e.g. "/status")
+    @param data optional dict sent as JSON (POST request), None = GET request
+    @param timeout optional timeout of the connection (seconds)
+    @param token the token of the service (None = read from DEFAULT_TOKEN_FILE)
+    @return the reply (dict)
+    """
+    body = None if data is None else json.dumps(data).encode("utf-8")
+    headers = {"Content-Type": "application/json", TOKEN_HEADER: token or read_token()}
+    request = Request(url.rstrip("/")+path, body, headers)
+    try:
+        reply = urlopen(request, timeout=timeout) if timeout is not None else urlopen(request)
+    except HTTPError as e:
+        try:
+            message = json.loads(e.read().decode("utf-8")).get("error", str(e))
+        except ValueError:
+            message = str(e)
+        raise ServiceError(message)
+    try:
+        return json.loads(reply.read().decode("utf-8"))
+    finally:
+        reply.close()
+
+def service_available(url=DEFAULT_URL, timeout=0.5, token=None):
+    """! @return true if a render service answers at url (token: see _request) """
+    try:
+        _request(url, "/status", timeout=timeout, token=token)
+    except (URLError, ServiceError, IOError, ValueError):
+        return False
+    return True
+
+def submit(stack, outputs, params=None, url=DEFAULT_URL, token=None):
+    """! Submits a job to the render service.
+    @param stack the path of the layer stack (see layer_stack.load_stack), readable by the service
+    @param outputs list of (output format, output path) (see batch_anaglyph.render_stack), writable by the service
+    @param params optional dict of parameters (see batch_anaglyph.DEFAULT_PARAMS; "cache": true reuses cached results)
+    @param url the address of the service
+    @param token the token of the service (None = read from DEFAULT_TOKEN_FILE)
+    @return the id of the job
+    """
+    job = {"stack": os.path.abspath(stack),
+           "outputs": [[fmt, os.path.abspath(output)] for fmt, output in outputs],
+           "params": params or {}}
+    return _request(url, "/jobs", job, token=token)["id"]
+
+def wait(job_id, url=DEFAULT_URL, timeout=None, token=None):
+    """! Waits for a job of the render service.
+    @param job_id the id of the job (see submit)
+    @param url the address of the service
+    @param timeout max. waiting time (seconds, None = no limit)
+    @param token the token of the service (None = read from DEFAULT_TOKEN_FILE)
+    @return the job description (dict with id, state, outputs, ...), raises ServiceError if the job failed
+    """
+    waited = 0
+    while True:
+        seconds = POLL_SECONDS if timeout is None else min(POLL_SECONDS, max(timeout-waited, 0))
+        job = _request(url, "/jobs/%s?wait=%g"%(job_id, seconds), token=token)
+        if job["state"] == "failed":
+            raise ServiceError("job %s failed: %s"%(job_id, job["error"]))
+        if job["state"] == "done":
+            return job
+        waited += seconds
+        if timeout is not None and waited >= timeout:
+            raise ServiceError("job %s not finished after %g s"%(job_id, timeout))
+
+def render_remote(image, formats, params=None, url=DEFAULT_URL, token=None):
+    """! Renders an image with the render service (e.g. from the gimp plugin).
+    The layers are stored in a temporary uncompressed .npz file, the outputs are returned as .npy files and loaded.
+    @param image the image (gimp image or layer_stack.ArrayImage, top most layer first)
+    @param formats the output formats (see stereo_output.FORMATS)
+    @param params optional dict of parameters (see submit)
+    @param url the address of the service
+    @param token the token of the service (None = read from DEFAULT_TOKEN_FILE)
+    @return dict format -> output (uint8)
+    """
+    directory = tempfile.mkdtemp(prefix="create_anaglyph_")
+    try:
+        stack = os.path.join(directory, "stack.npz")
+        save_npz(image, stack)
+        outputs = [(fmt, os.path.join(directory, fmt+".npy")) for fmt in formats]
+        token = token or read_token()
+        wait(submit(stack, outputs, params, url, token), url, token=token)
+        return dict((fmt, numpy.load(output)) for fmt, output in outputs)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
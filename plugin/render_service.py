@@ -0,0 +1,413 @@
+#! /usr/bin/env python
+"""! A long running local render service: renders layer stacks submitted over HTTP (localhost).
+
+Usage:
+    python render_service.py [--port <port>] [--workers <n>] [--memory-budget <MB>] [--token-file <path>]
+
+The service keeps numpy imported, the loaded layer stacks (StackCache) and the combined layers of previous
+jobs (render_cache.RenderCache, in memory) between jobs. The depth maps are parsed again by each job (one read
+of each map layer, see depth_algorithm.DepthMapStore). The jobs are queued and rendered by a pool of worker
+threads; a job only starts if its estimated memory (see estimate_memory, including its layer stack) fits into the
+memory budget next to the running jobs (a job larger than the budget runs alone).
+
+Protocol (JSON, see render_client.py):
+ * POST /jobs {"stack": <path>, "outputs": [[<format>, <path>], ...], "params": {...}} -> {"id": <job id>}
+   The parameters are those of batch_anaglyph.DEFAULT_PARAMS, "cache": true reuses the combined layers of previous jobs.
+ * GET /jobs/<id>[?wait=<seconds>] -> the job (id, state queued/running/done/failed, outputs, error, times);
+   a job stays queued until its memory is reserved;
+   with wait, the reply is sent when the job is finished or after the given time.
+ * GET /status -> the state of the service (jobs, memory, caches).
+The stack and output paths are files of the machine running the service.
+
+Every request must send the token of the service in the header X-Render-Token. The service creates a new random
+token when it starts and writes it to a file readable by the user only (default: render_client.DEFAULT_TOKEN_FILE),
+where the clients of the same user read it. Requests with an Origin header (sent by web browsers) are rejected and
+POST requests must have the Content-Type application/json, i.e., web pages cannot submit jobs.
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import binascii
+import argparse
+import threading
+import collections
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+import numpy
+from layer_stack import load_stack, stack_info
+from anaglyph_algorithm import Anaglyph
+from depth_algorithm import DepthAlgo, DEPTH_MAP
+from render_cache import RenderCache, DEFAULT_CACHE_SIZE
+from stereo_output import FORMATS, output_shape
+from batch_anaglyph import DEFAULT_PARAMS, ALGORITHMS, job_algorithm, render_stack
+from color_anaglyph import MATRICES
+from render_client import DEFAULT_TOKEN_FILE, TOKEN_HEADER
+
+## the default port of the service (see render_client.DEFAULT_URL)
+DEFAULT_PORT = 8765
+## the default memory budget of the running jobs (bytes)
+DEFAULT_MEMORY_BUDGET = 2*1024**3
+## the default size limit of the loaded layer stacks kept between jobs (bytes)
+DEFAULT_STACK_CACHE_SIZE = 1024**3
+## the number of finished jobs kept for status requests
+FINISHED_JOBS = 1000
+## the longest time a status request waits for a job (seconds)
+MAX_WAIT = 60
+
+## the states of a job
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+def _stamp(path):
+    """! @return the modification time of a layer stack (for a directory: the latest of its files) """
+    stamp = os.path.getmtime(path)
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            stamp = max(stamp, os.path.getmtime(os.path.join(path, name)))
+    return stamp
+
+class StackCache:
+    """! The loaded layer stacks (layer_stack.ArrayImage), keyed by path, modification time and color mode.
+    The least recently used stacks are removed when the size limit is exceeded, stacks deleted from disk when
+    another stack is loaded (memory mapped .npy layers are not counted). Can be used by several threads.
+    """
+    def __init__(self, max_bytes=DEFAULT_STACK_CACHE_SIZE):
+        """! Creates a cache.
+        @param max_bytes the size limit (bytes)
+        """
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def nbytes(image):
+        """! @return the memory needed by the layers of a stack (bytes, without memory mapped layers; an ArrayImage
+        of ArrayLayer or layer_stack.LayerInfo objects)
+        """
+        return sum(layer.nbytes for layer in image.layers)
+
+    def get(self, path, color=False):
+        """! @return the layer stack (loaded if not cached or modified, see layer_stack.load_stack) """
+        key = (os.path.abspath(path), _stamp(path), color)
+        with self.lock:
+            image = self.entries.pop(key, None)
+            if image is not None:
+                self.entries[key] = image
+                return image
+        image = load_stack(path, color)
+        with self.lock:
+            # stacks deleted in the meantime (e.g. temporary files of render_client.render_remote) are not needed anymore
+            for k in [k for k in self.entries if not os.path.exists(k[0])]:
+                del self.entries[k]
+            self.entries[key] = image
+            size = sum(self.nbytes(i) for i in self.entries.values())
+            while size > self.max_bytes and len(self.entries) > 1:
+                key, i = self.entries.popitem(last=False)
+                size -= self.nbytes(i)
+        return image
+
+def estimate_memory(image, formats, params):
+    """! Estimates the memory needed to render a layer stack (see batch_anaglyph.render_stack), without the stack itself.
+    @param image the layer stack (loaded or its layer_stack.stack_info)
+    @param formats the output formats
+    @param params the parameters (see batch_anaglyph.DEFAULT_PARAMS, "cache")
+    @return the memory (bytes)
+    """
+    algorithm = job_algorithm(params)
+    channels = algorithm.channels
+    h, w = image.height, image.width
+    memory = sum(int(numpy.prod(output_shape(fmt, h, w, channels))) for fmt in formats)
+    if params.get("cache") and algorithm is Anaglyph:
+        # composites (2 views x (c,t,a), float64, see render_cache.combine_cached): the result, a group of spans,
+        # a span and the contribution of a layer being combined; the layer (float64) and its shifted views
+        return memory+(4*2*3+2+4)*8*h*w
+    # per band: the layers read ahead, the left/right images and alpha channels (float64), temporaries
+    band = min(params["band_height"], h)
+    layers = (params["prefetch"]+2)*band*w*4*8
+    views = band*w*(2*channels+2)*8
+    memory += params["threads"]*(layers+2*views)
+    # the depth maps (float32, see depth_algorithm.DepthMapStore)
+    depthalgo = DepthAlgo(image, 0, 0)
+    memory += sum(1 for entry in depthalgo.plan if entry.kind == DEPTH_MAP)*h*w*4
+    depthalgo.close()
+    return memory
+
+class Job:
+    """! A render job of the service: a layer stack rendered into output files (see batch_anaglyph.render_stack). """
+    def __init__(self, job_id, stack, paths, params):
+        self.id = job_id
+        self.stack = stack
+        self.paths = paths
+        self.params = params
+        self.state = QUEUED
+        self.error = None
+        self.memory = 0
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        """! @return the description of the job (see the module documentation) """
+        return {"id": self.id, "state": self.state, "stack": self.stack, "outputs": [output for fmt, output in self.paths],
+                "error": self.error, "memory": self.memory, "submitted": self.submitted, "started": self.started,
+                "finished": self.finished}
+
+class RenderService:
+    """! The job queue and the worker pool of the render service (usable without HTTP, see serve). """
+    def __init__(self, workers=2, memory_budget=DEFAULT_MEMORY_BUDGET, stack_cache_bytes=DEFAULT_STACK_CACHE_SIZE,
+                 cache_bytes=DEFAULT_CACHE_SIZE):
+        """! Creates the service and starts the workers.
+        @param workers the number of jobs rendered concurrently
+        @param memory_budget the memory available for the running jobs (bytes, see estimate_memory)
+        @param stack_cache_bytes the size limit of the loaded layer stacks (see StackCache)
+        @param cache_bytes the size limit of the combined layers kept for jobs with "cache" (see render_cache.RenderCache)
+        """
+        self.memory_budget = memory_budget
+        self.memory = 0
+        self.stacks = StackCache(stack_cache_bytes)
+        self.cache = RenderCache(max_bytes=cache_bytes)
+        self.jobs = collections.OrderedDict()
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.closing = False
+        self.next_id = 1
+        self.workers = [threading.Thread(target=self._work) for i in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, stack, paths, params=None):
+        """! Queues a job.
+        @param stack the path of the layer stack (see layer_stack.load_stack)
+        @param paths list of (output format, output path)
+        @param params optional dict of parameters (see batch_anaglyph.DEFAULT_PARAMS; "cache": reuse combined layers)
+        @return the Job (raises ValueError for invalid jobs)
+        """
+        p = dict(DEFAULT_PARAMS)
+        p["cache"] = False
+        for key, value in (params or {}).items():
+            if key not in p:
+                raise ValueError("unknown parameter: %s"%(key))
+            p[key] = value
+        if p["algorithm"] not in ALGORITHMS:
+            raise ValueError("unknown algorithm: %s"%(p["algorithm"]))
+        if p["color"] is not None and p["color"] not in MATRICES:
+            raise ValueError("unknown color matrices: %s"%(p["color"]))
+        if not os.path.exists(stack):
+            raise ValueError("layer stack not found: %s"%(stack))
+        paths = [(fmt, output) for fmt, output in paths]
+        if not paths:
+            raise ValueError("no outputs")
+        for fmt, output in paths:
+            if fmt not in FORMATS:
+                raise ValueError("unknown output format: %s"%(fmt))
+        with self.condition:
+            job = Job(str(self.next_id), stack, paths, p)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            self.condition.notify_all()
+        return job
+
+    def job(self, job_id):
+        """! @return the Job with the given id or None """
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def status(self):
+        """! @return the state of the service (dict) """
+        with self.condition:
+            states = collections.Counter(job.state for job in self.jobs.values())
+            return {"workers": len(self.workers), "queued": states[QUEUED], "running": states[RUNNING],
+                    "done": states[DONE], "failed": states[FAILED], "memory": self.memory,
+                    "memory_budget": self.memory_budget, "stacks": len(self.stacks.entries),
+                    "cache_entries": len(self.cache.entries)}
+
+    def close(self):
+        """! Stops the workers (after their current job; queued jobs are not rendered). """
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closing:
+                    self.condition.wait()
+                if self.closing:
+                    return
+                job = self.queue.popleft()
+            self._run(job)
+
+    def _run(self, job):
+        reserved = False
+        try:
+            # the estimate is based on the file headers: the stack is loaded after the memory is reserved
+            color = job.params["color"] is not None
+            info = stack_info(job.stack, color)
+            job.memory = StackCache.nbytes(info)+estimate_memory(info, [fmt for fmt, output in job.paths], job.params)
+            # wait until the job fits into the memory budget (a job larger than the budget runs alone)
+            with self.condition:
+                while self.memory > 0 and self.memory+job.memory > self.memory_budget and not self.closing:
+                    self.condition.wait()
+                self.memory += job.memory
+                reserved = True
+                job.state = RUNNING
+            image = self.stacks.get(job.stack, color)
+            job.started = time.time()
+            render_stack(image, job.paths, job.params, cache=self.cache if job.params["cache"] else None)
+            job.state = DONE
+        except Exception as e:
+            job.state = FAILED
+            job.error = "%s: %s"%(type(e).__name__, e)
+        job.finished = time.time()
+        with self.condition:
+            if reserved:
+                self.memory -= job.memory
+            # keep the latest finished jobs only
+            finished = [j for j in self.jobs.values() if j.state in (DONE, FAILED)]
+            for j in finished[:max(0, len(finished)-FINISHED_JOBS)]:
+                del self.jobs[j.id]
+            self.condition.notify_all()
+        job.done.set()
+
+def write_token(path):
+    """! Creates a new random token and writes it to a file readable by the user only (an existing file is replaced).
+    @param path the token file
+    @return the token
+    """
+    token = binascii.hexlify(os.urandom(16)).decode("ascii")
+    if os.path.lexists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0o600)
+    try:
+        os.write(fd, token.encode("ascii"))
+    finally:
+        os.close(fd)
+    return token
+
+class _Handler(BaseHTTPRequestHandler):
+    """! The HTTP requests of the service (see the module documentation). """
+    def _reply(self, code, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        """! Checks the token and the origin of a request (a reply is sent if the request is rejected).
+        @return true if the request may be handled
+        """
+        if self.headers.get("Origin") is not None:
+            self._reply(403, {"error": "cross-origin requests are not allowed"})
+            return False
+        token = self.headers.get(TOKEN_HEADER, "")
+        if not hmac.compare_digest(token.encode("utf-8"), self.server.token.encode("utf-8")):
+            self._reply(403, {"error": "missing or wrong token (see %s)"%(TOKEN_HEADER)})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        url = urlparse(self.path)
+        service = self.server.service
+        if url.path == "/status":
+            self._reply(200, service.status())
+            return
+        parts = url.path.strip("/").split("/")
+        job = service.job(parts[1]) if len(parts) == 2 and parts[0] == "jobs" else None
+        if job is None:
+            self._reply(404, {"error": "not found: %s"%(url.path)})
+            return
+        wait = parse_qs(url.query).get("wait")
+        if wait:
+            try:
+                seconds = float(wait[0])
+            except ValueError:
+                self._reply(400, {"error": "invalid wait: %s"%(wait[0])})
+                return
+            job.done.wait(min(max(seconds, 0), MAX_WAIT))
+        self._reply(200, job.to_dict())
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if urlparse(self.path).path != "/jobs":
+            self._reply(404, {"error": "not found: %s"%(self.path)})
+            return
+        if self.headers.get("Content-Type", "").split(";")[0].strip().lower() != "application/json":
+            self._reply(415, {"error": "the Content-Type must be application/json"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            job = self.server.service.submit(request["stack"], request["outputs"], request.get("params"))
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": "%s: %s"%(type(e).__name__, e)})
+            return
+        self._reply(202, {"id": job.id})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(port=DEFAULT_PORT, host="127.0.0.1", verbose=False, token_file=DEFAULT_TOKEN_FILE, **params):
+    """! Runs the render service until interrupted.
+    @param port the port
+    @param host the address to listen on (default: localhost only)
+    @param verbose if true the requests are logged
+    @param token_file the file receiving the token of the service (see write_token; removed when the service stops)
+    @param params the parameters of RenderService (workers, memory_budget, stack_cache_bytes, cache_bytes)
+    """
+    server = _Server((host, port), _Handler)
+    server.token = write_token(token_file)
+    server.service = RenderService(**params)
+    server.verbose = verbose
+    print("render service listening on http://%s:%d (token: %s)"%(host, server.server_address[1], token_file))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.close()
+        if os.path.exists(token_file):
+            os.remove(token_file)
+
+def main(argv=None):
+    """! Command line entry point. """
+    parser = argparse.ArgumentParser(description="Local render service for anaglyphs (jobs submitted over HTTP).")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port (default: %d)"%(DEFAULT_PORT))
+    parser.add_argument("-w", "--workers", type=int, default=2, help="jobs rendered concurrently (default: 2)")
+    parser.add_argument("--memory-budget", type=int, default=DEFAULT_MEMORY_BUDGET//1024**2,
+                        help="memory of the running jobs in MB (default: %d)"%(DEFAULT_MEMORY_BUDGET//1024**2))
+    parser.add_argument("--stack-cache", type=int, default=DEFAULT_STACK_CACHE_SIZE//1024**2,
+                        help="memory of the loaded layer stacks kept between jobs in MB (default: %d)"%(DEFAULT_STACK_CACHE_SIZE//1024**2))
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE//1024**2,
+                        help="memory of the combined layers kept for jobs with \"cache\" in MB (default: %d)"%(DEFAULT_CACHE_SIZE//1024**2))
+    parser.add_argument("--token-file", default=DEFAULT_TOKEN_FILE,
+                        help="file receiving the token of the service (default: %s)"%(DEFAULT_TOKEN_FILE))
+    parser.add_argument("-v", "--verbose", action="store_true", help="log the requests")
+    args = parser.parse_args(argv)
+    serve(args.port, args.host, args.verbose, args.token_file, workers=args.workers, memory_budget=args.memory_budget*1024**2,
+          stack_cache_bytes=args.stack_cache*1024**2, cache_bytes=args.cache_size*1024**2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
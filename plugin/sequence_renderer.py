@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+"""! Renders stereo animations: a sequence of frames, each a layer stack, reusing the unchanged layers.
+
+Usage:
+    python sequence_renderer.py [options] <sequence.json>
+
+The sequence file lists the frames in order:
+    {"frames": [{"stack": "scene.npz"},
+                {"stack": "scene.npz", "offsets": {"car": [4, 0]}, "depths": {"car": 0.45}},
+                ...]}
+"stack" is a layer stack (see layer_stack.load_stack, relative to the sequence file), "offsets" moves layers
+(dx, dy in pixels) and "depths" sets the depth of layers (0.0=nearest layer, 1.0=farthest layer), both by layer name.
+Consecutive frames of the same stack share the loaded stack. The frames are written one by one as
+<outdir>/<sequence name>_<format>_<frame number>.<ext>.
+"""
+import os
+import sys
+import json
+import argparse
+import numpy
+from gimpfu_numpy_converter import layer2array
+from anaglyph_algorithm import overlap
+from depth_algorithm import DepthAlgo
+from render_cache import RenderCache, combine_cached, layer_key, DEFAULT_CACHE_SIZE
+from stereo_output import ANAGLYPH, FORMATS, allocate_outputs, write_outputs
+from layer_stack import load_stack, save_array
+from color_anaglyph import is_color_image
+
+def translate(data, dx, dy):
+    """! Moves a layer (the uncovered part is transparent).
+    @param data the layer (height x width x channels)
+    @param dx the shift to the right (pixels)
+    @param dy the shift downwards (pixels)
+    @return the moved layer (data itself if dx==dy==0)
+    """
+    if dx == 0 and dy == 0:
+        return data
+    h, w = data.shape[0], data.shape[1]
+    res = numpy.zeros_like(data)
+    cols = overlap(w, int(dx))
+    rows = overlap(h, int(dy))
+    if cols is not None and rows is not None:
+        res[rows[0],cols[0]] = data[rows[1],cols[1]]
+    return res
+
+class Frame:
+    """! A frame of a stereo animation: a layer stack and changes of single layers (see render_sequence).
+    The frames of an animation typically share the layer stack (or most of its layers) and move layers
+    or change their depth.
+    """
+    def __init__(self, image, offsets=None, depths=None):
+        """! Creates a frame.
+        @param image the layer stack (gimp image or layer_stack.ArrayImage, top most layer first)
+        @param offsets optional dict layer name -> (dx, dy): the layer is moved by dx, dy pixels (a depth map stays in place)
+        @param depths optional dict layer name -> depth (0.0=nearest layer, 1.0=farthest layer, see DepthAlgo.set_depth)
+        """
+        self.image = image
+        self.offsets = offsets or {}
+        self.depths = depths or {}
+
+    def layer_data(self, layer, dtype=None):
+        """! @return the data of a layer of the frame (moved according to offsets) """
+        data = layer2array(layer, dtype=dtype)
+        dx, dy = self.offsets.get(layer.name, (0, 0))
+        return translate(data, dx, dy)
+
+def render_sequence(frames, mindisp, maxdisp, f1=1.0, f2=1.0, swap_lr=False, formats=(ANAGLYPH,), cache=None, verbose=False):
+    """! Renders the frames of a stereo animation one by one (a generator: only the current frame is held in memory).
+
+    The composites of spans of consecutive layers (the shifted layers combined, see render_cache.combine_cached)
+    are kept in an in-memory RenderCache, keyed by the content of the layers and their disparities. A layer which
+    did not change since the previous frames (same data, same position, same depth) is detected by its key:
+    if only a few layers change from frame to frame, a frame costs reading the layers once (to compute the keys)
+    and shifting the layers of the spans with changed layers; the unchanged spans are not combined again.
+    Only gray level layers are supported (as for the render cache).
+    @param frames iterable of Frame objects (e.g. a generator loading the frames on demand)
+    @param mindisp the minimum disparity (percent of the image width, near)
+    @param maxdisp the maximum disparity (percent of the image width, far)
+    @param f1 the darkening factor for the left image (1.0 = no modification)
+    @param f2 the darkening factor for the right image (1.0 = no modification)
+    @param swap_lr if true the left and right image are swapped.
+    @param formats the output formats (see stereo_output.FORMATS)
+    @param cache the RenderCache (default: a new in-memory cache, DEFAULT_CACHE_SIZE)
+    @param verbose if true the cache usage is printed per frame
+    @return generator of dicts format -> output (uint8) per frame
+    """
+    if cache is None:
+        cache = RenderCache()
+    for frame in frames:
+        image = frame.image
+        if is_color_image(image):
+            raise ValueError("sequences of color (RGB) layer stacks are not supported")
+        depthalgo = DepthAlgo(image, mindisp, maxdisp)
+        try:
+            for entry in depthalgo.plan:
+                if entry.layer.name in frame.depths:
+                    depthalgo.set_depth(entry, frame.depths[entry.layer.name])
+            def loader(entry):
+                def load():
+                    # the data is read again when the layer is shifted (see render_cache.render_cached)
+                    return frame.layer_data(entry.layer), depthalgo.disparity(entry)
+                return load
+            layers = [(layer_key(frame.layer_data(entry.layer), depthalgo.disparity(entry)), loader(entry))
+                      for entry in depthalgo.layers()]
+            composite = combine_cached(layers, (image.height, image.width), cache, verbose=verbose)
+        finally:
+            depthalgo.close()
+        outputs = allocate_outputs(formats, image.height, image.width)
+        write_outputs(composite.to_anaglyph(f1, f2), outputs, 0, swap_lr)
+        yield outputs
+
+def load_sequence(path):
+    """! Reads a sequence file (see the module documentation).
+    @param path the sequence file (JSON)
+    @return generator of Frame objects; the layer stacks are loaded on demand (consecutive frames share the stack)
+    """
+    with open(path) as f:
+        description = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    stack = None
+    image = None
+    for item in description["frames"]:
+        if item["stack"] != stack:
+            stack = item["stack"]
+            # release the previous stack before the next one is loaded
+            image = None
+            image = load_stack(os.path.join(base, stack))
+        offsets = dict((name, tuple(offset)) for name, offset in item.get("offsets", {}).items())
+        yield Frame(image, offsets, item.get("depths"))
+
+def write_sequence(frames, outdir, name, ext=".png", formats=(ANAGLYPH,), **params):
+    """! Renders the frames of a stereo animation (see render_sequence) and stores each frame as soon as it is rendered.
+    @param frames iterable of Frame objects
+    @param outdir the output directory
+    @param name the name of the sequence (prefix of the output files)
+    @param ext the output file extension
+    @param formats the output formats (see stereo_output.FORMATS)
+    @param params the parameters of render_sequence (mindisp, maxdisp, f1, f2, swap_lr, cache, verbose)
+    @return generator of the output paths
+    """
+    p = dict(mindisp=0.0, maxdisp=2.0, f1=1.0, f2=0.8)
+    p.update(params)
+    for number, outputs in enumerate(render_sequence(frames, formats=formats, **p)):
+        for fmt in formats:
+            output = os.path.join(outdir, "%s_%s_%04d%s"%(name, fmt, number, ext))
+            save_array(outputs[fmt], output)
+            yield output
+
+def main(argv=None):
+    """! Command line entry point. """
+    parser = argparse.ArgumentParser(description="Render a stereo animation from a sequence of layer stacks (without gimp).")
+    parser.add_argument("sequence", help="sequence file (JSON, see sequence_renderer.py)")
+    parser.add_argument("-o", "--outdir", default=None, help="output directory (default: next to the sequence file)")
+    parser.add_argument("--format", default="png", help="output file format, e.g. png, tif or npy (default: png)")
+    parser.add_argument("--mindisp", type=float, default=0.0, help="min disparity, percent width (near)")
+    parser.add_argument("--maxdisp", type=float, default=2.0, help="max disparity, percent width (far)")
+    parser.add_argument("--left-factor", dest="f1", type=float, default=1.0, help="luminance correction left (0.0..1.0)")
+    parser.add_argument("--right-factor", dest="f2", type=float, default=0.8, help="luminance correction right (0.0..1.0)")
+    parser.add_argument("--swap-lr", action="store_true", help="swap left/right")
+    parser.add_argument("--outputs", default=ANAGLYPH,
+                        help="comma separated output formats: %s (default: %s)"%(", ".join(FORMATS), ANAGLYPH))
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE//1024**2,
+                        help="memory for the reused layer composites in MB (default: %d)"%(DEFAULT_CACHE_SIZE//1024**2))
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the cache usage per frame")
+    args = parser.parse_args(argv)
+    formats = [fmt.strip() for fmt in args.outputs.split(",") if fmt.strip()]
+    for fmt in formats:
+        if fmt not in FORMATS:
+            parser.error("unknown output format: %s"%(fmt))
+    outdir = args.outdir or os.path.dirname(os.path.abspath(args.sequence))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    name = os.path.splitext(os.path.basename(args.sequence))[0]
+    for output in write_sequence(load_sequence(args.sequence), outdir, name, "."+args.format, formats,
+                                 mindisp=args.mindisp, maxdisp=args.maxdisp, f1=args.f1, f2=args.f2, swap_lr=args.swap_lr,
+                                 cache=RenderCache(max_bytes=args.cache_size*1024**2), verbose=args.verbose):
+        print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
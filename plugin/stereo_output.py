@@ -0,0 +1,101 @@
+import numpy
+
+## the output formats (see write_outputs)
+ANAGLYPH = "anaglyph"
+SIDE_BY_SIDE = "side_by_side"
+OVER_UNDER = "over_under"
+INTERLEAVED = "interleaved"
+LEFT = "left"
+RIGHT = "right"
+FORMATS = (ANAGLYPH, SIDE_BY_SIDE, OVER_UNDER, INTERLEAVED, LEFT, RIGHT)
+
+def output_shape(fmt, height, width, channels=1):
+    """! Determines the size of an output image.
+    The anaglyph is a RGBA image, all other formats are images of the views with alpha channel
+    (gray level images or, with color views, RGBA images).
+    @param fmt the output format (see FORMATS)
+    @param height the image height
+    @param width the image width
+    @param channels the number of color channels of the views (see Anaglyph.channels)
+    @return the shape of the output (height x width x channels)
+    """
+    if fmt == ANAGLYPH:
+        return (height, width, 4)
+    if fmt == SIDE_BY_SIDE:
+        return (height, 2*width, channels+1)
+    if fmt == OVER_UNDER:
+        return (2*height, width, channels+1)
+    if fmt in (INTERLEAVED, LEFT, RIGHT):
+        return (height, width, channels+1)
+    raise ValueError("unknown output format: %s"%(fmt))
+
+def allocate_outputs(formats, height, width, channels=1):
+    """! @return dict format -> output buffer (uint8, see output_shape) for the requested formats """
+    return dict((fmt, numpy.zeros(output_shape(fmt, height, width, channels), dtype=numpy.uint8)) for fmt in formats)
+
+def _views(anaglyph, swap_lr):
+    """! @return ((left image, left alpha), (right image, right alpha)), swapped if swap_lr """
+    left = (anaglyph.left, anaglyph.aleft)
+    right = (anaglyph.right, anaglyph.aright)
+    if swap_lr:
+        return right, left
+    return left, right
+
+def _write_view(out, view):
+    """! Writes a view (image, alpha) into an output window (color channels, alpha; converted to uint8). """
+    im = view[0]
+    out[:,:,:-1] = numpy.reshape(im, (im.shape[0], im.shape[1], out.shape[2]-1))
+    out[:,:,-1] = view[1]
+
+def _write_anaglyph(anaglyph, out, y, swap_lr):
+    anaglyph.write_result(out[y:y+anaglyph.left.shape[0]], swap_lr)
+
+def _write_side_by_side(anaglyph, out, y, swap_lr):
+    left, right = _views(anaglyph, swap_lr)
+    h, w = left[0].shape[0], left[0].shape[1]
+    _write_view(out[y:y+h,:w], left)
+    _write_view(out[y:y+h,w:], right)
+
+def _write_over_under(anaglyph, out, y, swap_lr):
+    left, right = _views(anaglyph, swap_lr)
+    h = left[0].shape[0]
+    height = out.shape[0]//2
+    _write_view(out[y:y+h], left)
+    _write_view(out[height+y:height+y+h], right)
+
+def _write_interleaved(anaglyph, out, y, swap_lr):
+    left, right = _views(anaglyph, swap_lr)
+    h = left[0].shape[0]
+    # even image rows from the left view, odd rows from the right view
+    e = y%2
+    _write_view(out[y+e:y+h:2], (left[0][e::2], left[1][e::2]))
+    _write_view(out[y+1-e:y+h:2], (right[0][1-e::2], right[1][1-e::2]))
+
+def _write_left(anaglyph, out, y, swap_lr):
+    left = _views(anaglyph, swap_lr)[0]
+    _write_view(out[y:y+left[0].shape[0]], left)
+
+def _write_right(anaglyph, out, y, swap_lr):
+    right = _views(anaglyph, swap_lr)[1]
+    _write_view(out[y:y+right[0].shape[0]], right)
+
+_writers = {
+    ANAGLYPH: _write_anaglyph,
+    SIDE_BY_SIDE: _write_side_by_side,
+    OVER_UNDER: _write_over_under,
+    INTERLEAVED: _write_interleaved,
+    LEFT: _write_left,
+    RIGHT: _write_right,
+}
+
+def write_outputs(anaglyph, outputs, y=0, swap_lr=False):
+    """! Writes the left and right image of an Anaglyph into the output buffers of any number of formats.
+    The values are converted to uint8 when written (no float RGBA temporary as in Anaglyph.get_result,
+    the anaglyph is written by Anaglyph.write_result). The luminance correction (f1, f2) only applies to the anaglyph.
+    @param anaglyph the Anaglyph holding the left and right image of the rows y..y+h-1 (e.g. a band, see anaglyph_renderer.render_bands)
+    @param outputs dict format -> output buffer (uint8, shape see output_shape, e.g. from allocate_outputs)
+    @param y the first row of the image held by the anaglyph
+    @param swap_lr if true the left and right image are swapped.
+    """
+    for fmt, out in outputs.items():
+        _writers[fmt](anaglyph, out, y, swap_lr)
@@ -0,0 +1,43 @@
+"""! Shared helpers of the tests: the import paths and the synthetic layer stacks the algorithms are compared on. """
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "benchmark"))
+sys.path.insert(0, os.path.join(HERE, "..", "plugin"))
+
+from synthetic import make_stack, CONSTANT_DEPTH, DEPTH_MAP
+
+## (mindisp, maxdisp) in percent of the image width: positive, negative and mixed disparities
+DISPARITIES = ((0.0, 5.0), (-6.0, -1.0), (-4.0, 6.5))
+
+def stacks(depth, seeds):
+    """! Yields the synthetic test cases: small stacks (97x61, 6 layers) with all DISPARITIES.
+    @param depth CONSTANT_DEPTH or DEPTH_MAP (see synthetic.make_stack)
+    @param seeds the number of random stacks
+    @return generator of (image, mindisp, maxdisp)
+    """
+    for seed in range(seeds):
+        image = make_stack(97, 61, 6, 0.4, depth, seed)
+        for mindisp, maxdisp in DISPARITIES:
+            yield image, mindisp, maxdisp
+
+class StackComparison(object):
+    """! Mixin of a unittest.TestCase running check(image, mindisp, maxdisp) on the synthetic stacks
+    with constant depths and with depth maps (see stacks).
+    """
+    ## the number of random stacks per kind of depth
+    seeds = 3
+
+    def check(self, image, mindisp, maxdisp):
+        raise NotImplementedError()
+
+    def compare(self, depth):
+        for image, mindisp, maxdisp in stacks(depth, self.seeds):
+            self.check(image, mindisp, maxdisp)
+
+    def test_constant_depth(self):
+        self.compare(CONSTANT_DEPTH)
+
+    def test_depth_map(self):
+        self.compare(DEPTH_MAP)
@@ -0,0 +1,68 @@
+"""! Compares the ColorAnaglyph with per channel renders of the gray level Anaglyph on synthetic RGB layer stacks.
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import unittest
+import numpy
+
+from helpers import StackComparison, stacks, CONSTANT_DEPTH, DEPTH_MAP
+from layer_stack import ArrayLayer, ArrayImage
+from color_anaglyph import ColorAnaglyph, MATRICES
+from anaglyph_renderer import render
+
+## max. abs. difference of the views and the anaglyph (float64 rounding errors)
+TOLERANCE = 1e-9
+
+def colorize(image, seed):
+    """! @return the image with random colors (RGBA) instead of the gray levels, except the depth maps """
+    rng = numpy.random.RandomState(seed)
+    layers = []
+    for layer in image.layers:
+        if layer.name.startswith("depthmap"):
+            layers.append(layer)
+            continue
+        data = numpy.empty((layer.height, layer.width, 4), dtype=numpy.uint8)
+        data[:,:,:3] = rng.randint(0, 256, (layer.height, layer.width, 3))
+        data[:,:,3] = layer.data[:,:,1]
+        layers.append(ArrayLayer(layer.name, data))
+    return ArrayImage(layers)
+
+def channel(image, c):
+    """! @return the gray level image (gray, alpha) of the color channel c of a colorized image """
+    return ArrayImage([layer if layer.bpp == 2 else ArrayLayer(layer.name, layer.data[:,:,(c,3)]) for layer in image.layers])
+
+class ColorAnaglyphTest(StackComparison, unittest.TestCase):
+    def check(self, image, mindisp, maxdisp):
+        color = colorize(image, 0)
+        result = render(color, mindisp, maxdisp, 1.0, 0.8, algorithm=ColorAnaglyph)
+        # the reference views: each color channel rendered as gray level image
+        left = numpy.empty(result.left.shape)
+        right = numpy.empty(result.right.shape)
+        for c in range(3):
+            expected = render(channel(color, c), mindisp, maxdisp, 1.0, 0.8)
+            left[:,:,c] = expected.left
+            right[:,:,c] = expected.right
+            self.assertLessEqual(numpy.abs(result.aleft-expected.aleft).max(), TOLERANCE)
+            self.assertLessEqual(numpy.abs(result.aright-expected.aright).max(), TOLERANCE)
+        self.assertLessEqual(numpy.abs(result.left-left).max(), TOLERANCE)
+        self.assertLessEqual(numpy.abs(result.right-right).max(), TOLERANCE)
+
+        # the anaglyph: the matrices applied to the reference views
+        ml, mr = (numpy.asarray(m, dtype=numpy.float64) for m in MATRICES["dubois"])
+        rgb = numpy.dot(left, ml.T)*1.0+numpy.dot(right, mr.T)*0.8
+        rgb[:,:,1:] += (1-0.8)/2
+        expected = numpy.clip(rgb, 0, 255)
+        self.assertLessEqual(numpy.abs(result.get_result(False)[:,:,:3]-expected).max(), TOLERANCE)
+
+    def test_gray_matrices(self):
+        # the gray matrices applied to gray level layers give the anaglyph of Anaglyph
+        for depth in (CONSTANT_DEPTH, DEPTH_MAP):
+            for image, mindisp, maxdisp in stacks(depth, 1):
+                expected = render(image, mindisp, maxdisp, 1.0, 0.8).get_result(True)
+                result = render(image, mindisp, maxdisp, 1.0, 0.8, algorithm=ColorAnaglyph)
+                result.matrices = MATRICES["gray"]
+                self.assertLessEqual(numpy.abs(result.get_result(True)-expected).max(), TOLERANCE)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+"""! Compares the float32 CompactAnaglyph with the float64 Anaglyph on synthetic layer stacks.
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import tracemalloc
+import unittest
+import numpy
+
+from helpers import StackComparison
+from anaglyph_algorithm import CompactAnaglyph
+from anaglyph_renderer import render, render_to_array
+
+## max. abs. difference of the anaglyph values (gray levels 0..255): the float32 rounding errors accumulate
+## over the layers (about 1e-5 per layer and value), far below one gray level
+TOLERANCE = 1e-3
+## max. abs. difference of the uint8 anaglyph: a value close to an integer may be truncated to the next lower one
+UINT8_TOLERANCE = 1
+
+## max. temporary memory of CompactAnaglyph.update_ext in bytes per pixel: only row/column sized arrays and the
+## internal buffers of numpy, far below one float32 copy of the layer (4 bytes per pixel)
+MAX_UPDATE_BYTES_PER_PIXEL = 1.0
+
+class CompactAnaglyphTest(StackComparison, unittest.TestCase):
+    def check(self, image, mindisp, maxdisp):
+        expected = render(image, mindisp, maxdisp, 1.0, 0.8).get_result(False)
+        result = render(image, mindisp, maxdisp, 1.0, 0.8, algorithm=CompactAnaglyph).get_result(False)
+        self.assertEqual(result.shape, expected.shape)
+        self.assertLessEqual(numpy.abs(result-expected).max(), TOLERANCE)
+
+        expected = render_to_array(image, mindisp, maxdisp, 1.0, 0.8, band_height=16)
+        result = render_to_array(image, mindisp, maxdisp, 1.0, 0.8, band_height=16, algorithm=CompactAnaglyph)
+        self.assertLessEqual(numpy.abs(result.astype(int)-expected).max(), UINT8_TOLERANCE)
+
+    def test_depth_map_memory(self):
+        # once the buffers of the canvas exist, a depth mapped layer is resampled in place
+        h, w = 400, 600
+        rng = numpy.random.RandomState(0)
+        layer = rng.randint(0, 256, (h, w, 2)).astype(numpy.uint8)
+        for d in (numpy.round(rng.uniform(-8, 8, (h, w))), rng.uniform(-8, 8, (h, w))):
+            anaglyph = CompactAnaglyph()
+            anaglyph.update_ext(layer, d)
+            tracemalloc.start()
+            try:
+                anaglyph.update_ext(layer, d)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertLess(peak, MAX_UPDATE_BYTES_PER_PIXEL*h*w)
+
+if __name__ == "__main__":
+    unittest.main()
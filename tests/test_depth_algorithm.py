@@ -0,0 +1,88 @@
+"""! Compares the layer plan of DepthAlgo with the original parsing of the layer names (per layer, at every call).
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import re
+import unittest
+import numpy
+
+import helpers
+from layer_stack import ArrayLayer, ArrayImage
+from depth_algorithm import DepthAlgo
+
+## the names of the test stack (top most layer first): all kinds of layers, two depth maps
+NAMES = ("depthmap m 0 to 1", "layer 0", "reldepthmap=m 1", "depth=0.3", "fixdepthmap=k 2",
+         "depthmap k -0.5 to 0.5", "layer 3", "reldepthmap = m 4", "depth=-0.2", "layer 5", "background")
+
+def reference(image, mindisp, maxdisp):
+    """! The original algorithm: the layers are rendered bottom layer first (except the depth maps), the name of
+    each layer is parsed when its disparity is computed.
+    @return list of (layer, disparity) in rendering order
+    """
+    depthmap = re.compile(r'depthmap\s+(\w+)\s+(-?[\d\.]+)\s+to\s+(-?[\d\.]+)')
+    reldepthmap = re.compile(r'reldepthmap\s*=\s*(\w+)')
+    fixdepthmap = re.compile(r'fixdepthmap\s*=\s*(\w+)')
+    depth = re.compile(r'depth=(-?[\d\.]+)')
+    def fixed(layer):
+        return depth.match("depth=0" if layer.name.startswith("background") else layer.name)
+    def scale(d):
+        return mindisp+float(maxdisp-mindisp)*d
+
+    maps = {}
+    normal = []
+    for layer in reversed(image.layers):
+        m = depthmap.match(layer.name)
+        if m:
+            data = layer.data[:,:,0].astype(numpy.float64)
+            data = (data-data.min())/(data.max()-data.min())
+            maps[m.group(1)] = float(m.group(2))+data*(float(m.group(3))-float(m.group(2)))
+        elif not (fixdepthmap.match(layer.name) or fixed(layer)):
+            normal.insert(0, layer)
+    n = len(normal)
+
+    result = []
+    for layer in reversed(image.layers):
+        if depthmap.match(layer.name):
+            continue
+        mrel = reldepthmap.match(layer.name)
+        mfix = fixdepthmap.match(layer.name)
+        if mrel or mfix:
+            if mrel:
+                d = float(image.layers.index(layer))/float(n-1)
+                d = d-1.0/(n-1)+maps[mrel.group(1)]*2.0/(n-1)
+            else:
+                d = maps[mfix.group(1)]
+            result.append((layer, numpy.floor(0.5+scale(d)*image.width/100.0)))
+        else:
+            m = fixed(layer)
+            d = float(m.group(1)) if m else float(normal.index(layer))/float(n-1)
+            result.append((layer, int(0.5+scale(d)*image.width/100.0)))
+    return result
+
+def make_image(width, height, seed):
+    """! @return a stack with the layer NAMES (random pixels, the depth maps are random as well) """
+    rng = numpy.random.RandomState(seed)
+    return ArrayImage([ArrayLayer(name, rng.randint(0, 256, (height, width, 2))) for name in NAMES])
+
+class DepthAlgoTest(unittest.TestCase):
+    def test_plan(self):
+        for seed in range(3):
+            image = make_image(89, 7, seed)
+            for mindisp, maxdisp in helpers.DISPARITIES:
+                expected = reference(image, mindisp, maxdisp)
+                algo = DepthAlgo(image, mindisp, maxdisp)
+                entries = algo.layers()
+                self.assertEqual([entry.layer for entry in entries], [layer for layer, d in expected])
+                self.assertEqual([entry.layer for entry in algo.layers(True)], [layer for layer, d in reversed(expected)])
+                for entry, (layer, d) in zip(entries, expected):
+                    self.assertEqual(entry.has_map(), not isinstance(d, int), layer.name)
+                    if entry.has_map():
+                        self.assertTrue(numpy.array_equal(algo.disparity(entry), d), layer.name)
+                    else:
+                        self.assertEqual(algo.disparity(entry), d, layer.name)
+                        self.assertEqual(algo.get_disparity(layer), d, layer.name)
+                algo.close()
+
+if __name__ == "__main__":
+    unittest.main()
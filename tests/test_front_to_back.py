@@ -0,0 +1,29 @@
+"""! Compares the uint8 outputs of FrontToBackAnaglyph with the back to front Anaglyph on synthetic layer stacks.
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import unittest
+import numpy
+
+from helpers import StackComparison
+from front_to_back import FrontToBackAnaglyph
+from anaglyph_renderer import render, render_outputs
+from stereo_output import FORMATS
+
+class FrontToBackTest(StackComparison, unittest.TestCase):
+    seeds = 6
+
+    def check(self, image, mindisp, maxdisp):
+        expected = numpy.array(render(image, mindisp, maxdisp, 1.0, 0.8).get_result(False), dtype=numpy.uint8)
+        result = render(image, mindisp, maxdisp, 1.0, 0.8, algorithm=FrontToBackAnaglyph).get_result(False)
+        self.assertTrue(numpy.array_equal(numpy.array(result, dtype=numpy.uint8), expected))
+
+        expected = render_outputs(image, mindisp, maxdisp, 1.0, 0.8, formats=FORMATS, band_height=16)
+        result = render_outputs(image, mindisp, maxdisp, 1.0, 0.8, formats=FORMATS, band_height=16,
+                                algorithm=FrontToBackAnaglyph)
+        for fmt in FORMATS:
+            self.assertTrue(numpy.array_equal(result[fmt], expected[fmt]), fmt)
+
+if __name__ == "__main__":
+    unittest.main()
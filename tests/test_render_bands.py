@@ -0,0 +1,28 @@
+"""! Compares the band wise rendering (render_bands, also with several threads) with render on synthetic layer stacks.
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import unittest
+import numpy
+
+from helpers import StackComparison
+from anaglyph_algorithm import Anaglyph, CompactAnaglyph
+from front_to_back import FrontToBackAnaglyph
+from anaglyph_renderer import render, render_to_array
+
+class RenderBandsTest(StackComparison, unittest.TestCase):
+    def check(self, image, mindisp, maxdisp):
+        for algorithm in (Anaglyph, CompactAnaglyph, FrontToBackAnaglyph):
+            for swap_lr in (False, True):
+                expected = numpy.empty((image.height, image.width, 4), dtype=numpy.uint8)
+                render(image, mindisp, maxdisp, 1.0, 0.8, algorithm=algorithm).write_result(expected, swap_lr)
+                for threads in (1, 3):
+                    # band heights which do and do not divide the image height
+                    for band_height in (16, 61):
+                        result = render_to_array(image, mindisp, maxdisp, 1.0, 0.8, swap_lr, band_height=band_height,
+                                                 threads=threads, algorithm=algorithm)
+                        self.assertTrue(numpy.array_equal(result, expected), (algorithm.__name__, threads, band_height))
+
+if __name__ == "__main__":
+    unittest.main()
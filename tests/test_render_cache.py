@@ -0,0 +1,81 @@
+"""! Tests the render cache: the uint8 outputs of render_cached match render, and editing a layer recomputes
+only the span of the layer (see render_cache.combine_cached).
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from helpers import StackComparison, make_stack
+from gimpfu_numpy_converter import layer2array
+from depth_algorithm import DepthAlgo
+from anaglyph_renderer import render
+from render_cache import RenderCache, combine_cached, render_cached, layer_key, MIN_SPAN
+
+def uint8_result(anaglyph):
+    """! @return the uint8 anaglyph (see Anaglyph.write_result) """
+    out = numpy.empty((anaglyph.left.shape[0], anaglyph.left.shape[1], 4), dtype=numpy.uint8)
+    anaglyph.write_result(out, False)
+    return out
+
+def cached_layers(image, loaded):
+    """! @return the layers for combine_cached (as render_cached), the loaders append the layer index to loaded """
+    depthalgo = DepthAlgo(image, 0.0, 5.0)
+    def loader(i, entry):
+        def load():
+            loaded.append(i)
+            return layer2array(entry.layer), depthalgo.disparity(entry)
+        return load
+    return [(layer_key(layer2array(entry.layer), depthalgo.disparity(entry)), loader(i, entry))
+            for i, entry in enumerate(depthalgo.layers())]
+
+class RenderCacheTest(StackComparison, unittest.TestCase):
+    seeds = 2
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check(self, image, mindisp, maxdisp):
+        expected = uint8_result(render(image, mindisp, maxdisp, 1.0, 0.8))
+        for cache in (RenderCache(), RenderCache(self.directory)):
+            for i in range(2):
+                result = render_cached(image, mindisp, maxdisp, 1.0, 0.8, cache)
+                self.assertTrue(numpy.array_equal(uint8_result(result), expected))
+
+    def test_edit(self):
+        image = make_stack(97, 61, 13, 0.4)
+        n = len(image.layers)
+        shape = (image.height, image.width)
+        # room for the composites of 8 spans: the spans have MIN_SPAN layers
+        cache = RenderCache(self.directory, 8*RenderCache().composite_bytes(shape))
+        spans = [set(range(i, min(n, i+MIN_SPAN))) for i in range(0, n, MIN_SPAN)]
+
+        loaded = []
+        combine_cached(cached_layers(image, loaded), shape, cache)
+        self.assertEqual(sorted(loaded), list(range(n)))
+        loaded = []
+        combine_cached(cached_layers(image, loaded), shape, cache)
+        self.assertEqual(loaded, [])
+
+        # the same layer edited several times, then another layer (index bottom layer first)
+        for edit in (5, 5, 5, 11):
+            image.layers[n-1-edit].data[:,:,0] += 1
+            loaded = []
+            result = combine_cached(cached_layers(image, loaded), shape, cache)
+            span = [s for s in spans if edit in s][0]
+            self.assertEqual(set(loaded), span)
+            self.assertEqual(len(loaded), len(span))
+            expected = uint8_result(render(image, 0.0, 5.0, 1.0, 0.8))
+            self.assertTrue(numpy.array_equal(uint8_result(result.to_anaglyph(1.0, 0.8)), expected))
+            size = sum(os.path.getsize(os.path.join(self.directory, f)) for f in os.listdir(self.directory))
+            self.assertLessEqual(size, cache.max_bytes)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+"""! Tests the output formats of stereo_output (output_shape, write_outputs) with known left and right images.
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+import unittest
+import numpy
+
+import helpers  # the import paths of the plugin
+from anaglyph_algorithm import Anaglyph
+from stereo_output import output_shape, allocate_outputs, write_outputs, FORMATS, \
+    ANAGLYPH, SIDE_BY_SIDE, OVER_UNDER, INTERLEAVED, LEFT, RIGHT
+
+def make_anaglyph(h, w, seed=0):
+    """! @return an Anaglyph holding random (integer valued) left and right images """
+    rng = numpy.random.RandomState(seed)
+    anaglyph = Anaglyph(1.0, 0.8)
+    anaglyph.left, anaglyph.right, anaglyph.aleft, anaglyph.aright = rng.randint(0, 256, (4, h, w)).astype(numpy.float64)
+    return anaglyph
+
+def band(anaglyph, y, h):
+    """! @return an Anaglyph holding the rows y..y+h-1 of anaglyph (as the bands of anaglyph_renderer.render_bands) """
+    result = Anaglyph(anaglyph.f1, anaglyph.f2)
+    for name in ("left", "right", "aleft", "aright"):
+        setattr(result, name, getattr(anaglyph, name)[y:y+h])
+    return result
+
+def view(im, alpha):
+    """! @return the expected output of a view (gray, alpha; uint8) """
+    return numpy.stack((im, alpha), axis=2).astype(numpy.uint8)
+
+class StereoOutputTest(unittest.TestCase):
+    def test_output_shape(self):
+        for channels in (1, 3):
+            self.assertEqual(output_shape(ANAGLYPH, 5, 7, channels), (5, 7, 4))
+            self.assertEqual(output_shape(SIDE_BY_SIDE, 5, 7, channels), (5, 14, channels+1))
+            self.assertEqual(output_shape(OVER_UNDER, 5, 7, channels), (10, 7, channels+1))
+            for fmt in (INTERLEAVED, LEFT, RIGHT):
+                self.assertEqual(output_shape(fmt, 5, 7, channels), (5, 7, channels+1))
+        self.assertRaises(ValueError, output_shape, "unknown", 5, 7)
+
+    def test_write_outputs(self):
+        h, w = 13, 11
+        anaglyph = make_anaglyph(h, w)
+        for swap_lr in (False, True):
+            left = view(anaglyph.left, anaglyph.aleft)
+            right = view(anaglyph.right, anaglyph.aright)
+            if swap_lr:
+                left, right = right, left
+            expected_anaglyph = numpy.empty((h, w, 4), dtype=numpy.uint8)
+            anaglyph.write_result(expected_anaglyph, swap_lr)
+            interleaved = left.copy()
+            interleaved[1::2] = right[1::2]
+            expected = {
+                ANAGLYPH: expected_anaglyph,
+                SIDE_BY_SIDE: numpy.concatenate((left, right), axis=1),
+                OVER_UNDER: numpy.concatenate((left, right), axis=0),
+                INTERLEAVED: interleaved,
+                LEFT: left,
+                RIGHT: right,
+            }
+
+            outputs = allocate_outputs(FORMATS, h, w)
+            write_outputs(anaglyph, outputs, swap_lr=swap_lr)
+            for fmt in FORMATS:
+                self.assertTrue(numpy.array_equal(outputs[fmt], expected[fmt]), fmt)
+
+            # bands of odd and even heights, starting at odd and even rows
+            outputs = allocate_outputs(FORMATS, h, w)
+            for y, bh in ((0, 3), (3, 4), (7, 5), (12, 1)):
+                write_outputs(band(anaglyph, y, bh), outputs, y, swap_lr)
+            for fmt in FORMATS:
+                self.assertTrue(numpy.array_equal(outputs[fmt], expected[fmt]), fmt)
+
+if __name__ == "__main__":
+    unittest.main()